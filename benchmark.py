@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of data loading, the cost engine and the dashboard callbacks.
+
+Writes a synthetic data folder shaped like the real one (the fueleconomy.gov
+vehicles csv, EIA petroleum and electricity prices and eGRID CO2 rates),
+creates the dashboard app on it and times each path. Results are printed as
+JSON, and compared with a stored run when a baseline is given:
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --baseline baseline.json
+
+Scaling mode repeats the benchmarks with the catalog grown 1x to 50x, to see
+how each path scales with the size of the vehicles database:
+
+    python benchmark.py --scaling
+
+@author: richardbradshaw
+"""
+
+# Imports
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import numpy as np
+import pandas as pd
+import data_snapshot
+import fuel_prices
+import state_codes
+import vehicle_catalog
+
+# Rows of the synthetic catalog at scale 1, about the size of the real one
+catalog_rows = 47000
+
+# Catalog sizes of scaling mode, as multiples of catalog_rows
+scaling_factors = [1, 2, 5, 10, 20, 50]
+
+# Share of each kind of vehicle in the synthetic catalog
+vehicle_kinds = {'gas': 0.8, 'hybrid': 0.06, 'diesel': 0.04, 'phev': 0.03,
+                 'ev': 0.07}
+
+makes = ['Acura', 'Alfa Romeo', 'Audi', 'BMW', 'Buick', 'Cadillac',
+         'Chevrolet', 'Chrysler', 'Dodge', 'Fiat', 'Ford', 'Genesis', 'GMC',
+         'Honda', 'Hyundai', 'Infiniti', 'Jaguar', 'Jeep', 'Kia',
+         'Land Rover', 'Lexus', 'Lincoln', 'Mazda', 'Mercedes-Benz', 'Mini',
+         'Mitsubishi', 'Nissan', 'Polestar', 'Porsche', 'Ram', 'Rivian',
+         'Subaru', 'Tesla', 'Toyota', 'Volkswagen', 'Volvo']
+
+transmissions = ['Automatic (S6)', 'Automatic (S8)', 'Automatic 4-spd',
+                 'Automatic (AV-S7)', 'Automatic (variable gear ratios)',
+                 'Manual 5-spd', 'Manual 6-spd']
+
+# EIA petroleum areas and products of the synthetic prices
+petroleum_areas = {'NUS': 'U.S.', 'R1X': 'PADD 1A', 'R1Y': 'PADD 1B',
+                   'R1Z': 'PADD 1C', 'R20': 'PADD 2', 'R30': 'PADD 3',
+                   'R40': 'PADD 4', 'R50': 'PADD 5', 'SCA': 'CALIFORNIA'}
+petroleum_codes = {'EPMRU': 'Conventional Regular Gasoline',
+                   'EPMPU': 'Conventional Premium Gasoline',
+                   'EPMMU': 'Gasoline Conventional Midgrade',
+                   'EPD2D': 'No 2 Diesel'}
+
+# Vehicles of the default comparison, which must be in every catalog
+office_ids = [24008, 21018]
+
+# State, daily city miles and daily highway miles of the timed requests
+benchmark_trip = ('Pennsylvania', 15, 10)
+
+# Rows of the timed batch API request
+batch_rows = 1000
+
+
+def synthetic_catalog(rows, seed=0):
+    '''Function to generate a vehicles table shaped like cars_database.csv
+
+    Args:
+        rows(int): number of vehicles
+        seed(int): random seed
+
+    Returns:
+        DataFrame with the columns of the fueleconomy.gov database read by
+        the dashboard and a few it does not read
+    '''
+    rng = np.random.default_rng(seed)
+    kind = rng.choice(list(vehicle_kinds.keys()), rows,
+                      p=list(vehicle_kinds.values()))
+    kind[:len(office_ids)] = 'gas'
+    gas, hybrid, diesel = kind == 'gas', kind == 'hybrid', kind == 'diesel'
+    phev, ev = kind == 'phev', kind == 'ev'
+
+    year = rng.integers(1984, 2026, rows)
+    make = rng.choice(makes, rows)
+    # more models in larger catalogs, so each model keeps a few versions
+    model_number = rng.integers(1, max(5, rows // 1500), rows)
+    model = pd.Series(make).str[:3] + '-' + model_number.astype(str)
+
+    city08 = rng.integers(10, 35, rows) + np.where(hybrid | phev, 15, 0)
+    highway08 = city08 + rng.integers(2, 12, rows)
+    city08 = np.where(ev, rng.integers(90, 140, rows), city08)
+    highway08 = np.where(ev, rng.integers(80, 120, rows), highway08)
+    combined = 0.55 * city08 + 0.45 * highway08
+    co2 = np.where(diesel, 10180, 8887) / combined
+    gas_type = rng.choice(['Regular Gasoline', 'Premium Gasoline',
+                           'Midgrade Gasoline'], rows, p=[0.75, 0.22, 0.03])
+
+    cars = pd.DataFrame({
+        'barrels08': np.round(365 * 30 / combined / 42, 3),
+        'year': year,
+        'make': make,
+        'model': model,
+        'VClass': rng.choice(['Compact Cars', 'Midsize Cars',
+                              'Small Sport Utility Vehicle 4WD',
+                              'Standard Pickup Trucks'], rows),
+        'id': np.arange(rows) + 100000,
+        'city08': city08,
+        'highway08': highway08,
+        'cityE': np.where(ev | phev, rng.integers(25, 40, rows), 0)
+        .astype(float),
+        'highwayE': np.where(ev | phev, rng.integers(28, 45, rows), 0)
+        .astype(float),
+        'rangeCityA': np.where(phev, rng.integers(15, 55, rows), 0)
+        .astype(float),
+        'rangeHwyA': np.where(phev, rng.integers(15, 55, rows), 0)
+        .astype(float),
+        'rangeCity': np.where(ev, rng.integers(80, 400, rows), 0),
+        'rangeHwy': np.where(ev, rng.integers(80, 400, rows), 0),
+        'co2TailpipeGpm': np.where(ev, 0.0, np.round(co2, 1)),
+        'trany': np.where(ev, 'Automatic (A1)',
+                          rng.choice(transmissions, rows)),
+        'displ': np.where(ev, np.nan,
+                          rng.choice([1.5, 1.8, 2.0, 2.5, 3.5, 5.7], rows)),
+        'cylinders': np.where(ev, np.nan, rng.choice([4.0, 6.0, 8.0], rows)),
+        'startStop': np.where(year >= 2012,
+                              rng.choice(['Y', 'N'], rows), None),
+        'fuelType1': np.select([ev, diesel, hybrid], ['Electricity',
+                                                      'Diesel',
+                                                      'Regular Gasoline'],
+                               gas_type),
+        'fuelType2': np.where(phev, 'Electricity', None),
+        'atvType': np.select([ev, diesel, hybrid, phev],
+                             ['EV', 'Diesel', 'Hybrid', 'Plug-in Hybrid'],
+                             None),
+        'comb08': np.round(combined).astype(int)})
+
+    # a few incomplete vehicles for the cleaning to drop
+    incomplete = gas & (rng.random(rows) < 0.005)
+    incomplete[:len(office_ids)] = False
+    cars.loc[incomplete, 'cylinders'] = np.nan
+    cars.loc[:len(office_ids) - 1, 'id'] = office_ids
+    return cars
+
+
+def synthetic_prices(seed=0):
+    '''Function to generate EIA shaped petroleum and electricity prices
+
+    Args:
+        seed(int): random seed
+
+    Returns:
+        tuple of the weekly petroleum, monthly state electricity and monthly
+        US electricity price DataFrames
+    '''
+    rng = np.random.default_rng(seed)
+    weeks = pd.date_range('2008-01-07', '2025-12-29', freq='W-MON')
+    petrol_prices = []
+    for duoarea, area_name in petroleum_areas.items():
+        for product, product_name in petroleum_codes.items():
+            # a random walk around 3 dollars per gallon
+            walk = 3 + np.cumsum(rng.normal(0, 0.03, len(weeks)))
+            petrol_prices.append(pd.DataFrame({
+                'period': weeks, 'duoarea': duoarea, 'area-name': area_name,
+                'product': product, 'product-name': product_name,
+                'process': 'PTE', 'value': np.round(np.abs(walk), 3),
+                'units': '$/GAL'}))
+    petrol_prices = pd.concat(petrol_prices, ignore_index=True)
+
+    months = pd.date_range('2001-01-01', '2025-12-01', freq='MS')
+    electricity_prices = pd.concat([pd.DataFrame({
+        'period': months, 'State': state, 'Data Status': 'Final',
+        'price': np.round(rng.uniform(8, 30) + rng.normal(0, 1, len(months)),
+                          2)}) for state in state_codes.states.keys()],
+        ignore_index=True)
+    us_elec = pd.DataFrame({'Data Status': 'Final',
+                            'price': np.round(13 + rng.normal(0, 1,
+                                                              len(months)),
+                                              2),
+                            'period': months})
+    return petrol_prices, electricity_prices, us_elec
+
+
+def synthetic_co2(seed=0):
+    '''Function to generate eGRID shaped state and US CO2 emission rates'''
+    rng = np.random.default_rng(seed)
+    state_co2 = pd.DataFrame({'state': list(state_codes.states.keys())
+                              + ['US'],
+                              'co2_lb/MWh': rng.integers(
+                                  10, 1800, len(state_codes.states) + 1)
+                              .astype(float)})
+    state_co2['co2_g/kWh'] = state_co2['co2_lb/MWh'] / 1000 * 453.59
+    return state_co2
+
+
+def write_synthetic_data(data_path, scale=1, seed=0):
+    '''Function to write a synthetic data folder for the dashboard
+
+    Args:
+        data_path(str): folder to write the data files to
+        scale(float): size of the catalog as a multiple of catalog_rows
+        seed(int): random seed
+
+    Returns:
+        data_path
+    '''
+    os.makedirs(data_path, exist_ok=True)
+    synthetic_catalog(int(catalog_rows * scale), seed).to_csv(
+        os.path.join(data_path, vehicle_catalog.csv_file))
+    petrol_prices, electricity_prices, us_elec = synthetic_prices(seed)
+    petrol_prices.to_csv(os.path.join(data_path, 'petrol_prices.csv'))
+    electricity_prices.to_csv(os.path.join(data_path,
+                                           'state_electricity.csv'))
+    us_elec.to_csv(os.path.join(data_path, 'us_electricity.csv'))
+    synthetic_co2(seed).to_csv(os.path.join(data_path, 'egrid_co2_all.csv'))
+    return data_path
+
+
+def time_call(function, repeat=5):
+    '''Function to time a function call
+
+    Fast functions are called in loops long enough to time reliably, as by
+    the timeit command line.
+
+    Args:
+        function(function): function to time, called without arguments
+        repeat(int): number of timed loops
+
+    Returns:
+        dictionary of the median and best time of one call in milliseconds,
+        and the calls per loop
+    '''
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = np.array(timer.repeat(repeat, number)) / number * 1000
+    return {'median_ms': round(float(np.median(times)), 4),
+            'min_ms': round(float(times.min()), 4),
+            'number': number, 'repeat': repeat}
+
+
+# Variables that would change the settings of the app
+app_variables = ['DATA_PATH', 'RESULT_CACHE_DB', 'DATA_WATCH_INTERVAL',
+                 'SHARED_ARRAYS_DIR', 'CLIENTSIDE_DROPDOWNS', 'BACKGROUND_LOAD',
+                 'METRICS_ENABLED', 'PROFILE_CALLBACKS', 'PROFILE_ON_REQUEST']
+
+# Longest import of vehicle_compare allowed, most of it is pandas and dash
+import_budget_ms = 1500
+
+# Start up steps timed in a new interpreter
+startup_scripts = {
+    'import_vehicle_compare': 'import vehicle_compare',
+    # until the server can answer health checks
+    'create_app_background': 'import vehicle_compare\n'
+    'vehicle_compare.create_app({{"data_path": {data_path!r}}})',
+    # until the data is loaded
+    'create_app_loaded': 'import vehicle_compare\n'
+    'vehicle_compare.create_app({{"data_path": {data_path!r}, '
+    '"background_load": False}})'}
+
+
+def startup_time(name, data_path, repeat=3):
+    '''Function to time a start up step of the app in a new interpreter
+
+    Args:
+        name(str): key of startup_scripts
+        data_path(str): data folder the app is pointed at
+        repeat(int): number of runs
+
+    Returns:
+        dictionary like time_call
+    '''
+    environment = {key: value for key, value in os.environ.items()
+                   if key not in app_variables}
+    script = ('import time\nstart = time.perf_counter()\n'
+              + startup_scripts[name].format(data_path=data_path)
+              + '\nprint(time.perf_counter() - start)')
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script],
+                                capture_output=True, text=True, check=True,
+                                env=environment,
+                                cwd=os.path.dirname(os.path.abspath(
+                                    __file__)))
+        times.append(float(output.stdout.split()[-1]) * 1000)
+    return {'median_ms': round(float(np.median(times)), 4),
+            'min_ms': round(float(np.min(times)), 4),
+            'number': 1, 'repeat': repeat}
+
+
+def benchmark_vehicles(cars):
+    '''Function to pick a combustion, an electric and a plug-in vehicle'''
+    electric = cars['fuelType1'] == 'Electricity'
+    plug_in = cars['atvType'] == 'Plug-in Hybrid'
+    return {'ice': int(cars.index[~electric & ~plug_in][0]),
+            'ev': int(cars.index[electric][0]),
+            'phev': int(cars.index[plug_in][0])}
+
+
+def run_benchmarks(vc, data_path, repeat=5):
+    '''Function to time each path of the dashboard on one data folder
+
+    Results are calculated without the caches, except for
+    submit_calc_cached, so every timing includes the work it names.
+
+    Args:
+        vc(module): the imported vehicle_compare module
+        data_path(str): synthetic data folder
+        repeat(int): number of timed loops of each benchmark
+
+    Returns:
+        dictionary of time_call results keyed by benchmark name
+    '''
+    results = {}
+    # data loading, from the csv file and then from the catalog snapshot
+    results['load_snapshot_csv'] = time_call(
+        lambda: data_snapshot.load_snapshot(data_path), repeat)
+    vehicle_catalog.build_snapshot(data_path)
+    results['load_snapshot_npz'] = time_call(
+        lambda: data_snapshot.load_snapshot(data_path), repeat)
+    for name in startup_scripts.keys():
+        results[name] = startup_time(name, data_path)
+
+    vc.create_app({'data_path': data_path, 'shared_path': None,
+                   'result_cache_db': None, 'clientside_dropdowns': False,
+                   'data_watch_interval': None, 'background_load': False})
+    vc.fuel_costs_cache.clear()
+    vc.state_map_cache.clear()
+    snapshot = vc.data_store.current()
+    results['prepare_snapshot'] = time_call(
+        lambda: vc.prepare_snapshot(snapshot), repeat)
+    results['serve_layout'] = time_call(vc.serve_layout, repeat)
+
+    # price statistics
+    results['get_region'] = time_call(
+        lambda: [vc.get_region(i) for i in state_codes.state_names], repeat)
+    results['build_price_statistics'] = time_call(
+        lambda: fuel_prices.build_price_statistics(
+            snapshot.petrol_prices, snapshot.electricity_prices,
+            snapshot.us_elec), repeat)
+    series = fuel_prices.build_price_index(
+        snapshot.petrol_prices, snapshot.electricity_prices,
+        snapshot.us_elec)[('Regular Gasoline', 'U.S.')]
+    results['price_window'] = time_call(
+        lambda: fuel_prices.window_statistics(series, '5year'), repeat)
+    results['price_date_window'] = time_call(
+        lambda: fuel_prices.date_window_statistics(series, '2015-01-01',
+                                                   '2020-12-31'), repeat)
+
+    # fuel_costs for each branch of the cost calculation
+    state_in, city_miles, highway_miles = benchmark_trip
+    vehicles = benchmark_vehicles(snapshot.cars)
+    for kind, index in vehicles.items():
+        car = snapshot.cars.loc[index]
+        results['fuel_costs_' + kind] = time_call(
+            lambda: vc.fuel_costs(car, state_in, city_miles, highway_miles,
+                                  snapshot), repeat)
+
+    # the year, make and model dropdown cascade
+    car = snapshot.cars.loc[vehicles['ice']]
+    year, make, model = int(car['year']), car['make'], car['model']
+    for changed in ['year', 'make', 'model']:
+        results['dropdown_' + changed] = time_call(
+            lambda: vc.vehicle_options(changed, year, make, model, snapshot),
+            repeat)
+
+    # the comparison, with and without building the figures, the options
+    # dropdowns hold fueleconomy.gov ids
+    car_rows = list(vehicles.values())
+    cars_in = [int(snapshot.cars.loc[i, 'id']) for i in car_rows]
+    results['submit_calc_costs'] = time_call(
+        lambda: (vc.fuel_costs_cache.clear(),
+                 [vc.cached_fuel_costs(i, state_in, city_miles,
+                                       highway_miles, snapshot)
+                  for i in car_rows]), repeat)
+    results['submit_calc'] = time_call(
+        lambda: (vc.fuel_costs_cache.clear(),
+                 vc.submit_calc(1, cars_in, state_in, city_miles,
+                                highway_miles, '3year')), repeat)
+    results['submit_calc_cached'] = time_call(
+        lambda: vc.submit_calc(1, cars_in, state_in, city_miles,
+                               highway_miles, '3year'), repeat)
+
+    # the other callbacks
+    results['rank_calc'] = time_call(
+        lambda: vc.rank_calc(1, state_in, city_miles, highway_miles, None,
+                             None, None, None, 'annual_cost', 10, '3year'),
+        repeat)
+    results['mileage_calc'] = time_call(
+        lambda: vc.mileage_calc(1, cars_in, state_in, city_miles,
+                                highway_miles, '3year'), repeat)
+    results['state_map_calc'] = time_call(
+        lambda: (vc.state_map_cache.clear(),
+                 vc.state_map_calc(1, 'annual_cost', cars_in, city_miles,
+                                   highway_miles, '3year')), repeat)
+
+    # the batch API, a request of batch_rows rows read to the end
+    client = vc.server.test_client()
+    rows = [[cars_in[i % len(cars_in)],
+             state_codes.state_names[i % len(state_codes.state_names)],
+             city_miles, highway_miles] for i in range(batch_rows)]
+    results['batch_api'] = time_call(
+        lambda: client.post('/api/fuel_costs', json={'rows': rows}).data,
+        repeat)
+    return results
+
+
+def compare_baseline(runs, baseline_runs, tolerance=0.25):
+    '''Function to find the benchmarks that are slower than a baseline
+
+    Best times are compared, as they vary least between runs.
+
+    Args:
+        runs(dict): results of run_benchmarks keyed by scale
+        baseline_runs(dict): stored results in the same form
+        tolerance(float): allowed slowdown, 0.25 is 25% slower
+
+    Returns:
+        list of dictionaries of the scale, name, times and ratio of each
+        regression
+    '''
+    regressions = []
+    for scale, results in runs.items():
+        for name, result in results.items():
+            baseline = baseline_runs.get(scale, {}).get(name)
+            if baseline is None or baseline['min_ms'] <= 0:
+                continue
+            ratio = result['min_ms'] / baseline['min_ms']
+            if ratio > 1 + tolerance:
+                regressions.append({'scale': scale, 'name': name,
+                                    'baseline_ms': baseline['min_ms'],
+                                    'min_ms': result['min_ms'],
+                                    'ratio': round(ratio, 3)})
+    return regressions
+
+
+def scaling_ratios(runs):
+    '''Function to return how much slower each benchmark is at each scale
+
+    Args:
+        runs(dict): results of run_benchmarks keyed by scale
+
+    Returns:
+        dictionary of the time at each scale over the time at the smallest
+        scale, keyed by benchmark name
+    '''
+    scales = sorted(runs.keys(), key=float)
+    smallest = runs[scales[0]]
+    return {name: {scale: round(runs[scale][name]['min_ms']
+                                / result['min_ms'], 3)
+                   for scale in scales if name in runs[scale]}
+            for name, result in smallest.items() if result['min_ms'] > 0}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', type=float, nargs='+', default=[1],
+                        help='catalog sizes as multiples of catalog_rows')
+    parser.add_argument('--scaling', action='store_true',
+                        help=f'run at the scales {scaling_factors}')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed loops of each benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--baseline', help='JSON file of a stored run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown against the baseline')
+    arguments = parser.parse_args(arguments)
+    scales = scaling_factors if arguments.scaling else arguments.scale
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        data_paths = {f'{scale:g}': write_synthetic_data(
+            os.path.join(temp_path, f'{scale:g}'), scale, arguments.seed)
+            for scale in scales}
+
+        import vehicle_compare as vc
+
+        runs = {}
+        for scale, data_path in data_paths.items():
+            runs[scale] = run_benchmarks(vc, data_path, arguments.repeat)
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'catalog_rows': catalog_rows,
+              'seed': arguments.seed,
+              'runs': runs}
+    if len(runs) > 1:
+        report['scaling'] = scaling_ratios(runs)
+    report['import_budget_ms'] = import_budget_ms
+    report['over_budget'] = [scale for scale, results in runs.items()
+                             if results['import_vehicle_compare']['min_ms']
+                             > import_budget_ms]
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        report['tolerance'] = arguments.tolerance
+        report['regressions'] = compare_baseline(runs, baseline['runs'],
+                                                 arguments.tolerance)
+
+    text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            output_file.write(text)
+    print(text)
+    return 1 if report.get('regressions') or report['over_budget'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized fuel cost and CO2 calculations for the vehicle comparison
+dashboard.
+
+Computes the same annual costs and emissions as fuel_costs in
+vehicle_compare.py for any number of vehicles at once. Electric vehicles,
+plug-in hybrids and all other vehicles are calculated with masks instead of
+branching on each vehicle.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import numpy as np
+import fuel_prices
+
+
+def vehicle_arrays(vehicles):
+    '''Function to pull the columns used in the cost calculations
+
+    Args:
+        vehicles(DataFrame): rows of the vehicles database
+
+    Returns:
+        dictionary of numpy arrays
+    '''
+    arrays = {column: vehicles[column].to_numpy(dtype=float)
+              for column in ['city08', 'highway08', 'cityE', 'highwayE',
+                             'rangeCityA', 'rangeHwyA', 'co2TailpipeGpm']}
+    arrays['fuelType1'] = vehicles['fuelType1'].to_numpy()
+    arrays['electric'] = arrays['fuelType1'] == 'Electricity'
+    arrays['plug_in_hybrid'] = ~arrays['electric'] \
+        & (vehicles['atvType'] == 'Plug-in Hybrid').to_numpy()
+    return arrays
+
+
+def fuel_price_arrays(fuel_type, state_tables, state_code,
+                      time_period='3year'):
+    '''Function to look up the fuel price statistics of every vehicle
+
+    Vehicles that do not use a petroleum fuel are priced with electricity,
+    as in fuel_costs. With an array of state codes the prices get a leading
+    axis of states, so all of them are calculated at once.
+
+    Args:
+        fuel_type(array): fuelType1 of every vehicle
+        state_tables(dict): tables from state_codes.build_state_tables
+        state_code(int or array): code of the state
+        time_period(str): time period of the prices in state_tables
+
+    Returns:
+        dictionary of state and US fuel price mean and std arrays
+    '''
+    state_code = np.asarray(state_code)
+    prices = {key: np.full(state_code.shape + (len(fuel_type),), np.nan)
+              for key in ['gas_mean', 'gas_std', 'us_gas_mean', 'us_gas_std']}
+    petroleum = np.isin(fuel_type, list(fuel_prices.petroleum_products))
+    fuel_masks = {fuel: fuel_type == fuel for fuel in set(fuel_type[petroleum])}
+    fuel_masks['Electricity'] = ~petroleum
+    for fuel, fuel_mask in fuel_masks.items():
+        state_stats = state_tables['prices'][(fuel, time_period)][state_code]
+        us_stats = state_tables['us_prices'][(fuel, time_period)]
+        prices['gas_mean'][..., fuel_mask] = state_stats[..., 0, None]
+        prices['gas_std'][..., fuel_mask] = state_stats[..., 1, None]
+        prices['us_gas_mean'][..., fuel_mask] = us_stats[0]
+        prices['us_gas_std'][..., fuel_mask] = us_stats[1]
+    return prices
+
+
+def annual_fuel_costs(vehicles, city_miles, highway_miles, prices,
+                      state_co2_g_kwh, us_co2_g_kwh):
+    '''Function to calculate annual fuel costs and CO2 emissions
+
+    Miles may be scalars or arrays that broadcast against the vehicles.
+
+    Args:
+        vehicles(dict): arrays from vehicle_arrays
+        city_miles(float or array): daily city driving miles
+        highway_miles(float or array): daily highway driving miles
+        prices(dict): gas_mean, gas_std, us_gas_mean, us_gas_std,
+            electricity_mean, electricity_std, us_electricity_mean and
+            us_electricity_std, as scalars or per vehicle arrays
+        state_co2_g_kwh(float or array): state electricity CO2 rate
+        us_co2_g_kwh(float): US electricity CO2 rate
+
+    Returns:
+        dictionary of annual_cost, annual_cost_std, us_annual_cost,
+        us_annual_cost_std, co2_state, co2_US and co2_tailpipe arrays
+    '''
+    electric = vehicles['electric']
+    plug_in_hybrid = vehicles['plug_in_hybrid']
+    co2_gpm = vehicles['co2TailpipeGpm']
+    total_miles = city_miles + highway_miles
+    # electricity consumption in kWH/mile
+    highway_E = vehicles['highwayE'] / 100
+    city_E = vehicles['cityE'] / 100
+    # gas fuel efficiency in MPG
+    highway_mpg = vehicles['highway08']
+    city_mpg = vehicles['city08']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Electric vehicles: daily electricity usage in kWH
+        ev_usage = (highway_miles * highway_E) + (city_miles * city_E)
+
+        # Plug-in hybrids: the battery is fully charged each day and fully
+        # drained before switching to gas
+        city_drive_fraction = city_miles / total_miles
+        highway_drive_fraction = 1 - city_drive_fraction
+        effective_range = (city_drive_fraction * vehicles['rangeCityA']) \
+            + (highway_drive_fraction * vehicles['rangeHwyA'])
+        effective_efficiency = (city_drive_fraction * city_E) \
+            + (highway_drive_fraction * highway_E)
+        phev_usage = effective_range * effective_efficiency
+        depleted = total_miles > effective_range
+        gas_range = np.where(depleted, total_miles - effective_range, 0)
+        effective_mpg = (city_drive_fraction * city_mpg) \
+            + (highway_drive_fraction * highway_mpg)
+        phev_gas_usage = np.where(depleted, gas_range / effective_mpg, 0)
+
+        # All other vehicles: daily gas usage in gallons
+        ice_usage = (highway_miles / highway_mpg) + (city_miles / city_mpg)
+
+        results = {}
+        for prefix in ['', 'us_']:
+            for stat, suffix in [('mean', ''), ('std', '_std')]:
+                electricity_price = prices[prefix + 'electricity_' + stat]
+                gas_price = prices[prefix + 'gas_' + stat]
+                ev_cost = ev_usage * (electricity_price / 100) * 365
+                phev_cost = ((phev_usage * electricity_price / 100)
+                             + (phev_gas_usage * gas_price)) * 365
+                ice_cost = ice_usage * 365 * gas_price
+                results[prefix + 'annual_cost' + suffix] = np.round(
+                    np.where(electric, ev_cost,
+                             np.where(plug_in_hybrid, phev_cost, ice_cost)), 2)
+
+        # CO2 emissions in kg
+        ice_co2 = np.round((co2_gpm * total_miles) / 1000 * 365)
+        phev_gas_co2 = np.where(depleted, co2_gpm * gas_range, 0)
+        for co2_rate, key in [(state_co2_g_kwh, 'co2_state'),
+                              (us_co2_g_kwh, 'co2_US')]:
+            ev_co2 = np.round(ev_usage * co2_rate / 1000 * 365)
+            phev_co2 = np.round((phev_gas_co2 + (phev_usage * co2_rate))
+                                / 1000 * 365)
+            results[key] = np.where(electric, ev_co2,
+                                    np.where(plug_in_hybrid, phev_co2, ice_co2))
+        # as in fuel_costs, tailpipe CO2 of electric vehicles and plug-in
+        # hybrids is in grams per day
+        results['co2_tailpipe'] = np.where(
+            electric, co2_gpm * total_miles,
+            np.where(plug_in_hybrid, np.round(phev_gas_co2), ice_co2))
+
+    return results
+
+
+def vehicle_fuel_costs(vehicles, state_code, city_miles, highway_miles,
+                       state_tables, time_period='3year'):
+    '''Function to calculate annual fuel costs and CO2 of many vehicles
+
+    Args:
+        vehicles(DataFrame): rows of the vehicles database
+        state_code(int or array): code of the state, an array of codes gives
+            results with a leading axis of states
+        city_miles(float or array): daily city driving miles
+        highway_miles(float or array): daily highway driving miles
+        state_tables(dict): tables from state_codes.build_state_tables
+        time_period(str): time period of the prices in state_tables
+
+    Returns:
+        dictionary of result arrays from annual_fuel_costs
+    '''
+    state_code = np.asarray(state_code)
+    arrays = vehicle_arrays(vehicles)
+    prices = fuel_price_arrays(arrays['fuelType1'], state_tables, state_code,
+                               time_period)
+    electricity_stats = \
+        state_tables['prices'][('Electricity', time_period)][state_code]
+    prices['electricity_mean'] = electricity_stats[..., 0, None]
+    prices['electricity_std'] = electricity_stats[..., 1, None]
+    (prices['us_electricity_mean'], prices['us_electricity_std']) = \
+        state_tables['us_prices'][('Electricity', time_period)]
+    return annual_fuel_costs(arrays, city_miles, highway_miles, prices,
+                             state_tables['co2_g_kwh'][state_code][..., None],
+                             state_tables['us_co2_g_kwh'])
+
+
+def row_fuel_costs(vehicles, state_code, city_miles, highway_miles,
+                   state_tables, time_period='3year'):
+    '''Function to calculate annual fuel costs and CO2 of rows of requests
+
+    Each row has its own vehicle, state and daily miles. The rows of each
+    state are calculated at once.
+
+    Args:
+        vehicles(DataFrame): vehicle of every row
+        state_code(array): code of the state of every row
+        city_miles(array): daily city driving miles of every row
+        highway_miles(array): daily highway driving miles of every row
+        state_tables(dict): tables from state_codes.build_state_tables
+        time_period(str): time period of the prices in state_tables
+
+    Returns:
+        dictionary of result arrays from annual_fuel_costs, one value a row
+    '''
+    state_code = np.asarray(state_code)
+    city_miles = np.asarray(city_miles, dtype=float)
+    highway_miles = np.asarray(highway_miles, dtype=float)
+    results = {}
+    for code in np.unique(state_code):
+        rows = np.flatnonzero(state_code == code)
+        state_results = vehicle_fuel_costs(vehicles.iloc[rows], code,
+                                           city_miles[rows],
+                                           highway_miles[rows], state_tables,
+                                           time_period)
+        for key, values in state_results.items():
+            results.setdefault(key, np.full(len(state_code), np.nan))[rows] \
+                = values
+    return results
+
+
+def effective_electric_range(vehicles, city_fraction):
+    '''Function to find the daily miles where plug-in hybrids switch to gas
+
+    The city and highway electric ranges are blended by the share of city
+    driving, as in annual_fuel_costs.
+
+    Args:
+        vehicles(dict): arrays from vehicle_arrays
+        city_fraction(float): share of the daily miles driven in the city
+
+    Returns:
+        array of the effective electric range, NaN for vehicles that are
+        not plug-in hybrids
+    '''
+    effective_range = (city_fraction * vehicles['rangeCityA']) \
+        + ((1 - city_fraction) * vehicles['rangeHwyA'])
+    return np.where(vehicles['plug_in_hybrid'], effective_range, np.nan)
+
+
+def top_k(values, k):
+    '''Function to find the k smallest values without sorting all of them
+
+    Args:
+        values(array): values to rank, NaN values are never selected
+        k(int): number of values to return
+
+    Returns:
+        positions of the k smallest values in ascending order of value
+    '''
+    candidates = np.flatnonzero(np.isfinite(values))
+    k = min(k, len(candidates))
+    if k <= 0:
+        return candidates[:0]
+    smallest = candidates[np.argpartition(values[candidates], k - 1)[:k]]
+    return smallest[np.argsort(values[smallest], kind='stable')]
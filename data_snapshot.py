@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Versioned data snapshots for the vehicle comparison dashboard.
+
+Everything the callbacks read (vehicles, prices, price statistics and CO2
+rates) is loaded into one DataSnapshot. SnapshotStore builds a new snapshot
+when the data files change and swaps it in with a single assignment, so the
+server never restarts to pick up new prices. A callback takes the current
+snapshot once when it starts and keeps using it, even if a newer one is
+swapped in before it finishes.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import os
+import threading
+import time
+import pandas as pd
+import vehicle_catalog
+import fuel_prices
+import metrics
+import result_cache
+import shared_arrays
+import state_codes
+
+
+# Custom price windows whose state tables are kept by each snapshot
+custom_windows_kept = 64
+
+
+def data_files(data_path):
+    '''Function to list the data files a snapshot is loaded from
+
+    Args:
+        data_path(str): directory holding the data files
+
+    Returns:
+        list of file paths
+    '''
+    return [os.path.join(data_path, i) for i in
+            [vehicle_catalog.snapshot_file, vehicle_catalog.csv_file,
+             'petrol_prices.csv', 'manifest.json', 'state_electricity.csv',
+             'us_electricity.csv', 'egrid_co2_all.csv']]
+
+
+class DataSnapshot:
+    '''One version of all of the data used by the dashboard
+
+    Snapshots are never changed after they are built. Values the app derives
+    from the data, such as the default comparison, are kept in derived.
+
+    Args:
+        version(str): data version from result_cache.data_version
+        cars(DataFrame): cleaned vehicles database
+        petrol_prices(DataFrame): weekly petroleum prices
+        electricity_prices(DataFrame): monthly state electricity prices
+        us_elec(DataFrame): monthly US electricity prices
+        state_co2(DataFrame): state and US electricity CO2 rates
+        price_stats(dict): price statistics, built from the prices if None
+    '''
+
+    def __init__(self, version, cars, petrol_prices, electricity_prices,
+                 us_elec, state_co2, price_stats=None):
+        self.version = version
+        self.loaded = time.time()
+        self.cars = cars
+        # row of each fueleconomy.gov vehicle id, the first of an id listed
+        # twice
+        self.vehicle_rows = pd.Series(cars.index, index=cars['id'].to_numpy())
+        self.vehicle_rows = self.vehicle_rows[
+            ~self.vehicle_rows.index.duplicated()]
+        # dropdown options for each year, make and model
+        self.catalog_index = vehicle_catalog.build_catalog_index(cars)
+        self.petrol_prices = petrol_prices
+        self.electricity_prices = electricity_prices
+        self.us_elec = us_elec
+        self.state_co2 = state_co2
+        # prefix sums of every fuel price series, for custom windows
+        self.price_index = fuel_prices.build_price_index(
+            petrol_prices, electricity_prices, us_elec)
+        # average fuel prices of every fuel and area
+        if price_stats is None:
+            price_stats = fuel_prices.index_statistics(self.price_index)
+        self.price_stats = price_stats
+        # prices and CO2 rates of every state, indexed by state code
+        self.state_tables = state_codes.build_state_tables(state_co2,
+                                                           price_stats)
+        # state tables of the custom windows used recently
+        self.window_tables = result_cache.LRUCache(custom_windows_kept)
+        self.derived = {}
+
+    def period_tables(self, time_period):
+        '''Function to return the state tables holding a time period's prices
+
+        Args:
+            time_period(str): key of fuel_prices.time_periods or a custom
+                period from fuel_prices.custom_period
+
+        Returns:
+            dictionary of tables from state_codes.build_state_tables
+
+        Raises:
+            ValueError: if the time period is not valid
+        '''
+        if time_period in fuel_prices.time_periods:
+            return self.state_tables
+        tables = self.window_tables.get(time_period)
+        if tables is None:
+            tables = state_codes.build_state_tables(
+                self.state_co2, fuel_prices.index_statistics(
+                    self.price_index, time_period), [time_period])
+            self.window_tables.put(time_period, tables)
+        return tables
+
+
+def load_snapshot(data_path, shared_path=None):
+    '''Function to load the data files into a new snapshot
+
+    The version is read before the files so a file that changes while it is
+    being loaded is picked up by the next reload.
+
+    With a shared_path, the numeric vehicle columns and the price statistics
+    are mapped from the arrays published there for this version, and
+    published first if no other process has done so.
+
+    Args:
+        data_path(str): directory holding the data files
+        shared_path(str): folder of the shared arrays, not shared if None
+
+    Returns:
+        DataSnapshot
+    '''
+    version = result_cache.data_version(data_files(data_path))
+    arrays = shared_arrays.attach(shared_path, version) if shared_path \
+        else None
+
+    # vehicles database, from the prebuilt snapshot when available
+    if arrays:
+        # only the text columns, the numeric ones are mapped
+        cars = vehicle_catalog.load_catalog(data_path, [
+            i for i in vehicle_catalog.catalog_columns
+            + vehicle_catalog.derived_columns if i not in arrays])
+    else:
+        cars = vehicle_catalog.load_catalog(data_path)
+    # gas and diesel prices
+    petrol_prices = fuel_prices.read_petrol_prices(data_path)
+    # Electricity prices
+    electricity_prices = pd.read_csv(os.path.join(data_path,
+                                                  'state_electricity.csv'),
+                                     index_col=0, parse_dates=['period'])
+    us_elec = pd.read_csv(os.path.join(data_path, 'us_electricity.csv'),
+                          index_col=0, parse_dates=['period'])
+    # state and US annual CO2 emissions
+    state_co2 = pd.read_csv(os.path.join(data_path, 'egrid_co2_all.csv'),
+                            index_col=0)
+
+    # Add column of full state name to electricity_prices and state_co2
+    electricity_prices['state_name'] = \
+        electricity_prices['State'].map(state_codes.states)
+    state_co2['state_name'] = state_co2['state'].map(state_codes.states)
+
+    if not shared_path:
+        return DataSnapshot(version, cars, petrol_prices, electricity_prices,
+                            us_elec, state_co2)
+    if not arrays:
+        price_stats = fuel_prices.build_price_statistics(
+            petrol_prices, electricity_prices, us_elec)
+        shared_arrays.publish(cars, price_stats, shared_path, version)
+        arrays = shared_arrays.attach(shared_path, version)
+    cars = shared_arrays.shared_frame(cars, arrays,
+                                      vehicle_catalog.catalog_columns
+                                      + vehicle_catalog.derived_columns)
+    return DataSnapshot(version, cars, petrol_prices, electricity_prices,
+                        us_elec, state_co2,
+                        shared_arrays.shared_price_stats(arrays))
+
+
+class SnapshotStore:
+    '''Holder of the current data snapshot that reloads it when data changes
+
+    The first snapshot is loaded when the store is created, or in a
+    background thread with background set, in which case current() waits for
+    it.
+
+    Args:
+        data_path(str): directory holding the data files
+        prepare(function): called with each new snapshot before it is
+            swapped in, to fill in its derived values
+        on_swap(list): functions called with the new snapshot after a swap
+        shared_path(str): folder of the arrays shared by the workers, not
+            shared if None
+        background(bool): load the first snapshot in a background thread
+    '''
+
+    def __init__(self, data_path, prepare=None, on_swap=None,
+                 shared_path=None, background=False):
+        self.data_path = data_path
+        self.shared_path = shared_path
+        self.prepare = prepare
+        self.on_swap = list(on_swap or [])
+        self.reloads = 0
+        self.last_error = None
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._snapshot = None
+        self._loaded = threading.Event()
+        if background:
+            threading.Thread(target=self._first_load, daemon=True).start()
+        else:
+            self._snapshot = self._build()
+            self._loaded.set()
+
+    def _first_load(self):
+        with self._reload_lock:
+            try:
+                self._snapshot = self._build()
+            except Exception as error:
+                # a later reload can still load the data
+                self.last_error = repr(error)
+        self._loaded.set()
+
+    def _build(self):
+        start = time.perf_counter()
+        snapshot = load_snapshot(self.data_path, self.shared_path)
+        if self.prepare is not None:
+            self.prepare(snapshot)
+        metrics.observe('data_snapshot_load_seconds',
+                        'Time to load and prepare a data snapshot',
+                        time.perf_counter() - start)
+        return snapshot
+
+    def current(self, timeout=None):
+        '''Function to return the current snapshot
+
+        Waits for the first snapshot if it is loading in the background.
+
+        Args:
+            timeout(float): seconds to wait, forever if None
+
+        Returns:
+            DataSnapshot
+        '''
+        if self._snapshot is None:
+            self._loaded.wait(timeout)
+            if self._snapshot is None:
+                raise RuntimeError('The data is not loaded: '
+                                   f'{self.last_error or "timed out"}')
+        return self._snapshot
+
+    def ready(self):
+        '''Function to check if a snapshot has been loaded'''
+        return self._snapshot is not None
+
+    def changed(self):
+        '''Function to check if the data files differ from the snapshot'''
+        return self._snapshot is None or \
+            result_cache.data_version(data_files(self.data_path)) \
+            != self._snapshot.version
+
+    def reload(self, force=False):
+        '''Function to build a new snapshot and swap it in
+
+        Only one reload runs at a time, a reload requested while another is
+        running returns at once.
+
+        Args:
+            force(bool): reload even if the data files have not changed
+
+        Returns:
+            True if a new snapshot was swapped in
+        '''
+        if not self._reload_lock.acquire(blocking=False):
+            return False
+        try:
+            if not force and not self.changed():
+                return False
+            snapshot = self._build()
+            # a single assignment, requests see the old or the new snapshot
+            self._snapshot = snapshot
+            self.reloads += 1
+            self.last_error = None
+        except Exception as error:
+            # keep serving the old snapshot if the new data can not be loaded
+            self.last_error = repr(error)
+            return False
+        finally:
+            self._reload_lock.release()
+        for function in self.on_swap:
+            function(snapshot)
+        return True
+
+    def reload_in_background(self, force=False):
+        '''Function to reload the snapshot in a background thread
+
+        Returns:
+            the started thread
+        '''
+        thread = threading.Thread(target=self.reload, args=(force,),
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def watch(self, interval=60):
+        '''Function to reload whenever the data files change
+
+        Starts a background thread that checks the data version every
+        interval seconds.
+
+        Args:
+            interval(float): seconds between checks
+        '''
+        if self._watcher is not None:
+            return
+
+        def check():
+            while True:
+                time.sleep(interval)
+                self.reload()
+
+        self._watcher = threading.Thread(target=check, daemon=True)
+        self._watcher.start()
+
+    def status(self):
+        '''Function to return the version and reload state of the store'''
+        snapshot = self._snapshot
+        return {'ready': snapshot is not None,
+                'version': snapshot.version if snapshot else None,
+                'loaded': snapshot.loaded if snapshot else None,
+                'reloads': self.reloads,
+                'reloading': self._reload_lock.locked(),
+                'last_error': self.last_error}
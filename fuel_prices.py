@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fuel price statistics for the vehicle comparison dashboard.
+
+The average and standard deviation of every fuel price series only change
+when the price data is refreshed, so they are computed once for every
+(fuel, area, time period) and looked up when calculating fuel costs.
+
+Each series keeps prefix sums of its prices and squared prices, so the mean
+and standard deviation of any window of it take the same time to compute
+however many prices the window holds. Windows of a number of years are
+counted in the cadence of the series, weekly petroleum prices or monthly
+electricity prices. Custom windows between two dates are time periods named
+'YYYY-MM-DD:YYYY-MM-DD', computed from the series when they are first used.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+# EIA petroleum product names for each fueleconomy.gov fuelType1
+petroleum_products = {'Regular Gasoline': 'Conventional Regular Gasoline',
+                      'Premium Gasoline': 'Conventional Premium Gasoline',
+                      'Midgrade Gasoline': 'Gasoline Conventional Midgrade',
+                      'Diesel': 'No 2 Diesel'}
+
+# Folder of yearly petroleum price files written by ingest.py
+petrol_partitions = 'petrol_prices'
+
+# Years of the most recent prices averaged for each time period
+time_periods = {'1year': 1, '3year': 3, '5year': 5}
+
+# Prices per year of weekly and monthly series
+cadences = {'weekly': 52, 'monthly': 12}
+
+
+def read_petrol_prices(data_path):
+    '''Function to read the weekly petroleum prices
+
+    Reads the yearly partition files written by ingest.py, or the single
+    petrol_prices.csv file if the prices have not been partitioned yet.
+
+    Args:
+        data_path(str): directory holding the data files
+
+    Returns:
+        DataFrame of petroleum prices with a price column
+    '''
+    partition_files = sorted(glob.glob(os.path.join(data_path,
+                                                    petrol_partitions,
+                                                    '*.csv')))
+    if partition_files:
+        petrol_prices = pd.concat([pd.read_csv(i, parse_dates=['period'])
+                                   for i in partition_files],
+                                  ignore_index=True)
+    else:
+        petrol_prices = pd.read_csv(os.path.join(data_path,
+                                                 'petrol_prices.csv'),
+                                    index_col=0, parse_dates=['period'])
+    return petrol_prices.rename(columns={'value': 'price'})
+
+
+def series_cadence(periods):
+    '''Function to tell if a price series is weekly or monthly
+
+    Args:
+        periods(array): sorted dates of the prices
+
+    Returns:
+        'weekly' or 'monthly'
+    '''
+    if len(periods) < 2:
+        return 'monthly'
+    spacing = np.median(np.diff(periods) / np.timedelta64(1, 'D'))
+    return 'weekly' if spacing < 15 else 'monthly'
+
+
+def build_price_series(price_df):
+    '''Function to index a price series for window statistics
+
+    Missing prices are skipped, as pandas does. Prices are centred on their
+    average before summing so the squared sums keep their precision.
+
+    Args:
+        price_df(DataFrame): prices with period and price columns
+
+    Returns:
+        dictionary of the sorted periods, prefix counts, sums and squared
+        sums of the prices, the centring shift and the cadence
+    '''
+    price_df = price_df.sort_values(by='period')
+    periods = price_df['period'].to_numpy(dtype='datetime64[ns]')
+    prices = price_df['price'].to_numpy(dtype=float)
+    valid = ~np.isnan(prices)
+    shift = prices[valid].mean() if valid.any() else 0.0
+    centred = np.where(valid, prices - shift, 0.0)
+    return {'period': periods,
+            'count': np.concatenate([[0], np.cumsum(valid)]),
+            'total': np.concatenate([[0.0], np.cumsum(centred)]),
+            'total_sq': np.concatenate([[0.0], np.cumsum(centred ** 2)]),
+            'shift': shift,
+            'cadence': series_cadence(periods)}
+
+
+def range_statistics(series, start, stop):
+    '''Function to return the statistics of the prices in rows start:stop
+
+    Args:
+        series(dict): series from build_price_series
+        start(int): first row
+        stop(int): row after the last row
+
+    Returns:
+        tuple of the rounded mean and standard deviation of the prices
+    '''
+    count = series['count'][stop] - series['count'][start]
+    if count == 0:
+        return np.nan, np.nan
+    total = series['total'][stop] - series['total'][start]
+    mean = total / count + series['shift']
+    if count < 2:
+        return round(mean, 2), np.nan
+    squares = series['total_sq'][stop] - series['total_sq'][start] \
+        - total * total / count
+    return round(mean, 2), round(np.sqrt(max(squares, 0) / (count - 1)), 2)
+
+
+def window_statistics(series, time_period='3year'):
+    '''Function to return the statistics of the most recent prices
+
+    Args:
+        series(dict): series from build_price_series
+        time_period(str): key of time_periods
+
+    Returns:
+        tuple of the rounded mean and standard deviation of the prices
+    '''
+    stop = len(series['period'])
+    rows = time_periods[time_period] * cadences[series['cadence']]
+    return range_statistics(series, max(stop - rows, 0), stop)
+
+
+def date_window_rows(series, start_date, end_date):
+    '''Function to find the rows of the prices between two dates
+
+    Args:
+        series(dict): series from build_price_series
+        start_date(str or datetime): first date, included
+        end_date(str or datetime): last date, included
+
+    Returns:
+        tuple of the first row and the row after the last row
+    '''
+    start = np.searchsorted(series['period'],
+                            np.datetime64(pd.Timestamp(start_date)), 'left')
+    stop = np.searchsorted(series['period'],
+                           np.datetime64(pd.Timestamp(end_date)), 'right')
+    return start, max(start, stop)
+
+
+def date_window_statistics(series, start_date, end_date):
+    '''Function to return the statistics of the prices between two dates
+
+    Args:
+        series(dict): series from build_price_series
+        start_date(str or datetime): first date, included
+        end_date(str or datetime): last date, included
+
+    Returns:
+        tuple of the rounded mean and standard deviation of the prices
+    '''
+    return range_statistics(series, *date_window_rows(series, start_date,
+                                                      end_date))
+
+
+def custom_period(start_date, end_date):
+    '''Function to name the custom time period between two dates
+
+    Args:
+        start_date(str or datetime): first date, included
+        end_date(str or datetime): last date, included
+
+    Returns:
+        time period 'YYYY-MM-DD:YYYY-MM-DD'
+    '''
+    return f'{pd.Timestamp(start_date):%Y-%m-%d}:' \
+        f'{pd.Timestamp(end_date):%Y-%m-%d}'
+
+
+def period_dates(time_period):
+    '''Function to return the dates of a custom time period
+
+    Args:
+        time_period(str): key of time_periods or a custom period
+
+    Returns:
+        tuple of the first and last date, None for a key of time_periods
+
+    Raises:
+        ValueError: if the time period is neither
+    '''
+    if not isinstance(time_period, str):
+        raise ValueError(f'unknown time period {time_period!r}')
+    if time_period in time_periods:
+        return None
+    dates = time_period.split(':')
+    if len(dates) != 2:
+        raise ValueError(f'unknown time period {time_period!r}')
+    try:
+        start_date, end_date = [pd.Timestamp(i) for i in dates]
+    except ValueError:
+        raise ValueError(f'unknown time period {time_period!r}') from None
+    if start_date > end_date:
+        raise ValueError(f'time period {time_period!r} ends before it starts')
+    return start_date, end_date
+
+
+def missing_prices(price_index, time_period):
+    '''Function to find the fuels with no national prices in a time period
+
+    A custom window outside the dates of the data would give no costs for
+    the vehicles using those fuels.
+
+    Args:
+        price_index(dict): series from build_price_index
+        time_period(str): key of time_periods or a custom period
+
+    Returns:
+        list of the fuel types with no U.S. prices in the period, empty for
+        a key of time_periods
+    '''
+    dates = period_dates(time_period)
+    if dates is None:
+        return []
+    national = [(fuel_type, 'U.S.') for fuel_type in petroleum_products] \
+        + [('Electricity', 'US')]
+    missing = []
+    for fuel_type, area in national:
+        series = price_index.get((fuel_type, area))
+        if series is None:
+            continue
+        start, stop = date_window_rows(series, *dates)
+        if series['count'][stop] == series['count'][start]:
+            missing.append(fuel_type)
+    return missing
+
+
+def build_price_index(petrol_prices, electricity_prices, us_elec):
+    '''Function to index every fuel price series
+
+    Petroleum prices are keyed by PADD region or 'U.S.' and electricity
+    prices by state name or 'US'.
+
+    Args:
+        petrol_prices(DataFrame): weekly EIA petroleum prices
+        electricity_prices(DataFrame): monthly state electricity prices
+        us_elec(DataFrame): monthly US electricity prices
+
+    Returns:
+        dictionary of series from build_price_series keyed by
+        (fuel type, area)
+    '''
+    price_index = {}
+    for fuel_type, product_name in petroleum_products.items():
+        product_prices = petrol_prices[petrol_prices['product-name']
+                                       == product_name]
+        for area, area_prices in product_prices.groupby('area-name'):
+            price_index[(fuel_type, area)] = build_price_series(area_prices)
+
+    for state, state_prices in electricity_prices.groupby('state_name'):
+        price_index[('Electricity', state)] = build_price_series(state_prices)
+    price_index[('Electricity', 'US')] = build_price_series(us_elec)
+    return price_index
+
+
+def build_price_statistics(petrol_prices, electricity_prices, us_elec):
+    '''Function to compute the statistics of every fuel price series
+
+    Run again whenever the prices are refreshed.
+
+    Args:
+        petrol_prices(DataFrame): weekly EIA petroleum prices
+        electricity_prices(DataFrame): monthly state electricity prices
+        us_elec(DataFrame): monthly US electricity prices
+
+    Returns:
+        dictionary of (mean, std) keyed by (fuel type, area, time period)
+    '''
+    return index_statistics(build_price_index(petrol_prices,
+                                              electricity_prices, us_elec))
+
+
+def index_statistics(price_index, time_period=None):
+    '''Function to compute the statistics of every series of a price index
+
+    Args:
+        price_index(dict): series from build_price_index
+        time_period(str): key of time_periods or a custom period, every key
+            of time_periods if None
+
+    Returns:
+        dictionary of (mean, std) keyed by (fuel type, area, time period)
+    '''
+    if time_period is None:
+        return {(fuel_type, area, time_period):
+                window_statistics(series, time_period)
+                for (fuel_type, area), series in price_index.items()
+                for time_period in time_periods.keys()}
+    dates = period_dates(time_period)
+    if dates is None:
+        return {(fuel_type, area, time_period):
+                window_statistics(series, time_period)
+                for (fuel_type, area), series in price_index.items()}
+    return {(fuel_type, area, time_period):
+            date_window_statistics(series, *dates)
+            for (fuel_type, area), series in price_index.items()}
+
+
+def lookup_statistics(price_stats, fuel_type, area, time_period='3year'):
+    '''Function to look up the statistics of a fuel price series
+
+    Args:
+        price_stats(dict): statistics from build_price_statistics
+        fuel_type(str): fuelType1 of a vehicle or 'Electricity'
+        area(str): PADD region, state name, 'U.S.' or 'US'
+        time_period(str): key of time_periods or a custom period
+
+    Returns:
+        tuple of the mean and standard deviation, NaN if there are no prices
+    '''
+    return price_stats.get((fuel_type, area, time_period), (np.nan, np.nan))
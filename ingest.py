@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental refresh of the data used by the vehicle comparison dashboard.
+
+Replaces the refresh steps of Dash_Data.ipynb:
+
+    EIA_API_KEY=... python ingest.py /path/to/data/
+
+Weekly petroleum prices are kept in one csv file per year under
+data/petrol_prices/. Only weeks after the watermark in data/manifest.json
+are requested from the EIA API, new rows are de-duplicated on
+(period, product, duoarea) and only the yearly files that received rows are
+rewritten. The electricity workbook, the eGRID workbook and the
+fueleconomy.gov vehicles file are downloaded, and only parsed again when
+their content hash differs from the one recorded in the manifest.
+
+The EIA pages and the source files are fetched concurrently over one pooled
+session, with timeouts, retries with backoff and conditional requests
+(ETag / If-Modified-Since), and the changed files are parsed in parallel
+worker processes.
+
+All urls are arguments so the refresh can be run against a local server.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import hashlib
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from datetime import datetime, timedelta
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fuel_prices
+import vehicle_catalog
+
+eia_petroleum_url = 'https://api.eia.gov/v2/petroleum/pri/gnd/data/'
+eia_electricity_url = \
+    'https://www.eia.gov/electricity/data/eia861m/xls/sales_revenue.xlsx'
+vehicles_url = 'https://www.fueleconomy.gov/feg/epadata/vehicles.csv'
+
+# EIA products and areas of the weekly retail petroleum prices
+petroleum_facets = {'product': ['EPD2D', 'EPMMU', 'EPMPU', 'EPMRU'],
+                    'duoarea': ['NUS', 'R10', 'R1X', 'R1Y', 'R1Z', 'R20',
+                                'R30', 'R40', 'R50', 'R5XCA', 'SCA', 'SCO',
+                                'SFL', 'SMN', 'SNY', 'SOH', 'STX', 'SWA']}
+petroleum_keys = ['period', 'product', 'duoarea']
+# largest number of rows the EIA API returns per request
+eia_page_length = 5000
+
+manifest_file = 'manifest.json'
+sources_folder = 'sources'
+
+# Seconds to wait for a connection and between bytes of a response
+request_timeout = (10, 120)
+
+# Failed requests are retried after 0, 2, 4, 8... seconds
+retry_total = 5
+retry_backoff = 1
+retry_statuses = [429, 500, 502, 503, 504]
+
+# Concurrent downloads and parsing processes
+max_workers = 4
+
+# Conversion from lb/MWh to g/kWh
+lb_mwh_to_g_kwh = 453.59 / 1000
+
+
+def read_manifest(data_path):
+    '''Function to read the refresh manifest
+
+    Args:
+        data_path(str): directory holding the data files
+
+    Returns:
+        dictionary with the petroleum watermark and source file hashes
+    '''
+    manifest_path = os.path.join(data_path, manifest_file)
+    if not os.path.exists(manifest_path):
+        return {'petroleum': {}, 'sources': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(data_path, manifest):
+    '''Function to save the refresh manifest, replacing the old one at once'''
+    manifest_path = os.path.join(data_path, manifest_file)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def file_hash(file_path):
+    '''Function to return the sha256 hash of a file's content'''
+    content_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def partition_path(data_path, year):
+    '''Function to return the petroleum price file of a year'''
+    return os.path.join(data_path, fuel_prices.petrol_partitions,
+                        f'{year}.csv')
+
+
+def write_partitions(data_path, new_prices):
+    '''Function to add petroleum prices to the yearly partition files
+
+    Only the years that receive prices are read and rewritten. Rows with the
+    same period, product and area are replaced by the newest one.
+
+    Args:
+        data_path(str): directory holding the data files
+        new_prices(DataFrame): petroleum prices with a value column
+
+    Returns:
+        dictionary of the number of rows in each rewritten partition
+    '''
+    os.makedirs(os.path.join(data_path, fuel_prices.petrol_partitions),
+                exist_ok=True)
+    new_prices = new_prices.copy()
+    new_prices['period'] = pd.to_datetime(new_prices['period'])
+    new_prices['value'] = pd.to_numeric(new_prices['value'], errors='coerce')
+
+    partition_rows = {}
+    for year, year_prices in new_prices.groupby(new_prices['period'].dt.year):
+        year_path = partition_path(data_path, year)
+        if os.path.exists(year_path):
+            year_prices = pd.concat([pd.read_csv(year_path,
+                                                 parse_dates=['period']),
+                                     year_prices], ignore_index=True)
+        year_prices = year_prices.drop_duplicates(subset=petroleum_keys,
+                                                  keep='last')
+        year_prices = year_prices.sort_values(by=petroleum_keys)
+        year_prices.to_csv(year_path + '.tmp', index=False)
+        os.replace(year_path + '.tmp', year_path)
+        partition_rows[str(year)] = len(year_prices)
+    return partition_rows
+
+
+def partition_petrol_csv(data_path, manifest):
+    '''Function to split an existing petrol_prices.csv into yearly files
+
+    Args:
+        data_path(str): directory holding the data files
+        manifest(dict): refresh manifest, updated in place
+    '''
+    petrol_prices = pd.read_csv(os.path.join(data_path, 'petrol_prices.csv'),
+                                index_col=0)
+    update_petroleum_manifest(manifest,
+                              write_partitions(data_path, petrol_prices),
+                              petrol_prices['period'])
+
+
+def update_petroleum_manifest(manifest, partition_rows, periods):
+    '''Function to record new partitions and move the watermark forward'''
+    petroleum = manifest.setdefault('petroleum', {})
+    petroleum.setdefault('partitions', {}).update(partition_rows)
+    if len(periods):
+        latest = pd.to_datetime(periods).max().strftime('%Y-%m-%d')
+        petroleum['watermark'] = max(latest,
+                                     petroleum.get('watermark', latest))
+
+
+def make_session(pool_size=max_workers):
+    '''Function to create a pooled requests session that retries failures
+
+    Args:
+        pool_size(int): connections kept open to each host
+
+    Returns:
+        requests Session
+    '''
+    retry = Retry(total=retry_total, backoff_factor=retry_backoff,
+                  status_forcelist=retry_statuses, allowed_methods=['GET'],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_petroleum_page(session, url, params, offset):
+    '''Function to request one page of the EIA petroleum prices'''
+    r = session.get(url, params=params + [('offset', offset)],
+                    timeout=request_timeout)
+    r.raise_for_status()
+    return r.json()['response']
+
+
+def fetch_petroleum(session, api_key, start_date, end_date,
+                    url=eia_petroleum_url, executor=None):
+    '''Function to request weekly petroleum prices from the EIA v2 API
+
+    The first page gives the number of rows, the remaining pages are
+    requested concurrently when an executor is given.
+
+    Args:
+        session(Session): requests session
+        api_key(str): EIA API key
+        start_date(str): first date, YYYY-MM-DD
+        end_date(str): last date, YYYY-MM-DD
+        url(str): EIA petroleum prices url
+        executor(Executor): thread pool for the remaining pages, not the
+            pool this function runs in
+
+    Returns:
+        DataFrame of the prices, one row per period, product and area
+    '''
+    params = [('api_key', api_key), ('frequency', 'weekly'),
+              ('data[0]', 'value'), ('start', start_date), ('end', end_date),
+              ('sort[0][column]', 'period'), ('sort[0][direction]', 'desc'),
+              ('length', eia_page_length)]
+    for facet, values in petroleum_facets.items():
+        params += [(f'facets[{facet}][]', i) for i in values]
+
+    first_page = fetch_petroleum_page(session, url, params, 0)
+    rows = list(first_page['data'])
+    # the API may return fewer rows per page than requested
+    page_length = len(rows)
+    if page_length:
+        offsets = range(page_length, int(first_page.get('total', 0)),
+                        page_length)
+        fetch_page = lambda offset: fetch_petroleum_page(session, url,
+                                                         params, offset)
+        pages = executor.map(fetch_page, offsets) if executor \
+            else map(fetch_page, offsets)
+        for page in pages:
+            rows += page['data']
+    return pd.DataFrame(rows)
+
+
+def refresh_petroleum(data_path, manifest, session, api_key, today=None,
+                      url=eia_petroleum_url, executor=None):
+    '''Function to add the petroleum prices published since the watermark
+
+    Args:
+        data_path(str): directory holding the data files
+        manifest(dict): refresh manifest, updated in place
+        session(Session): requests session
+        api_key(str): EIA API key
+        today(datetime): last date to request, now by default
+        url(str): EIA petroleum prices url
+        executor(Executor): thread pool for the pages of the request
+
+    Returns:
+        number of new price rows
+    '''
+    if 'watermark' not in manifest.get('petroleum', {}) \
+        and os.path.exists(os.path.join(data_path, 'petrol_prices.csv')):
+        partition_petrol_csv(data_path, manifest)
+
+    watermark = manifest.get('petroleum', {}).get('watermark')
+    if watermark:
+        start_date = (datetime.strptime(watermark, '%Y-%m-%d')
+                      + timedelta(days=1)).strftime('%Y-%m-%d')
+    else:
+        start_date = '1990-01-01'
+    end_date = (today or datetime.now()).strftime('%Y-%m-%d')
+    if start_date > end_date:
+        return 0
+
+    new_prices = fetch_petroleum(session, api_key, start_date, end_date, url,
+                                 executor)
+    if new_prices.empty:
+        return 0
+    update_petroleum_manifest(manifest,
+                              write_partitions(data_path, new_prices),
+                              new_prices['period'])
+    return len(new_prices)
+
+
+def download(session, url, file_path, validators=None):
+    '''Function to stream a file to disk if it changed since the last refresh
+
+    Args:
+        session(Session): requests session
+        url(str): file url
+        file_path(str): file to write
+        validators(dict): etag and last_modified of the previous download
+
+    Returns:
+        dictionary of the etag and last_modified of the download, None if the
+        server reports the file has not been modified
+    '''
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    with session.get(url, headers=headers, stream=True,
+                     timeout=request_timeout) as r:
+        if r.status_code == 304:
+            return None
+        r.raise_for_status()
+        with open(file_path + '.tmp', 'wb') as f:
+            for block in r.iter_content(1 << 20):
+                f.write(block)
+        validators = {'etag': r.headers.get('ETag'),
+                      'last_modified': r.headers.get('Last-Modified')}
+    os.replace(file_path + '.tmp', file_path)
+    return validators
+
+
+def source_hash(manifest, file_path):
+    '''Function to check a source file against the hash in the manifest
+
+    Args:
+        manifest(dict): refresh manifest
+        file_path(str): downloaded source file
+
+    Returns:
+        the new content hash, None if the file has not changed
+    '''
+    content_hash = file_hash(file_path)
+    if manifest.get('sources', {}).get(os.path.basename(file_path)) \
+        == content_hash:
+        return None
+    return content_hash
+
+
+def record_source(manifest, file_path, content_hash=None, validators=None):
+    '''Function to record the hash and validators of a parsed source file'''
+    file_name = os.path.basename(file_path)
+    if content_hash:
+        manifest.setdefault('sources', {})[file_name] = content_hash
+    if validators:
+        manifest.setdefault('validators', {})[file_name] = validators
+
+
+def parse_electricity(data_path, workbook_path):
+    '''Function to save the monthly state and US electricity prices
+
+    Args:
+        data_path(str): directory holding the data files
+        workbook_path(str): EIA-861M sales_revenue.xlsx file
+    '''
+    # Monthly residential electricity prices in Cents/kWh
+    electricity_prices = pd.read_excel(workbook_path,
+                                       sheet_name='Monthly-States',
+                                       usecols='A:D, H', skiprows=2,
+                                       skipfooter=1)
+    electricity_prices.insert(0, 'period', pd.to_datetime(
+        {'year': electricity_prices['Year'],
+         'month': electricity_prices['Month'], 'day': 1}))
+    electricity_prices = electricity_prices.drop(['Year', 'Month'], axis=1)
+    electricity_prices = electricity_prices.rename(
+        columns={'Cents/kWh': 'price'})
+
+    us_elec = pd.read_excel(workbook_path, sheet_name='US-YTD',
+                            usecols='A:C, G', skiprows=2, skipfooter=1)
+    us_elec = us_elec.rename(columns={'Cents/kWh': 'price'})
+    # Remove yearly average
+    us_elec = us_elec[us_elec['MONTH'] != '.']
+    us_elec['period'] = pd.to_datetime({'year': us_elec['Year'],
+                                        'month': us_elec['MONTH'], 'day': 1})
+    us_elec = us_elec.drop(['Year', 'MONTH'], axis=1)
+
+    electricity_prices.to_csv(os.path.join(data_path, 'state_electricity.csv'))
+    us_elec.to_csv(os.path.join(data_path, 'us_electricity.csv'))
+
+
+def parse_egrid(data_path, workbook_path, year_suffix='20'):
+    '''Function to save the state and US CO2 emission rates of electricity
+
+    Args:
+        data_path(str): directory holding the data files
+        workbook_path(str): eGRID data workbook
+        year_suffix(str): last two digits of the eGRID year in sheet names
+    '''
+    state_column = 'State annual CO2 equivalent total output emission rate ' \
+        '(lb/MWh)'
+    us_column = 'U.S. annual CO2 equivalent total output emission rate ' \
+        '(lb/MWh)'
+
+    # State annual CO2 emissions in lb/MWh
+    state_co2 = pd.read_excel(workbook_path, sheet_name='ST' + year_suffix,
+                              usecols=['State abbreviation', state_column])
+    state_co2 = state_co2.drop(labels=0)
+    state_co2 = state_co2.rename(columns={'State abbreviation': 'state',
+                                          state_column: 'co2_lb/MWh'})
+    state_co2['co2_g/kWh'] = state_co2['co2_lb/MWh'] * lb_mwh_to_g_kwh
+
+    # US annual CO2 emissions in lb/MWh
+    us_co2 = pd.read_excel(workbook_path, sheet_name='US' + year_suffix,
+                           usecols=[us_column])[us_column].iloc[1]
+    us_co2_all = pd.DataFrame({'state': 'US', 'co2_lb/MWh': us_co2,
+                               'co2_g/kWh': us_co2 * lb_mwh_to_g_kwh,
+                               'state_name': 'US'}, index=[53])
+    state_co2 = pd.concat([state_co2, us_co2_all])
+    state_co2.to_csv(os.path.join(data_path, 'egrid_co2_all.csv'))
+
+
+def parse_vehicles(data_path, vehicles_path):
+    '''Function to install a new vehicles file and rebuild the snapshot
+
+    Args:
+        data_path(str): directory holding the data files
+        vehicles_path(str): downloaded fueleconomy.gov vehicles csv file
+    '''
+    # the dashboard reads the csv file as downloaded
+    csv_path = os.path.join(data_path, vehicle_catalog.csv_file)
+    shutil.copyfile(vehicles_path, csv_path + '.tmp')
+    os.replace(csv_path + '.tmp', csv_path)
+    vehicle_catalog.build_snapshot(data_path)
+
+
+def source_files(data_path, egrid_path=None,
+                 electricity_url=eia_electricity_url,
+                 vehicles_url=vehicles_url):
+    '''Function to list the source files of a refresh
+
+    Args:
+        data_path(str): directory holding the data files
+        egrid_path(str): eGRID workbook path or url, skipped if None
+        electricity_url(str): EIA-861M workbook url
+        vehicles_url(str): fueleconomy.gov vehicles csv url
+
+    Returns:
+        list of (url, local path, parse function), url is None for files
+        that are already on disk
+    '''
+    sources_path = os.path.join(data_path, sources_folder)
+    sources = [(electricity_url,
+                os.path.join(sources_path, 'sales_revenue.xlsx'),
+                parse_electricity),
+               (vehicles_url, os.path.join(sources_path, 'vehicles.csv'),
+                parse_vehicles)]
+    if egrid_path and egrid_path.startswith(('http://', 'https://')):
+        sources.append((egrid_path,
+                        os.path.join(sources_path,
+                                     os.path.basename(egrid_path)),
+                        parse_egrid))
+    elif egrid_path:
+        sources.append((None, egrid_path, parse_egrid))
+    return sources
+
+
+def refresh_sources(data_path, manifest, session, sources, threads,
+                    processes):
+    '''Function to download the source files and parse the changed ones
+
+    Every download runs in the thread pool. As each one finishes, a file
+    whose content hash changed is parsed in the process pool.
+
+    Args:
+        data_path(str): directory holding the data files
+        manifest(dict): refresh manifest, updated in place
+        session(Session): requests session
+        sources(list): sources from source_files
+        threads(Executor): thread pool for the downloads
+        processes(Executor): process pool for the parsing
+
+    Returns:
+        list of the source files that were parsed
+    '''
+    os.makedirs(os.path.join(data_path, sources_folder), exist_ok=True)
+    validators = manifest.get('validators', {})
+
+    downloads = {}
+    for url, file_path, parse in sources:
+        if url:
+            future = threads.submit(download, session, url, file_path,
+                                    validators.get(os.path.basename(
+                                        file_path)))
+        else:
+            future = threads.submit(lambda: {})
+        downloads[future] = (file_path, parse)
+
+    parses = {}
+    for future in as_completed(downloads):
+        file_path, parse = downloads[future]
+        file_validators = future.result()
+        if file_validators is None:
+            continue
+        content_hash = source_hash(manifest, file_path)
+        if content_hash:
+            parses[processes.submit(parse, data_path, file_path)] = \
+                (file_path, content_hash, file_validators)
+        else:
+            record_source(manifest, file_path, validators=file_validators)
+
+    parsed = []
+    for future in as_completed(parses):
+        future.result()
+        file_path, content_hash, file_validators = parses[future]
+        record_source(manifest, file_path, content_hash, file_validators)
+        parsed.append(file_path)
+    return parsed
+
+
+def refresh(data_path, api_key, egrid_path=None,
+            petroleum_url=eia_petroleum_url,
+            electricity_url=eia_electricity_url, vehicles_url=vehicles_url,
+            workers=max_workers):
+    '''Function to refresh all of the dashboard data
+
+    The petroleum prices and the source files are fetched at the same time.
+    The manifest is only written once everything has succeeded, so a failed
+    refresh is simply run again.
+
+    Args:
+        data_path(str): directory holding the data files
+        api_key(str): EIA API key
+        egrid_path(str): eGRID workbook path or url, skipped if None
+        petroleum_url(str): EIA petroleum prices url
+        electricity_url(str): EIA-861M workbook url
+        vehicles_url(str): fueleconomy.gov vehicles csv url
+        workers(int): concurrent downloads and parsing processes
+
+    Returns:
+        refresh manifest
+    '''
+    manifest = read_manifest(data_path)
+    sources = source_files(data_path, egrid_path, electricity_url,
+                           vehicles_url)
+    # the petroleum pages have their own threads, as refresh_petroleum waits
+    # for them from a thread of the download pool
+    with make_session(2 * workers) as session, \
+        ThreadPoolExecutor(workers) as threads, \
+            ThreadPoolExecutor(workers) as pages, \
+            ProcessPoolExecutor(workers) as processes:
+        petroleum = threads.submit(refresh_petroleum, data_path, manifest,
+                                   session, api_key, url=petroleum_url,
+                                   executor=pages)
+        refresh_sources(data_path, manifest, session, sources, threads,
+                        processes)
+        petroleum.result()
+    write_manifest(data_path, manifest)
+    return manifest
+
+
+if __name__ == '__main__':
+    refresh(sys.argv[1] if len(sys.argv) > 1 else 'data/',
+            os.environ['EIA_API_KEY'],
+            sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Latency metrics for the vehicle comparison dashboard.
+
+Enabled by setting METRICS_ENABLED=1. The duration of every server callback,
+including the serialization of its figures, the stages of submit_calc and
+the snapshot loads are counted in histograms with fixed buckets. They are
+served with the cache hit rates in the Prometheus text format on /metrics.
+
+When disabled, callbacks are not wrapped and stages() returns a shared timer
+that does nothing, so the app runs as if this module did not exist.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import bisect
+import functools
+import hmac
+import os
+import threading
+import time
+import flask
+
+enabled = os.environ.get('METRICS_ENABLED') == '1'
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    '''Thread-safe histogram of values counted in fixed buckets
+
+    Args:
+        buckets(tuple): sorted upper bounds of the buckets, a last bucket
+            counts the values above them
+    '''
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        '''Function to count a value'''
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.total += value
+
+    def cumulative(self):
+        '''Function to return the cumulative bucket counts and the total'''
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+        running = 0
+        cumulative = []
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+
+def label_text(labels):
+    '''Function to format labels as {name="value",...} for Prometheus'''
+    if not labels:
+        return ''
+    values = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"')
+               .replace('\n', '\\n')) for key, value in sorted(labels.items())]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in values) + '}'
+
+
+class Registry:
+    '''Histograms, counters and collected gauges of the app
+
+    Collectors are functions called on every render that return a list of
+    (name, type, help, labels, value) tuples, for values such as cache hit
+    rates that are kept elsewhere. Adding a collector with the name of an
+    existing one replaces it.
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = {}
+        self.help = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text, **labels):
+        '''Function to return the histogram of a name and labels'''
+        key = tuple(sorted(labels.items()))
+        series = self.histograms.get(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            with self._lock:
+                series = self.histograms.setdefault(name, {})
+                histogram = series.setdefault(key, Histogram())
+                self.help[name] = help_text
+        return histogram
+
+    def increment(self, name, help_text, amount=1, **labels):
+        '''Function to add to a counter'''
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+            self.help[name] = help_text
+
+    def add_collector(self, name, function):
+        '''Function to add a collector of gauges and counters'''
+        self.collectors[name] = function
+
+    def render(self):
+        '''Function to return every metric in the Prometheus text format'''
+        lines = []
+        for name, series in sorted(self.histograms.items()):
+            lines += [f'# HELP {name} {self.help[name]}',
+                      f'# TYPE {name} histogram']
+            for key, histogram in sorted(series.items()):
+                labels = dict(key)
+                cumulative, total = histogram.cumulative()
+                for bound, count in zip(histogram.buckets + ('+Inf',),
+                                        cumulative):
+                    lines.append(f'{name}_bucket'
+                                 f'{label_text({**labels, "le": bound})} '
+                                 f'{count}')
+                lines += [f'{name}_sum{label_text(labels)} {total}',
+                          f'{name}_count{label_text(labels)} '
+                          f'{cumulative[-1]}']
+        with self._lock:
+            counters = {name: dict(series)
+                        for name, series in self.counters.items()}
+        for name, series in sorted(counters.items()):
+            lines += [f'# HELP {name} {self.help[name]}',
+                      f'# TYPE {name} counter']
+            lines += [f'{name}{label_text(dict(key))} {value}'
+                      for key, value in sorted(series.items())]
+
+        collected = {}
+        for collector in list(self.collectors.values()):
+            for name, kind, help_text, labels, value in collector():
+                collected.setdefault((name, kind, help_text), []).append(
+                    (labels, value))
+        for (name, kind, help_text), values in sorted(collected.items()):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            lines += [f'{name}{label_text(labels)} {value}'
+                      for labels, value in values]
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def observe(name, help_text, seconds, **labels):
+    '''Function to count a duration in a histogram, if metrics are enabled'''
+    if enabled:
+        registry.histogram(name, help_text, **labels).observe(seconds)
+
+
+class StageTimer:
+    '''Timer of the consecutive stages of a callback
+
+    Each mark records the time since the previous mark, or since the timer
+    was created, as the duration of the named stage.
+
+    Args:
+        callback(str): name of the callback
+    '''
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.start = time.perf_counter()
+
+    def mark(self, stage):
+        '''Function to record the end of a stage'''
+        now = time.perf_counter()
+        registry.histogram('dash_callback_stage_duration_seconds',
+                           'Duration of the stages of a Dash callback',
+                           callback=self.callback, stage=stage
+                           ).observe(now - self.start)
+        self.start = now
+
+
+class NullStageTimer:
+    '''Stage timer used when metrics are disabled'''
+
+    def mark(self, stage):
+        pass
+
+
+null_stage_timer = NullStageTimer()
+
+
+def stages(callback):
+    '''Function to start timing the stages of a callback
+
+    Args:
+        callback(str): name of the callback
+
+    Returns:
+        StageTimer, or a timer that does nothing if metrics are disabled
+    '''
+    return StageTimer(callback) if enabled else null_stage_timer
+
+
+def timed_callback(function, name):
+    '''Function to wrap a callback so its duration and exceptions are counted
+
+    Args:
+        function(function): callback as registered by Dash
+        name(str): callback label of the metrics
+
+    Returns:
+        wrapped function
+    '''
+    histogram = registry.histogram('dash_callback_duration_seconds',
+                                   'Duration of Dash callbacks including '
+                                   'serialization', callback=name)
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception as error:
+            registry.increment('dash_callback_exceptions_total',
+                               'Exceptions raised by Dash callbacks, '
+                               'including PreventUpdate', callback=name,
+                               exception=type(error).__name__)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    timed.timed_callback = True
+    return timed
+
+
+def wrap_server_callbacks(app, wrapper, marker):
+    '''Function to wrap every server callback registered on an app
+
+    Clientside callbacks run in the browser and have no function on the
+    server, so they are skipped. Callbacks already wrapped, marked with a
+    true marker attribute, are not wrapped again.
+
+    Args:
+        app(Dash): dashboard app
+        wrapper(function): called with the callback function and its name,
+            returns the wrapped function
+        marker(str): attribute set on the functions returned by wrapper
+    '''
+    for entry in app.callback_map.values():
+        function = entry.get('callback')
+        if function is None or getattr(function, marker, False):
+            continue
+        entry['callback'] = wrapper(function, function.__name__)
+
+
+def admin_request():
+    '''Function to check that the current request may use the admin pages
+
+    Allowed for requests from the same host, or with the X-Admin-Token header
+    matching ADMIN_TOKEN.
+
+    Returns:
+        True if the request is allowed
+    '''
+    if flask.request.remote_addr in ['127.0.0.1', '::1']:
+        return True
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    return bool(admin_token) and hmac.compare_digest(
+        flask.request.headers.get('X-Admin-Token', ''), admin_token)
+
+
+def instrument_callbacks(app):
+    '''Function to time every server callback registered on an app
+
+    Call after the callbacks are registered. Clientside callbacks run in the
+    browser and are not timed. Does nothing if metrics are disabled.
+
+    Args:
+        app(Dash): dashboard app
+    '''
+    if enabled:
+        wrap_server_callbacks(app, timed_callback, 'timed_callback')
+
+
+def add_cache(name, cache):
+    '''Function to report the hit rate of a cache with a stats() method
+
+    Args:
+        name(str): cache label of the metrics
+        cache(object): LRUCache or SQLiteCache from result_cache
+    '''
+    def collect():
+        stats = cache.stats()
+        labels = {'cache': name}
+        return [('cache_hits_total', 'counter', 'Cache lookups that hit',
+                 labels, stats['hits']),
+                ('cache_misses_total', 'counter', 'Cache lookups that missed',
+                 labels, stats['misses']),
+                ('cache_hit_ratio', 'gauge', 'Share of cache lookups that '
+                 'hit', labels, round(stats['hit_rate'], 6)),
+                ('cache_entries', 'gauge', 'Entries in the cache', labels,
+                 stats['size'])]
+    registry.add_collector('cache_' + name, collect)
+
+
+def add_snapshot_store(store):
+    '''Function to report the reloads and age of the data snapshot
+
+    Args:
+        store(SnapshotStore): store of the app's data snapshots
+    '''
+    def collect():
+        status = store.status()
+        collected = [('data_snapshot_ready', 'gauge',
+                      '1 once the first data snapshot is loaded', {},
+                      int(status['ready'])),
+                     ('data_snapshot_reloads_total', 'counter',
+                      'Data snapshots swapped in after the first', {},
+                      status['reloads']),
+                     ('data_snapshot_reload_failed', 'gauge',
+                      '1 if the last reload failed', {},
+                      int(status['last_error'] is not None))]
+        if status['loaded'] is not None:
+            collected.append(('data_snapshot_age_seconds', 'gauge',
+                              'Seconds since the current data snapshot was '
+                              'loaded', {},
+                              round(time.time() - status['loaded'], 3)))
+        return collected
+    registry.add_collector('data_snapshot', collect)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of slow dashboard callbacks.
+
+A sampling profiler records the call stack of a callback every few
+milliseconds while it runs. If the callback takes longer than the threshold,
+its stacks are written in the collapsed-stack format read by flamegraph.pl,
+speedscope and other flame graph tools:
+
+    flamegraph.pl profiles/submit_calc-20240101T120000-812ms.collapsed > fg.svg
+
+Profiling is off unless enabled with environment variables:
+
+    PROFILE_CALLBACKS=1      profile every callback
+    PROFILE_ON_REQUEST=1     profile the callbacks of pages opened with
+                             ?profile=1, until opened with ?profile=0
+    PROFILE_DIR              folder of the profiles, profiles/ by default
+    PROFILE_THRESHOLD_MS     slowest callback not written, 500 by default
+    PROFILE_INTERVAL_MS      milliseconds between samples, 5 by default
+
+?profile=1 is only honoured for the requests allowed on the admin pages,
+from the same host or with the X-Admin-Token header matching ADMIN_TOKEN.
+It sets a cookie signed with ADMIN_TOKEN, or without it with a key of the
+process, which expires after a day.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import functools
+import hashlib
+import hmac
+import os
+import secrets
+import sys
+import threading
+import time
+import flask
+import metrics
+
+profile_all = os.environ.get('PROFILE_CALLBACKS') == '1'
+profile_on_request = os.environ.get('PROFILE_ON_REQUEST') == '1'
+enabled = profile_all or profile_on_request
+
+profile_dir = os.environ.get('PROFILE_DIR', 'profiles')
+threshold_ms = float(os.environ.get('PROFILE_THRESHOLD_MS', 500))
+interval_ms = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+
+# Profiles kept in profile_dir, older ones are removed
+profiles_kept = 200
+
+# Cookie set by the profile query parameter
+profile_cookie = 'profile'
+
+# Seconds until the profile cookie expires
+profile_cookie_seconds = 24 * 3600
+
+# Key of the profile cookies when ADMIN_TOKEN is not set
+process_key = secrets.token_bytes(32)
+
+
+def frame_label(frame):
+    '''Function to name a stack frame as function (file:line)'''
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:' \
+        f'{code.co_firstlineno})'
+
+
+class StackSampler:
+    '''Sampler of the call stacks of one thread
+
+    Samples are taken by a background thread, so the profiled code runs
+    unchanged between samples.
+
+    Args:
+        thread_id(int): threading.get_ident() of the thread to sample
+        interval(float): seconds between samples
+    '''
+
+    def __init__(self, thread_id, interval=interval_ms / 1000):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            if labels:
+                stack = ';'.join(reversed(labels))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def start(self):
+        '''Function to start sampling'''
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Function to stop sampling
+
+        Returns:
+            dictionary of the number of samples of each collapsed stack
+        '''
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+
+def write_profile(name, elapsed_ms, stacks):
+    '''Function to write the stacks of a callback in collapsed-stack format
+
+    Args:
+        name(str): name of the callback
+        elapsed_ms(float): duration of the callback
+        stacks(dict): samples of each collapsed stack from StackSampler
+
+    Returns:
+        path of the profile file
+    '''
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_path = os.path.join(
+        profile_dir, f'{name}-{time.strftime("%Y%m%dT%H%M%S")}-'
+        f'{elapsed_ms:.0f}ms-{threading.get_ident()}.collapsed')
+    with open(profile_path, 'w') as profile_file:
+        for stack, count in sorted(stacks.items()):
+            profile_file.write(f'{stack} {count}\n')
+    remove_old_profiles()
+    return profile_path
+
+
+def remove_old_profiles(keep=profiles_kept):
+    '''Function to delete all but the newest profiles'''
+    profiles = [os.path.join(profile_dir, i) for i in os.listdir(profile_dir)
+                if i.endswith('.collapsed')]
+    profiles = sorted(profiles, key=os.path.getmtime, reverse=True)
+    for old_path in profiles[keep:]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            # removed by another worker
+            pass
+
+
+def cookie_signature(expires):
+    '''Function to sign the expiry time of a profile cookie'''
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    key = admin_token.encode() if admin_token else process_key
+    return hmac.new(key, f'profile:{expires}'.encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def cookie_value(now=None):
+    '''Function to build a signed profile cookie
+
+    Args:
+        now(float): time the cookie is set, the current time if None
+
+    Returns:
+        cookie value 'expires.signature'
+    '''
+    expires = int(now if now is not None else time.time()) \
+        + profile_cookie_seconds
+    return f'{expires}.{cookie_signature(expires)}'
+
+
+def valid_cookie(value):
+    '''Function to check the signature and expiry of a profile cookie'''
+    expires, _, signature = (value or '').partition('.')
+    if not expires.isdigit():
+        return False
+    return hmac.compare_digest(signature, cookie_signature(int(expires))) \
+        and int(expires) > time.time()
+
+
+def requested():
+    '''Function to check if the current request should be profiled'''
+    if profile_all:
+        return True
+    return profile_on_request and flask.has_request_context() \
+        and valid_cookie(flask.request.cookies.get(profile_cookie))
+
+
+def profiled_callback(function, name):
+    '''Function to wrap a callback so slow calls write a profile
+
+    Args:
+        function(function): callback as registered by Dash
+        name(str): name of the profile files
+
+    Returns:
+        wrapped function
+    '''
+    @functools.wraps(function)
+    def profiled(*args, **kwargs):
+        if not requested():
+            return function(*args, **kwargs)
+        sampler = StackSampler(threading.get_ident()).start()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            stacks = sampler.stop()
+            if elapsed_ms > threshold_ms and stacks:
+                write_profile(name, elapsed_ms, stacks)
+
+    profiled.profiled_callback = True
+    return profiled
+
+
+def set_profile_cookie(response):
+    '''Function to turn profiling on or off for a browser with ?profile=
+
+    Only requests allowed on the admin pages can turn profiling on.
+    '''
+    value = flask.request.args.get(profile_cookie)
+    if value == '0':
+        response.delete_cookie(profile_cookie)
+    elif value == '1' and metrics.admin_request():
+        response.set_cookie(profile_cookie, cookie_value(), httponly=True,
+                            samesite='Lax', max_age=profile_cookie_seconds)
+    return response
+
+
+def instrument_callbacks(app):
+    '''Function to profile every server callback registered on an app
+
+    Call after the callbacks are registered. Clientside callbacks run in the
+    browser and are not profiled. Does nothing unless profiling is enabled.
+
+    Args:
+        app(Dash): dashboard app
+    '''
+    if not enabled:
+        return
+    metrics.wrap_server_callbacks(app, profiled_callback, 'profiled_callback')
+    if profile_on_request:
+        app.server.after_request(set_profile_cookie)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Result caches for the vehicle comparison dashboard.
+
+Many users compare the same popular vehicles with the same state and round
+daily miles, so comparison results are memoized. Cache keys include the
+data version so results computed from old price data are never reused.
+
+LRUCache keeps results in the memory of one worker. SQLiteCache keeps
+serialized results in a local SQLite file shared by all workers on a host,
+so warm results survive restarts.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def data_version(file_paths):
+    '''Function to identify the current version of the data files
+
+    Args:
+        file_paths(list): data files the results are computed from
+
+    Returns:
+        short hash of the names, sizes and modification times of the files
+    '''
+    version = hashlib.sha1()
+    for file_path in file_paths:
+        if os.path.exists(file_path):
+            file_stat = os.stat(file_path)
+            version.update(f'{os.path.basename(file_path)} {file_stat.st_size} '
+                           f'{file_stat.st_mtime_ns};'.encode())
+    return version.hexdigest()[:12]
+
+
+class LRUCache:
+    '''Thread-safe least recently used cache with hit and miss counters
+
+    Args:
+        max_size(int): largest number of entries kept, 0 disables the cache
+    '''
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''Function to return a cached value and mark it as recently used'''
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        '''Function to add a value, evicting the least recently used'''
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''Function to drop every entry, used when the data is reloaded'''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''Function to return the size and hit rate of the cache'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    '''Cache of serialized results in a local SQLite file
+
+    Entries expire after ttl seconds, and the least recently used entries
+    are removed once there are more than max_entries.
+
+    Args:
+        db_path(str): SQLite file, created if it does not exist
+        ttl(float): seconds an entry stays valid
+        max_entries(int): largest number of entries kept
+        evict_every(int): number of puts between evictions
+    '''
+
+    def __init__(self, db_path, ttl=7 * 24 * 3600, max_entries=100000,
+                 evict_every=100):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                created REAL NOT NULL, accessed REAL NOT NULL)''')
+            connection.execute('''CREATE INDEX IF NOT EXISTS results_accessed
+                ON results (accessed)''')
+
+    def _connection(self):
+        # sqlite connections can not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(key):
+        return json.dumps(key, default=str)
+
+    def get(self, key, default=None):
+        '''Function to return a cached value that has not expired'''
+        now = time.time()
+        with self._connection() as connection:
+            row = connection.execute(
+                'SELECT value, created FROM results WHERE key = ?',
+                (self._key(key),)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return default
+            connection.execute('UPDATE results SET accessed = ? WHERE key = ?',
+                               (now, self._key(key)))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        '''Function to store a serialized value'''
+        now = time.time()
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                (self._key(key), value, now, now))
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        '''Function to remove expired and least recently used entries'''
+        with self._connection() as connection:
+            connection.execute('DELETE FROM results WHERE created < ?',
+                               (time.time() - self.ttl,))
+            connection.execute(
+                '''DELETE FROM results WHERE key IN (SELECT key FROM results
+                ORDER BY accessed DESC LIMIT -1 OFFSET ?)''',
+                (self.max_entries,))
+
+    def clear(self):
+        '''Function to drop every entry'''
+        with self._connection() as connection:
+            connection.execute('DELETE FROM results')
+
+    def stats(self):
+        '''Function to return the size and hit rate of the cache'''
+        size = self._connection().execute(
+            'SELECT COUNT(*) FROM results').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {'size': size, 'max_size': self.max_entries,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped vehicle and price arrays shared by the dashboard workers.
+
+Every worker process that imports vehicle_compare.py would otherwise hold
+its own copy of the vehicles table and price statistics. In shared mode the
+numeric vehicle columns and the price statistics of each data version are
+written once as .npy files, and every worker maps them read-only, so all
+workers on a host use the same pages of the operating system's file cache.
+
+The first process to load a data version publishes it, for example the
+gunicorn master when the app is preloaded, and the other workers attach to
+it instead of loading those columns themselves.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# Published data versions kept, older ones are removed
+versions_kept = 2
+
+price_stats_file = 'price_stats.npy'
+
+
+def version_path(shared_path, version):
+    '''Function to return the folder of the arrays of a data version'''
+    return os.path.join(shared_path, version)
+
+
+def numeric_columns(cars):
+    '''Function to list the numeric columns of the vehicles table'''
+    return [column for column in cars.columns
+            if pd.api.types.is_numeric_dtype(cars[column])]
+
+
+def price_stats_array(price_stats):
+    '''Function to pack the price statistics into a structured array
+
+    Args:
+        price_stats(dict): statistics from build_price_statistics
+
+    Returns:
+        structured array of fuel, area, time period, mean and std
+    '''
+    keys = list(price_stats.keys())
+    text_width = max([len(i) for key in keys for i in key] + [1])
+    stats = np.zeros(len(keys), dtype=[('fuel', f'U{text_width}'),
+                                       ('area', f'U{text_width}'),
+                                       ('time_period', f'U{text_width}'),
+                                       ('mean', float), ('std', float)])
+    for i, (key, (mean, std)) in enumerate(price_stats.items()):
+        stats[i] = (*key, mean, std)
+    return stats
+
+
+def publish(cars, price_stats, shared_path, version):
+    '''Function to write the arrays of a data version for the workers
+
+    The arrays are written to a temporary folder that is renamed into place,
+    so workers never map half-written files. If another process published
+    the same version first, its files are kept.
+
+    Args:
+        cars(DataFrame): cleaned vehicles database
+        price_stats(dict): statistics from build_price_statistics
+        shared_path(str): folder holding the published versions
+        version(str): data version
+
+    Returns:
+        folder of the published version
+    '''
+    target_path = version_path(shared_path, version)
+    if os.path.isdir(target_path):
+        return target_path
+
+    temp_path = f'{target_path}.tmp-{os.getpid()}'
+    os.makedirs(temp_path, exist_ok=True)
+    np.save(os.path.join(temp_path, '_index.npy'), cars.index.to_numpy())
+    for column in numeric_columns(cars):
+        np.save(os.path.join(temp_path, column + '.npy'),
+                cars[column].to_numpy())
+    np.save(os.path.join(temp_path, price_stats_file),
+            price_stats_array(price_stats))
+    try:
+        os.rename(temp_path, target_path)
+    except OSError:
+        # another worker published this version first
+        shutil.rmtree(temp_path, ignore_errors=True)
+    remove_old_versions(shared_path)
+    return target_path
+
+
+def remove_old_versions(shared_path, keep=versions_kept):
+    '''Function to delete all but the newest published versions
+
+    Workers that still map the files of a removed version keep reading them
+    until they reload, as the files are only freed once they are unmapped.
+    '''
+    versions = [os.path.join(shared_path, i) for i in os.listdir(shared_path)
+                if '.tmp-' not in i]
+    versions = sorted([i for i in versions if os.path.isdir(i)],
+                      key=os.path.getmtime, reverse=True)
+    for old_path in versions[keep:]:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def attach(shared_path, version):
+    '''Function to map the published arrays of a data version read-only
+
+    Args:
+        shared_path(str): folder holding the published versions
+        version(str): data version
+
+    Returns:
+        dictionary of memory-mapped arrays keyed by column name, None if the
+        version has not been published
+    '''
+    source_path = version_path(shared_path, version)
+    if not os.path.isdir(source_path):
+        return None
+    return {file_name[:-len('.npy')]: np.load(os.path.join(source_path,
+                                                           file_name),
+                                              mmap_mode='r')
+            for file_name in os.listdir(source_path)
+            if file_name.endswith('.npy')}
+
+
+def shared_frame(cars, arrays, columns):
+    '''Function to back the numeric vehicle columns with the shared arrays
+
+    Args:
+        cars(DataFrame): vehicles database, only its text columns are used
+        arrays(dict): arrays from attach
+        columns(list): columns of the returned DataFrame, in order
+
+    Returns:
+        vehicles DataFrame with the numeric columns mapped from the arrays
+    '''
+    columns = {column: arrays[column] if column in arrays
+               else cars[column].array
+               for column in columns}
+    # copy=False keeps each column on its mapped array
+    return pd.DataFrame(columns, index=arrays['_index'], copy=False)
+
+
+def shared_price_stats(arrays):
+    '''Function to rebuild the price statistics from the shared arrays'''
+    return {(str(i['fuel']), str(i['area']), str(i['time_period'])):
+            (float(i['mean']), float(i['std']))
+            for i in arrays[price_stats_file[:-len('.npy')]]}
+
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Integer state codes and per-state lookup tables for the vehicle comparison
+dashboard.
+
+Each state name gets an integer code, its position in state_names. The PADD
+region, electricity CO2 rate and fuel price statistics of every state are
+kept in dense arrays indexed by the code, so a per-state lookup is an array
+index and all states can be calculated at once by indexing with an array of
+codes. Unknown states get the code unknown_state, whose entries are NaN.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import numpy as np
+import fuel_prices
+
+# Dictionary of state names from https://gist.github.com/JeffPaine/3083347
+states = {
+    'AK': 'Alaska', 'AL': 'Alabama', 'AR': 'Arkansas', 'AZ': 'Arizona',
+    'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut', 
+    'DC': 'District of Columbia', 'DE': 'Delaware', 'FL': 'Florida',
+    'GA': 'Georgia', 'HI': 'Hawaii', 'IA': 'Iowa', 'ID': 'Idaho',
+    'IL': 'Illinois', 'IN': 'Indiana', 'KS': 'Kansas', 'KY': 'Kentucky',
+    'LA': 'Louisiana', 'MA': 'Massachusetts', 'MD': 'Maryland',
+    'ME': 'Maine', 'MI': 'Michigan', 'MN': 'Minnesota', 'MO': 'Missouri',
+    'MS': 'Mississippi', 'MT': 'Montana', 'NC': 'North Carolina',
+    'ND': 'North Dakota', 'NE': 'Nebraska', 'NH': 'New Hampshire',
+    'NJ': 'New Jersey', 'NM': 'New Mexico', 'NV': 'Nevada',
+    'NY': 'New York', 'OH': 'Ohio', 'OK': 'Oklahoma', 'OR': 'Oregon',
+    'PA': 'Pennsylvania', 'RI': 'Rhode Island', 'SC': 'South Carolina',
+    'SD': 'South Dakota', 'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah',
+    'VA': 'Virginia', 'VT': 'Vermont', 'WA': 'Washington',
+    'WI': 'Wisconsin', 'WV': 'West Virginia', 'WY': 'Wyoming'
+}
+
+# Dictionary of EIA gasoline regions and the states that make up those regions
+regions = {'PADD 1A': ['Connecticut', 'Maine', 'Massachusetts', 
+                       'New Hampshire', 'Rhode Island', 'Vermont'], 
+          'PADD 1B': ['Delaware', 'District of Columbia', 'Maryland', 
+                      'New Jersey', 'Pennsylvania', 'New York'],
+          'PADD 1C': ['Florida', 'Georgia', 'North Carolina', 'South Carolina', 
+                      'Virginia', 'West Virginia'],
+          'PADD 2': ['Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 
+                     'Michigan', 'Missouri', 'Nebraska', 'North Dakota', 
+                     'Oklahoma', 'South Dakota', 'Tennessee', 'Wisconsin', 
+                     'Minnesota', 'Ohio'],
+          'PADD 3': ['Alabama', 'Arkansas', 'Louisiana', 'Mississippi', 
+                     'New Mexico', 'Texas'],
+          'PADD 4': ['Colorado', 'Idaho', 'Montana', 'Utah', 'Wyoming'],
+          'PADD 5': ['Alaska', 'Arizona', 'California', 'Hawaii', 
+                     'Nevada', 'Oregon', 'Washington']}
+
+# State names in code order
+state_names = sorted(states.values())
+state_index = {state: code for code, state in enumerate(state_names)}
+# Code of a state that is not in states
+unknown_state = len(state_names)
+# Abbreviation of each state name
+state_abbreviations = {name: abbreviation
+                       for abbreviation, name in states.items()}
+
+# PADD region of each state name
+state_regions = {state: region for region, region_states in regions.items()
+                 for state in region_states}
+
+
+def state_code(state):
+    '''Function to return the integer code of a state name
+
+    Args:
+        state(str): state name
+
+    Returns:
+        code of the state, unknown_state if it is not a state
+    '''
+    return state_index.get(state, unknown_state)
+
+
+def build_state_tables(state_co2, price_stats, time_periods=None):
+    '''Function to build the dense per-state lookup tables
+
+    Every array has one entry per state code plus a final NaN entry for
+    unknown states. Petroleum prices of a state are those of its PADD region.
+
+    Args:
+        state_co2(DataFrame): state and US electricity CO2 rates with a
+            state_name column
+        price_stats(dict): statistics from build_price_statistics
+        time_periods(list): time periods of the price tables, the keys of
+            fuel_prices.time_periods if None
+
+    Returns:
+        dictionary with the region and co2_g_kwh arrays, us_co2_g_kwh, and
+        prices and us_prices of (mean, std) keyed by (fuel type, time period)
+    '''
+    # the first rate listed for a state is used
+    state_rates = state_co2.drop_duplicates(subset='state_name')\
+        .set_index('state_name')['co2_g/kWh']
+    tables = {
+        'region': np.array([state_regions.get(i) for i in state_names]
+                           + [None], dtype=object),
+        'co2_g_kwh': np.array([state_rates.get(i, np.nan)
+                               for i in state_names] + [np.nan],
+                              dtype=float),
+        'us_co2_g_kwh': state_co2[state_co2['state'] == 'US']['co2_g/kWh']
+        .iloc[0],
+        'prices': {},
+        'us_prices': {}}
+
+    for time_period in time_periods or fuel_prices.time_periods.keys():
+        for fuel_type in fuel_prices.petroleum_products.keys():
+            tables['prices'][(fuel_type, time_period)] = np.array(
+                [fuel_prices.lookup_statistics(price_stats, fuel_type,
+                                               state_regions.get(i),
+                                               time_period)
+                 for i in state_names] + [(np.nan, np.nan)], dtype=float)
+            tables['us_prices'][(fuel_type, time_period)] = \
+                fuel_prices.lookup_statistics(price_stats, fuel_type, 'U.S.',
+                                              time_period)
+        tables['prices'][('Electricity', time_period)] = np.array(
+            [fuel_prices.lookup_statistics(price_stats, 'Electricity', i,
+                                           time_period)
+             for i in state_names] + [(np.nan, np.nan)], dtype=float)
+        tables['us_prices'][('Electricity', time_period)] = \
+            fuel_prices.lookup_statistics(price_stats, 'Electricity', 'US',
+                                          time_period)
+    return tables
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests that the vectorized cost engine gives the results of the original
+per-vehicle fuel_costs calculation.
+
+reference_fuel_costs repeats the arithmetic of the original fuel_costs one
+vehicle at a time, with the prices and CO2 rates looked up directly, and is
+compared with cost_engine over combustion, electric and plug-in hybrid
+vehicles in every state and at several daily mileages.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import numpy as np
+import pandas as pd
+import pytest
+import benchmark
+import cost_engine
+import data_snapshot
+import fuel_prices
+import state_codes
+
+# Daily city and highway miles of the compared cases
+mileages = [(15, 10), (0, 40), (60, 0), (5, 120), (2.5, 3.5)]
+
+result_keys = ['annual_cost', 'annual_cost_std', 'us_annual_cost',
+               'us_annual_cost_std', 'co2_state', 'co2_US', 'co2_tailpipe']
+
+
+def reference_fuel_costs(car, state, city_miles, highway_miles, price_stats,
+                         state_rates, us_co2_g_kwh, time_period='3year'):
+    '''Function to calculate the costs and CO2 of one vehicle as fuel_costs
+    did before the cost engine
+
+    Returns:
+        dictionary of the results keyed as in cost_engine
+    '''
+    fuel_type = car['fuelType1']
+    if fuel_type in fuel_prices.petroleum_products:
+        gas = fuel_prices.lookup_statistics(
+            price_stats, fuel_type, state_codes.state_regions.get(state),
+            time_period)
+        us_gas = fuel_prices.lookup_statistics(price_stats, fuel_type,
+                                               'U.S.', time_period)
+    else:
+        gas = fuel_prices.lookup_statistics(price_stats, 'Electricity',
+                                            state, time_period)
+        us_gas = fuel_prices.lookup_statistics(price_stats, 'Electricity',
+                                               'US', time_period)
+    electricity = fuel_prices.lookup_statistics(price_stats, 'Electricity',
+                                                state, time_period)
+    us_electricity = fuel_prices.lookup_statistics(price_stats,
+                                                   'Electricity', 'US',
+                                                   time_period)
+    state_co2 = state_rates.get(state, np.nan)
+    total_miles = city_miles + highway_miles
+    highway_E = car['highwayE'] / 100
+    city_E = car['cityE'] / 100
+    results = {}
+
+    if fuel_type == 'Electricity':
+        usage = (highway_miles * highway_E) + (city_miles * city_E)
+        for prefix, prices in [('', electricity), ('us_', us_electricity)]:
+            results[prefix + 'annual_cost'] = np.round(
+                usage * (prices[0] / 100) * 365, 2)
+            results[prefix + 'annual_cost_std'] = np.round(
+                usage * (prices[1] / 100) * 365, 2)
+        results['co2_tailpipe'] = car['co2TailpipeGpm'] * total_miles
+        results['co2_state'] = round(usage * state_co2 / 1000 * 365)
+        results['co2_US'] = round(usage * us_co2_g_kwh / 1000 * 365)
+
+    elif car['atvType'] == 'Plug-in Hybrid':
+        city_drive_fraction = city_miles / total_miles
+        highway_drive_fraction = 1 - city_drive_fraction
+        effective_range = (city_drive_fraction * car['rangeCityA']) \
+            + (highway_drive_fraction * car['rangeHwyA'])
+        effective_efficiency = (city_drive_fraction * city_E) \
+            + (highway_drive_fraction * highway_E)
+        electricity_usage = effective_range * effective_efficiency
+        if total_miles > effective_range:
+            gas_range = total_miles - effective_range
+            effective_mpg = (city_drive_fraction * car['city08']) \
+                + (highway_drive_fraction * car['highway08'])
+            gas_usage = gas_range / effective_mpg
+            gas_co2 = car['co2TailpipeGpm'] * gas_range
+        else:
+            gas_usage = 0
+            gas_co2 = 0
+        for prefix, (gas_prices, electricity_prices) in [
+                ('', (gas, electricity)), ('us_', (us_gas, us_electricity))]:
+            for stat, suffix in [(0, ''), (1, '_std')]:
+                results[prefix + 'annual_cost' + suffix] = np.round(
+                    ((electricity_usage * electricity_prices[stat] / 100)
+                     + (gas_usage * gas_prices[stat])) * 365, 2)
+        results['co2_tailpipe'] = round(gas_co2)
+        results['co2_state'] = round((gas_co2 + electricity_usage
+                                      * state_co2) / 1000 * 365)
+        results['co2_US'] = round((gas_co2 + electricity_usage
+                                   * us_co2_g_kwh) / 1000 * 365)
+
+    else:
+        usage = (highway_miles / car['highway08']) \
+            + (city_miles / car['city08'])
+        for prefix, prices in [('', gas), ('us_', us_gas)]:
+            results[prefix + 'annual_cost'] = np.round(
+                usage * 365 * prices[0], 2)
+            results[prefix + 'annual_cost_std'] = np.round(
+                usage * 365 * prices[1], 2)
+        co2 = round((car['co2TailpipeGpm'] * total_miles) / 1000 * 365)
+        results.update({'co2_tailpipe': co2, 'co2_state': co2,
+                        'co2_US': co2})
+    return results
+
+
+@pytest.fixture(scope='module')
+def snapshot(tmp_path_factory):
+    '''Fixture of a snapshot of a small synthetic data folder'''
+    data_path = benchmark.write_synthetic_data(
+        str(tmp_path_factory.mktemp('data')), scale=0.005, seed=5)
+    return data_snapshot.load_snapshot(data_path)
+
+
+@pytest.mark.parametrize('city_miles, highway_miles', mileages)
+def test_engine_matches_per_vehicle_fuel_costs(snapshot, city_miles,
+                                               highway_miles):
+    cars = snapshot.cars
+    state_rates = snapshot.state_co2.drop_duplicates(subset='state_name')\
+        .set_index('state_name')['co2_g/kWh']
+    us_co2_g_kwh = snapshot.state_tables['us_co2_g_kwh']
+    # every kind of vehicle is compared
+    assert {'Electricity', 'Diesel'} <= set(cars['fuelType1'])
+    assert (cars['atvType'] == 'Plug-in Hybrid').any()
+
+    for state in state_codes.state_names:
+        results = cost_engine.vehicle_fuel_costs(
+            cars, state_codes.state_code(state), city_miles, highway_miles,
+            snapshot.state_tables)
+        expected = [reference_fuel_costs(car, state, city_miles,
+                                         highway_miles, snapshot.price_stats,
+                                         state_rates, us_co2_g_kwh)
+                    for _, car in cars.iterrows()]
+        for key in result_keys:
+            np.testing.assert_array_equal(
+                results[key], np.array([i[key] for i in expected], float),
+                err_msg=f'{key} in {state}')
+
+
+def test_row_fuel_costs_matches_vehicle_fuel_costs(snapshot):
+    cars = snapshot.cars
+    rng = np.random.default_rng(0)
+    rows = rng.integers(0, len(cars), 500)
+    codes = rng.integers(0, len(state_codes.state_names), 500)
+    city_miles = rng.choice([0, 5, 15.5, 40], 500)
+    highway_miles = rng.choice([1, 10, 80], 500)
+    results = cost_engine.row_fuel_costs(cars.iloc[rows], codes, city_miles,
+                                         highway_miles, snapshot.state_tables)
+    for position in range(0, 500, 7):
+        single = cost_engine.vehicle_fuel_costs(
+            cars.iloc[[rows[position]]], codes[position],
+            city_miles[position], highway_miles[position],
+            snapshot.state_tables)
+        for key in result_keys:
+            assert results[key][position] == pytest.approx(
+                single[key][0], nan_ok=True), key
+
+
+def test_hand_calculated_costs():
+    # one petroleum price and one electricity price everywhere
+    price_stats = {(fuel, area, '3year'): (3.0, 0.5)
+                   for fuel in fuel_prices.petroleum_products
+                   for area in list(state_codes.regions) + ['U.S.']}
+    price_stats.update({('Electricity', area, '3year'): (15.0, 2.0)
+                        for area in state_codes.state_names + ['US']})
+    state_co2 = pd.DataFrame({'state': ['TX', 'US'],
+                              'co2_g/kWh': [400.0, 380.0],
+                              'state_name': ['Texas', 'US']})
+    tables = state_codes.build_state_tables(state_co2, price_stats, ['3year'])
+    cars = pd.DataFrame({
+        'fuelType1': ['Regular Gasoline', 'Electricity', 'Regular Gasoline'],
+        'atvType': [None, 'EV', 'Plug-in Hybrid'],
+        'city08': [25, 120, 50], 'highway08': [30, 100, 50],
+        'cityE': [0.0, 25.0, 30.0], 'highwayE': [0.0, 30.0, 30.0],
+        'rangeCityA': [0.0, 0.0, 20.0], 'rangeHwyA': [0.0, 0.0, 20.0],
+        'co2TailpipeGpm': [300.0, 0.0, 200.0]})
+    results = cost_engine.vehicle_fuel_costs(
+        cars, state_codes.state_code('Texas'), 15, 10, tables)
+
+    # gas: (15 / 25 + 10 / 30) gallons a day at $3
+    # electric: 15 * 0.25 + 10 * 0.30 = 6.75 kWh a day at 15 cents
+    # plug-in: 20 miles on 6 kWh, then 5 miles on 0.1 gallons
+    np.testing.assert_allclose(results['annual_cost'],
+                               [1022.0, 369.56, 438.0])
+    np.testing.assert_allclose(results['annual_cost_std'],
+                               [170.33, 49.28, 62.05])
+    # kg a year: 7.5 kg a day of gas, 2.7 kg a day of electricity, and
+    # 1 kg of gas plus 2.4 kg of electricity
+    np.testing.assert_allclose(results['co2_state'], [2738.0, 986.0, 1241.0])
+    np.testing.assert_allclose(results['co2_tailpipe'], [2738.0, 0.0, 1000.0])
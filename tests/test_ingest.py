@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of ingest.py against a local stand-in for the EIA and fueleconomy.gov
+servers.
+
+The server pages the petroleum prices three rows at a time, fails one page
+once to exercise the retries, and answers conditional requests for the
+source files with 304 when their ETag matches.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import io
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import pandas as pd
+import pytest
+import requests
+import benchmark
+import fuel_prices
+import ingest
+import state_codes
+import vehicle_catalog
+
+# Rows of the petroleum prices returned on each page
+page_length = 3
+
+
+def petroleum_rows(periods):
+    '''Function to build EIA petroleum rows, one product and area a week'''
+    return [{'period': period, 'duoarea': 'NUS', 'area-name': 'U.S.',
+             'product': 'EPMRU',
+             'product-name': 'Conventional Regular Gasoline',
+             'process': 'PTE', 'value': str(3 + i / 100), 'units': '$/GAL'}
+            for i, period in enumerate(periods)]
+
+
+def electricity_workbook():
+    '''Function to build a workbook shaped like EIA-861M sales_revenue.xlsx'''
+    months = pd.date_range('2023-01-01', '2023-12-01', freq='MS')
+    states = pd.concat([pd.DataFrame({
+        'Year': months.year, 'Month': months.month, 'State': state,
+        'Data Status': 'Final', 'Revenue': 1.0, 'Sales': 1.0,
+        'Customers': 1.0, 'Cents/kWh': 15.0})
+        for state in state_codes.states.keys()], ignore_index=True)
+    us = pd.DataFrame({'Year': months.year, 'MONTH': months.month,
+                       'Data Status': 'Final', 'Revenue': 1.0, 'Sales': 1.0,
+                       'Customers': 1.0, 'Cents/kWh': 14.0})
+    footer = {'Year': 'Source: EIA-861M'}
+    content = io.BytesIO()
+    with pd.ExcelWriter(content) as writer:
+        pd.concat([states, pd.DataFrame([footer])]).to_excel(
+            writer, sheet_name='Monthly-States', startrow=2, index=False)
+        pd.concat([us, pd.DataFrame([footer])]).to_excel(
+            writer, sheet_name='US-YTD', startrow=2, index=False)
+    return content.getvalue()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    '''Handler of the stand-in server, set up by the server fixture'''
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/petroleum':
+            offset = int(query['offset'][0])
+            state['pages'].append((query['start'][0], offset))
+            if (query['start'][0], offset) in state['fail_once']:
+                state['fail_once'].remove((query['start'][0], offset))
+                return self.send_body(503, b'', 'text/plain')
+            rows = sorted([i for i in state['petroleum']
+                           if query['start'][0] <= i['period']
+                           <= query['end'][0]],
+                          key=lambda i: i['period'], reverse=True)
+            page = rows[offset:offset + page_length]
+            body = json.dumps({'response': {'total': len(rows),
+                                            'data': page}}).encode()
+            return self.send_body(200, body, 'application/json')
+
+        file_name = url.path.lstrip('/')
+        if file_name not in state['files']:
+            return self.send_body(404, b'', 'text/plain')
+        body, etag = state['files'][file_name]
+        if self.headers.get('If-None-Match') == etag:
+            state['downloads'].append((file_name, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        state['downloads'].append((file_name, 200))
+        self.send_body(200, body, 'application/octet-stream',
+                       {'ETag': etag,
+                        'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+
+
+@pytest.fixture
+def server():
+    '''Fixture of the stand-in server, yields its url and state'''
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    httpd.state = {
+        'petroleum': petroleum_rows(['2023-12-18', '2023-12-25',
+                                     '2024-01-01', '2024-01-08',
+                                     '2024-01-15', '2024-01-22',
+                                     '2024-01-29']),
+        'files': {'sales_revenue.xlsx': (electricity_workbook(), '"e1"'),
+                  'vehicles.csv': (benchmark.synthetic_catalog(200)
+                                   .to_csv(index=False).encode(), '"v1"')},
+        'pages': [], 'downloads': [], 'fail_once': {('1990-01-01', 3)}}
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}', httpd.state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def run_refresh(data_path, url, workers=1):
+    '''Function to refresh a data folder from the stand-in server'''
+    return ingest.refresh(str(data_path), 'key',
+                          petroleum_url=url + '/petroleum',
+                          electricity_url=url + '/sales_revenue.xlsx',
+                          vehicles_url=url + '/vehicles.csv',
+                          workers=workers)
+
+
+def test_refresh_pages_partitions_and_skips_unmodified(tmp_path, server):
+    url, state = server
+    # one worker, so the petroleum pages can not wait behind their caller
+    manifest = run_refresh(tmp_path, url, workers=1)
+
+    # every page is requested, the failed one again after a retry
+    assert sorted(state['pages']) == [('1990-01-01', 0), ('1990-01-01', 3),
+                                      ('1990-01-01', 3), ('1990-01-01', 6)]
+    assert manifest['petroleum']['watermark'] == '2024-01-29'
+    assert manifest['petroleum']['partitions'] == {'2023': 2, '2024': 5}
+    assert len(fuel_prices.read_petrol_prices(str(tmp_path))) == 7
+    assert set(manifest['sources']) == {'sales_revenue.xlsx', 'vehicles.csv'}
+    assert manifest['validators']['vehicles.csv']['etag'] == '"v1"'
+    assert json.load(open(tmp_path / ingest.manifest_file)) == manifest
+    assert os.path.exists(tmp_path / vehicle_catalog.snapshot_file)
+    electricity = pd.read_csv(tmp_path / 'state_electricity.csv')
+    assert len(electricity) == 12 * len(state_codes.states)
+
+    # a new week
+    state['petroleum'] += petroleum_rows(['2024-02-05'])
+    parsed_at = os.path.getmtime(tmp_path / 'state_electricity.csv')
+    state['pages'].clear()
+    state['downloads'].clear()
+    manifest = run_refresh(tmp_path, url, workers=2)
+
+    # only the weeks after the watermark are requested
+    assert state['pages'] == [('2024-01-30', 0)]
+    assert manifest['petroleum']['watermark'] == '2024-02-05'
+    assert manifest['petroleum']['partitions']['2024'] == 6
+    petrol_prices = fuel_prices.read_petrol_prices(str(tmp_path))
+    assert len(petrol_prices) == 8
+    assert not petrol_prices.duplicated(subset=ingest.petroleum_keys).any()
+    # the unchanged source files are not downloaded or parsed again
+    assert sorted(state['downloads']) == [('sales_revenue.xlsx', 304),
+                                          ('vehicles.csv', 304)]
+    assert os.path.getmtime(tmp_path / 'state_electricity.csv') == parsed_at
+
+
+def test_manifest_written_only_after_every_fetch(tmp_path, server):
+    url, state = server
+    vehicles = state['files'].pop('vehicles.csv')
+    with pytest.raises(requests.HTTPError):
+        run_refresh(tmp_path, url)
+    assert not os.path.exists(tmp_path / ingest.manifest_file)
+
+    state['files']['vehicles.csv'] = vehicles
+    state['pages'].clear()
+    manifest = run_refresh(tmp_path, url)
+    # without a manifest the petroleum prices are requested from the start
+    assert ('1990-01-01', 0) in state['pages']
+    assert manifest['petroleum']['watermark'] == '2024-01-29'
+    # the prices written by the failed refresh are not duplicated
+    assert manifest['petroleum']['partitions'] == {'2023': 2, '2024': 5}
+    petrol_prices = fuel_prices.read_petrol_prices(str(tmp_path))
+    assert len(petrol_prices) == 7
+    assert os.path.exists(tmp_path / ingest.manifest_file)
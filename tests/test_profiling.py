@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of turning on profiling with ?profile=1 in profiling.py.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import flask
+import pytest
+import profiling
+
+# Address of a visitor from another host
+remote = {'REMOTE_ADDR': '203.0.113.5'}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    '''Fixture of a server answering whether its requests are profiled'''
+    monkeypatch.setattr(profiling, 'profile_on_request', True)
+    monkeypatch.setenv('ADMIN_TOKEN', 'secret')
+    server = flask.Flask(__name__)
+    server.add_url_rule('/', view_func=lambda: str(profiling.requested()))
+    server.after_request(profiling.set_profile_cookie)
+    return server.test_client()
+
+
+def test_remote_visitor_can_not_turn_on_profiling(client):
+    response = client.get('/?profile=1', environ_base=remote)
+    assert 'Set-Cookie' not in response.headers
+    # nor by sending the cookie itself
+    client.set_cookie(profiling.profile_cookie, '1')
+    assert client.get('/', environ_base=remote).text == 'False'
+    client.set_cookie(profiling.profile_cookie, '99999999999.forged')
+    assert client.get('/', environ_base=remote).text == 'False'
+
+
+@pytest.mark.parametrize('environ, headers', [
+    ({}, {}), (remote, {'X-Admin-Token': 'secret'})])
+def test_admin_turns_profiling_on_and_off(client, environ, headers):
+    client.get('/?profile=1', environ_base=environ, headers=headers)
+    assert client.get('/', environ_base=remote).text == 'True'
+    client.get('/?profile=0', environ_base=remote)
+    assert client.get('/', environ_base=remote).text == 'False'
+
+
+def test_cookie_expires(client):
+    expired = profiling.cookie_value(now=0)
+    assert not profiling.valid_cookie(expired)
+    assert profiling.valid_cookie(profiling.cookie_value())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the callbacks of vehicle_compare.py on a small synthetic data
+folder.
+
+@author: richardbradshaw
+"""
+
+# Imports
+import json
+import pytest
+import benchmark
+import vehicle_compare
+
+
+@pytest.fixture(scope='module')
+def snapshot(tmp_path_factory):
+    '''Fixture of the app on a small synthetic data folder, yields its data'''
+    data_path = benchmark.write_synthetic_data(
+        str(tmp_path_factory.mktemp('data')), scale=0.005, seed=5)
+    vehicle_compare.create_app({
+        'data_path': data_path, 'shared_path': None, 'result_cache_db': None,
+        'clientside_dropdowns': False, 'data_watch_interval': None,
+        'background_load': False})
+    return vehicle_compare.current_snapshot()
+
+
+def vehicle_ids(snapshot, count=2):
+    '''Function to pick the options dropdown values of a few vehicles'''
+    vehicles = benchmark.benchmark_vehicles(snapshot.cars)
+    return [int(snapshot.cars.loc[i, 'id']) for i in vehicles.values()][:count]
+
+
+def test_options_are_vehicle_ids(snapshot):
+    car = snapshot.cars.iloc[0]
+    trims = vehicle_compare.vehicle_options('model', int(car['year']),
+                                            car['make'], car['model'],
+                                            snapshot)[4]
+    assert int(car['id']) in [i['value'] for i in trims]
+
+
+def test_callbacks_price_the_selected_ids(snapshot):
+    cars_in = vehicle_ids(snapshot)
+    names = [vehicle_compare.cached_fuel_costs(
+        snapshot.vehicle_rows[i], 'Texas', 15, 10, snapshot)[4]
+        for i in cars_in]
+    fig_cost, fig_co2, summary_text, summary_footnote = \
+        vehicle_compare.submit_calc(1, cars_in, 'Texas', 15, 10, '3year')
+    assert set(fig_cost.data[0].x) == set(names)
+    fig_miles = vehicle_compare.mileage_calc(1, cars_in, 'Texas', 15, 10,
+                                             '3year')
+    assert {i.name for i in fig_miles.data} == set(names)
+    fig_map = vehicle_compare.state_map_calc(1, 'annual_cost', cars_in, 15,
+                                             10, '3year')
+    assert len(fig_map.data) == len(cars_in)
+
+
+def test_missing_vehicle_is_reported(snapshot):
+    # an id from a page opened before a reload removed the vehicle
+    cars_in = vehicle_ids(snapshot, 1) + [int(snapshot.cars['id'].max()) + 1]
+    fig_cost, fig_co2, summary_text, summary_footnote = \
+        vehicle_compare.submit_calc(1, cars_in, 'Texas', 15, 10, '3year')
+    assert summary_text == vehicle_compare.unavailable_text
+    assert fig_cost['data'] == []
+    for figure in [vehicle_compare.mileage_calc(1, cars_in, 'Texas', 15, 10,
+                                                '3year'),
+                   vehicle_compare.state_map_calc(1, 'annual_cost', cars_in,
+                                                  15, 10, '3year')]:
+        assert figure['layout']['title']['text'] == \
+            vehicle_compare.unavailable_text
+
+
+@pytest.mark.parametrize('miles', [10 ** 400, 1e300, float('inf'), -1,
+                                   '15', None])
+def test_batch_rejects_bad_miles(snapshot, miles):
+    client = vehicle_compare.server.test_client()
+    response = client.post('/api/fuel_costs', json={
+        'rows': [[vehicle_ids(snapshot, 1)[0], 'Texas', miles, 10]]})
+    assert response.status_code == 400
+    assert 'city_miles' in response.get_json()['rows'][0]['error']
+
+
+def test_batch_results_are_json(snapshot):
+    client = vehicle_compare.server.test_client()
+    cars_in = vehicle_ids(snapshot, 3)
+    response = client.post('/api/fuel_costs', json={
+        'rows': [[i, 'Texas', vehicle_compare.batch_max_miles, 0]
+                 for i in cars_in] + [[cars_in[2], 'Texas', 0, 0]]})
+    assert response.status_code == 200
+
+    def reject(constant):
+        raise ValueError(f'{constant} is not valid JSON')
+    lines = [json.loads(i, parse_constant=reject)
+             for i in response.get_data(as_text=True).splitlines()]
+    assert [i['id'] for i in lines] == cars_in + cars_in[2:]
+    assert all(i['annual_cost'] > 0 for i in lines[:-1])
+    # the share of city miles of a plug-in hybrid is undefined without miles
+    assert lines[-1]['annual_cost'] is None
+
+
+@pytest.mark.parametrize('time_period, fuel_type', [
+    ('2030-01-01:2031-01-01', 'Electricity'),
+    ('2002-01-01:2003-01-01', 'Regular Gasoline')])
+def test_batch_rejects_window_without_prices(snapshot, time_period,
+                                             fuel_type):
+    client = vehicle_compare.server.test_client()
+    response = client.post('/api/fuel_costs', json={
+        'rows': [[vehicle_ids(snapshot, 1)[0], 'Texas', 15, 10]],
+        'time_period': time_period})
+    assert response.status_code == 400
+    assert fuel_type in response.get_json()['error']
+
+
+def test_batch_accepts_window_with_prices(snapshot):
+    client = vehicle_compare.server.test_client()
+    response = client.post('/api/fuel_costs', json={
+        'rows': [[i, 'Texas', 15, 10] for i in vehicle_ids(snapshot, 3)],
+        'time_period': '2015-01-01:2015-03-01'})
+    assert response.status_code == 200
+    lines = [json.loads(i) for i in response.get_data(as_text=True)
+             .splitlines()]
+    assert all(i['annual_cost'] > 0 for i in lines)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vehicle catalog loading for the vehicle comparison dashboard.
+
+The fueleconomy.gov dump has ~80 columns and tens of thousands of rows, so
+parsing it on every start is slow. Running this script writes a columnar
+snapshot (.npz) holding only the columns the dashboard uses, with the
+cleaning already applied, and prints how much memory the loaded catalog
+uses. The snapshot records the size and modification time of the csv file
+it was built from, and is built again when the csv file changes:
+
+    python vehicle_catalog.py /path/to/data/
+
+@author: richardbradshaw
+"""
+
+# Imports
+import os
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+
+# Columns of the fueleconomy.gov database read by the dashboard
+catalog_columns = ['year', 'make', 'model', 'fuelType1', 'atvType', 'city08',
+                   'highway08', 'cityE', 'highwayE', 'rangeCityA',
+                   'rangeHwyA', 'co2TailpipeGpm', 'trany', 'displ',
+                   'cylinders', 'startStop', 'rangeCity', 'rangeHwy', 'id']
+
+# Columns derived from the database during cleaning
+derived_columns = ['trany_short', 'fuelType1_short']
+
+# Text columns with few distinct values, kept as categoricals in memory
+categorical_columns = ['make', 'model', 'fuelType1', 'atvType', 'trany',
+                       'startStop', 'trany_short', 'fuelType1_short']
+
+csv_file = 'cars_database.csv'
+snapshot_file = 'cars_snapshot.npz'
+
+
+def clean_catalog(cars):
+    '''Function to drop incomplete vehicles and add the short display names
+
+    Args:
+        cars(DataFrame): raw vehicles database
+
+    Returns:
+        cleaned vehicles DataFrame
+    '''
+    # Drop cars with incomplete information
+    drop_index = cars[((cars['cylinders'].isnull()) & (cars['fuelType1'] != 'Electricity')
+          | (cars['trany'].isnull()) & (cars['fuelType1'] != 'Electricity'))].index
+    cars = cars.drop(drop_index)
+    cars['trany_short'] = cars['trany'].replace({'Manual': 'Man',
+                                                 'Automatic': 'Auto'}, regex=True)
+    cars['fuelType1_short'] = cars['fuelType1'].replace('Gasoline',
+                                                        'Gas', regex=True)
+    return cars
+
+
+def compact_dtypes(cars):
+    '''Function to reduce the memory used by the vehicles table
+
+    Repeated text columns become categoricals. Integer columns are downcast
+    to the smallest integer type, and float columns to float32 only when
+    every value is exactly representable, so costs calculated from the
+    compact table are unchanged.
+
+    Args:
+        cars(DataFrame): cleaned vehicles database, changed in place
+
+    Returns:
+        vehicles DataFrame with compact dtypes
+    '''
+    for column in categorical_columns:
+        if column in cars.columns:
+            cars[column] = cars[column].astype('category')
+    for column in cars.select_dtypes('integer').columns:
+        cars[column] = pd.to_numeric(cars[column], downcast='integer')
+    for column in cars.select_dtypes('float').columns:
+        values = cars[column].to_numpy()
+        compact_values = values.astype(np.float32)
+        if np.array_equal(compact_values, values, equal_nan=True):
+            cars[column] = compact_values
+    return cars
+
+
+def memory_report(cars):
+    '''Function to list the memory used by each column of the vehicles table
+
+    Args:
+        cars(DataFrame): vehicles database
+
+    Returns:
+        DataFrame of the dtype and kB of each column, largest first, with a
+        total row
+    '''
+    usage = cars.memory_usage(index=True, deep=True)
+    report = pd.DataFrame({'dtype': cars.dtypes.astype(str)
+                           .reindex(usage.index).fillna('index'),
+                           'kB': (usage / 1000).round(1)})
+    report = report.sort_values(by='kB', ascending=False)
+    report.loc['total'] = ['', report['kB'].sum().round(1)]
+    return report
+
+
+def read_catalog_csv(data_path):
+    '''Function to read and clean the full vehicles database csv file
+
+    Args:
+        data_path(str): directory holding the data files
+
+    Returns:
+        cleaned vehicles DataFrame restricted to the catalog columns
+    '''
+    cars = pd.read_csv(os.path.join(data_path, csv_file),
+                       usecols=lambda column: column in catalog_columns,
+                       low_memory=(False))
+    cars = clean_catalog(cars)
+    return cars[catalog_columns + derived_columns]
+
+
+def csv_signature(data_path):
+    '''Function to return the size and modification time of the csv file
+
+    Args:
+        data_path(str): directory holding the data files
+
+    Returns:
+        int64 array of the size in bytes and mtime in nanoseconds, None if
+        there is no csv file
+    '''
+    try:
+        stat = os.stat(os.path.join(data_path, csv_file))
+    except FileNotFoundError:
+        return None
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def write_snapshot(cars, snapshot_path, source=None):
+    '''Function to save a cleaned catalog as a typed columnar .npz file
+
+    Numeric columns keep their dtype. Text columns are stored as fixed
+    width unicode arrays with a separate mask of missing values, so the
+    snapshot can be loaded without pickle.
+
+    Args:
+        cars(DataFrame): cleaned vehicles database
+        snapshot_path(str): .npz file to write
+        source(array): csv_signature of the csv file the catalog was read
+            from
+    '''
+    arrays = {'_index': cars.index.to_numpy()}
+    if source is not None:
+        arrays['_source'] = source
+    for column in cars.columns:
+        if pd.api.types.is_numeric_dtype(cars[column]):
+            arrays[column] = cars[column].to_numpy()
+        else:
+            arrays[column] = cars[column].fillna('').astype(str).to_numpy(dtype=str)
+            arrays[column + '__null'] = cars[column].isnull().to_numpy()
+
+    # write to a temporary file first so a running app never reads half a
+    # file, one for each process as every worker may rebuild a stale snapshot
+    temp_path = f'{snapshot_path}.{os.getpid()}.tmp.npz'
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, snapshot_path)
+
+
+def read_snapshot(snapshot_path, columns=None):
+    '''Function to load a catalog snapshot written by write_snapshot
+
+    Args:
+        snapshot_path(str): .npz file to read
+        columns(list): columns to read, all of them if None
+
+    Returns:
+        cleaned vehicles DataFrame
+    '''
+    if columns is None:
+        columns = catalog_columns + derived_columns
+    with np.load(snapshot_path, allow_pickle=False) as snapshot:
+        # members of an .npz file are only read when they are accessed
+        arrays = {}
+        for column in columns:
+            values = snapshot[column]
+            if column + '__null' in snapshot.files:
+                values = pd.Series(values, dtype=object)
+                values[snapshot[column + '__null']] = np.nan
+                values = values.to_numpy()
+            arrays[column] = values
+        index = snapshot['_index']
+    return pd.DataFrame(arrays, index=index)
+
+
+def build_snapshot(data_path):
+    '''Function to build the catalog snapshot from the vehicles csv file
+
+    Args:
+        data_path(str): directory holding the data files
+
+    Returns:
+        path of the snapshot file
+    '''
+    snapshot_path = os.path.join(data_path, snapshot_file)
+    # taken before reading, so a csv changed while it is read is stale
+    source = csv_signature(data_path)
+    write_snapshot(read_catalog_csv(data_path), snapshot_path, source)
+    return snapshot_path
+
+
+def snapshot_is_current(data_path, snapshot_path):
+    '''Function to check a snapshot was built from the current csv file
+
+    A snapshot without a csv file next to it is used as it is.
+
+    Args:
+        data_path(str): directory holding the data files
+        snapshot_path(str): .npz file written by build_snapshot
+
+    Returns:
+        True if the snapshot can be used
+    '''
+    source = csv_signature(data_path)
+    if source is None:
+        return True
+    with np.load(snapshot_path, allow_pickle=False) as snapshot:
+        return '_source' in snapshot.files \
+            and np.array_equal(snapshot['_source'], source)
+
+
+def load_catalog(data_path, columns=None):
+    '''Function to load the vehicles catalog, using the snapshot if current
+
+    Parses the csv file when no snapshot has been built. A snapshot built
+    from an older csv file, such as one rewritten by the notebook, is built
+    again from the csv file. The catalog is returned with the compact dtypes
+    of compact_dtypes.
+
+    Args:
+        data_path(str): directory holding the data files
+        columns(list): columns to read, all of them if None
+
+    Returns:
+        cleaned vehicles DataFrame
+    '''
+    snapshot_path = os.path.join(data_path, snapshot_file)
+    if os.path.exists(snapshot_path) \
+        and snapshot_is_current(data_path, snapshot_path):
+        return compact_dtypes(read_snapshot(snapshot_path, columns))
+
+    source = csv_signature(data_path)
+    cars = read_catalog_csv(data_path)
+    if os.path.exists(snapshot_path):
+        warnings.warn(f'{snapshot_path} is older than {csv_file}, building '
+                      'it again')
+        try:
+            write_snapshot(cars, snapshot_path, source)
+        except OSError as error:
+            # a read-only data folder, the csv file is parsed on every load
+            warnings.warn(f'could not rebuild {snapshot_path}: {error}')
+    if columns is not None:
+        cars = cars[columns].copy()
+    return compact_dtypes(cars)
+
+
+def option_labels(cars):
+    '''Function to build the dropdown label of every vehicle
+
+    Electric vehicles are labelled with their range and all other vehicles
+    with their transmission, engine and fuel type.
+
+    Args:
+        cars(DataFrame): cleaned vehicles database
+
+    Returns:
+        tuple of the electric and the combustion label Series
+    '''
+    startStop_flag = np.where(cars['startStop'] == 'Y', ' start/stop', '')
+    ev_label = cars['rangeCity'].astype('str') + '/' \
+        + cars['rangeHwy'].astype('str') + ' mi city/hwy range'
+    # categoricals are added as objects so missing values stay missing
+    ice_label = cars['trany_short'].astype(object) + ' ' \
+        + cars['displ'].astype('str') + ' L ' \
+            + cars['cylinders'].astype('str') + ' cyl ' \
+                + cars['fuelType1_short'].astype(object) + ' ' \
+                    + startStop_flag
+    return ev_label, ice_label
+
+
+def build_catalog_index(cars):
+    '''Function to index the catalog for the year/make/model dropdowns
+
+    The options of the vehicles have the fueleconomy.gov id as their value,
+    so a selection still names the same vehicle after the data is reloaded.
+
+    Args:
+        cars(DataFrame): cleaned vehicles database
+
+    Returns:
+        dictionary with the dropdown options for the makes of each year, the
+        models of each (year, make), the vehicles of each
+        (year, make, model) and the option label of each row of cars
+    '''
+    ev_label, ice_label = option_labels(cars)
+    ev_label = ev_label.to_numpy()
+    ice_label = ice_label.to_numpy()
+    electric = (cars['fuelType1'] == 'Electricity').to_numpy()
+    row_index = cars.index.to_numpy()
+    vehicle_ids = cars['id'].to_numpy()
+
+    # A model is labelled by range only if all of its versions are electric
+    trims = {}
+    labels = {}
+    for (year, make, model), rows in cars.groupby(['year', 'make', 'model'],
+                                                  observed=True
+                                                  ).indices.items():
+        if electric[rows].all():
+            label = ev_label[rows]
+        else:
+            label = ice_label[rows]
+        trims[(int(year), make, model)] = [{'label': i, 'value': int(j)} 
+                                           for i, j in zip(label, 
+                                                           vehicle_ids[rows])]
+        labels.update(zip(row_index[rows].tolist(), label))
+
+    makes = {}
+    models = {}
+    for year, make, model in trims.keys():
+        makes.setdefault(year, set()).add(make)
+        models.setdefault((year, make), set()).add(model)
+
+    catalog_index = {
+        'years': [{'label': i, 'value': i}
+                  for i in sorted(makes.keys(), reverse=True)],
+        'makes': {year: [{'label': i, 'value': i} for i in sorted(names)]
+                  for year, names in makes.items()},
+        'models': {key: [{'label': i, 'value': i} for i in sorted(names)]
+                   for key, names in models.items()},
+        'trims': trims,
+        'labels': labels}
+    return catalog_index
+
+
+def compact_catalog(catalog_index):
+    '''Function to nest the catalog index for sending to the browser
+
+    Lists are used instead of dictionaries so the sort order of the makes and
+    models survives the trip through JSON.
+
+    Args:
+        catalog_index(dict): index from build_catalog_index
+
+    Returns:
+        list of [year, [[make, [[model, [[label, value], ...]], ...]], ...]]
+    '''
+    catalog = []
+    for year in [i['value'] for i in catalog_index['years']]:
+        makes = []
+        for make in [i['value'] for i in catalog_index['makes'][year]]:
+            models = []
+            for model in [i['value'] for i in
+                          catalog_index['models'][(year, make)]]:
+                models.append([model, [[i['label'], i['value']] for i in
+                                       catalog_index['trims'][(year, make,
+                                                               model)]]])
+            makes.append([make, models])
+        catalog.append([year, makes])
+    return catalog
+
+
+if __name__ == '__main__':
+    data_path = sys.argv[1] if len(sys.argv) > 1 else 'data/'
+    print(build_snapshot(data_path))
+    cars = read_catalog_csv(data_path)
+    loaded_report = memory_report(cars)
+    print(pd.concat({'loaded': loaded_report,
+                     'compact': memory_report(compact_dtypes(cars))},
+                    axis=1))
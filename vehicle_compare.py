@@ -7,108 +7,115 @@ Created on Tue Dec 20 20:10:13 2022
 """
 
 # Imports
-# import time
+import os
+import json
+import gzip
+import hashlib
+import hmac
+import time
 import pandas as pd
 import numpy as np
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, MATCH, ALL
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-import plotly.express as px
+import flask
+import vehicle_catalog
+import cost_engine
+import result_cache
+import data_snapshot
+import fuel_prices
+import state_codes
+import metrics
+import profiling
 
 # Load Data
 
 path = '/Users/richardbradshaw/Box/Python/01_Vehicles_Dash/'
 # path = '/home/rbrad06/mysite/'
 
-# vehicles database
-cars = pd.read_csv(path + 'data/cars_database.csv', low_memory=(False))
-# Drop cars with incomplete information
-drop_index = cars[((cars['cylinders'].isnull()) & (cars['fuelType1'] != 'Electricity') 
-      | (cars['trany'].isnull()) & (cars['fuelType1'] != 'Electricity') 
-     | (cars['trany'].isnull()) & (cars['fuelType1'] != 'Electricity'))].index
-cars = cars.drop(drop_index)
-cars['trany_short'] = cars['trany'].replace({'Manual': 'Man', 
-                                             'Automatic': 'Auto'}, regex=True)
-cars['fuelType1_short'] = cars['fuelType1'].replace('Gasoline', 
-                                                    'Gas', regex=True)
-
-# separate vehicles into their separate types 
-ev = cars[cars['fuelType1'] == 'Electricity']
-ice = cars[(cars['fuelType1'] != 'Electricity') & 
-           (cars['fuelType2'] != 'Electricity') & 
-           (cars['atvType'] != 'Hybrid')]
-phev = cars[cars['atvType'] == 'Plug-in Hybrid']
-hybrids = cars[cars['atvType'] == 'Hybrid']
-
-# gas and diesel prices
-petrol_prices = pd.read_csv(path + 'data/petrol_prices.csv', index_col=0, parse_dates=['period'])
-# petrol_prices['period'] = pd.to_datetime(petrol_prices['period'])
-petrol_prices.rename(columns={'value': 'price'}, inplace=True)
-# separate gas prices into their separate types
-diesel = petrol_prices[petrol_prices['product-name'] == 'No 2 Diesel']
-regular_gas = petrol_prices[petrol_prices['product-name'] == 
-                            'Conventional Regular Gasoline']
-premium_gas = petrol_prices[petrol_prices['product-name'] == 
-                            'Conventional Premium Gasoline']
-midgrade_gas = petrol_prices[petrol_prices['product-name'] == 
-                             'Gasoline Conventional Midgrade']
-
-# Electricity prices
-electricity_prices = pd.read_csv(path + 'data/state_electricity.csv', index_col=0, 
-                                 parse_dates=['period'])
-us_elec = pd.read_csv(path + 'data/us_electricity.csv', index_col=0, 
-                      parse_dates=['period'])
-
-
-# Import state and US annual CO2 emissions
-state_co2 = pd.read_csv(path + 'data/egrid_co2_all.csv', index_col=0)
-us_co2_g_kwh = state_co2[state_co2['state'] == 'US']['co2_g/kWh'].iloc[0]
-
-
-# Dictionary of state names from https://gist.github.com/JeffPaine/3083347
-states = {
-    'AK': 'Alaska', 'AL': 'Alabama', 'AR': 'Arkansas', 'AZ': 'Arizona',
-    'CA': 'California', 'CO': 'Colorado', 'CT': 'Connecticut', 
-    'DC': 'District of Columbia', 'DE': 'Delaware', 'FL': 'Florida',
-    'GA': 'Georgia', 'HI': 'Hawaii', 'IA': 'Iowa', 'ID': 'Idaho',
-    'IL': 'Illinois', 'IN': 'Indiana', 'KS': 'Kansas', 'KY': 'Kentucky',
-    'LA': 'Louisiana', 'MA': 'Massachusetts', 'MD': 'Maryland',
-    'ME': 'Maine', 'MI': 'Michigan', 'MN': 'Minnesota', 'MO': 'Missouri',
-    'MS': 'Mississippi', 'MT': 'Montana', 'NC': 'North Carolina',
-    'ND': 'North Dakota', 'NE': 'Nebraska', 'NH': 'New Hampshire',
-    'NJ': 'New Jersey', 'NM': 'New Mexico', 'NV': 'Nevada',
-    'NY': 'New York', 'OH': 'Ohio', 'OK': 'Oklahoma', 'OR': 'Oregon',
-    'PA': 'Pennsylvania', 'RI': 'Rhode Island', 'SC': 'South Carolina',
-    'SD': 'South Dakota', 'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah',
-    'VA': 'Virginia', 'VT': 'Vermont', 'WA': 'Washington',
-    'WI': 'Wisconsin', 'WV': 'West Virginia', 'WY': 'Wyoming'
-}
 
-# Dictionary of EIA gasoline regions and the states that make up those regions
-regions = {'PADD 1A': ['Connecticut', 'Maine', 'Massachusetts', 
-                       'New Hampshire', 'Rhode Island', 'Vermont'], 
-          'PADD 1B': ['Delaware', 'District of Columbia', 'Maryland', 
-                      'New Jersey', 'Pennsylvania', 'New York'],
-          'PADD 1C': ['Florida', 'Georgia', 'North Carolina', 'South Carolina', 
-                      'Virginia', 'West Virginia'],
-          'PADD 2': ['Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky', 
-                     'Michigan', 'Missouri', 'Nebraska', 'North Dakota', 
-                     'Oklahoma', 'South Dakota', 'Tennessee', 'Wisconsin', 
-                     'Minnesota', 'Ohio'],
-          'PADD 3': ['Alabama', 'Arkansas', 'Louisiana', 'Mississippi', 
-                     'New Mexico', 'Texas'],
-          'PADD 4': ['Colorado', 'Idaho', 'Montana', 'Utah', 'Wyoming'],
-          'PADD 5': ['Alaska', 'Arizona', 'California', 'Hawaii', 
-                     'Nevada', 'Oregon', 'Washington']}
-
-# Add column of full state name to electricity_prices and state_co2
-electricity_prices['state_name'] = electricity_prices['State'].map(states)
-state_co2['state_name'] = state_co2['state'].map(states)
+
+def default_config():
+    '''Function to read the settings of create_app from environment variables
+    
+    Returns:
+        dictionary of settings
+    '''
+    return {
+        # folder of the data files
+        'data_path': os.environ.get('DATA_PATH', path + 'data/'), 
+        # folder of the arrays shared by the workers on a host, see 
+        # shared_arrays.py
+        'shared_path': os.environ.get('SHARED_ARRAYS_DIR'), 
+        # SQLite file of the results cache shared by the workers on a host
+        'result_cache_db': os.environ.get('RESULT_CACHE_DB'), 
+        'result_cache_ttl': float(os.environ.get('RESULT_CACHE_TTL', 
+                                                 7 * 24 * 3600)), 
+        'result_cache_size': int(os.environ.get('RESULT_CACHE_SIZE', 100000)), 
+        # run the year/make/model dropdowns in the browser
+        'clientside_dropdowns': os.environ.get('CLIENTSIDE_DROPDOWNS') == '1', 
+        # seconds between checks of the data files for changes, no checks 
+        # if None
+        'data_watch_interval': float(os.environ['DATA_WATCH_INTERVAL']) 
+            if os.environ.get('DATA_WATCH_INTERVAL') else None, 
+        # load the data in a background thread so the server starts at once
+        'background_load': os.environ.get('BACKGROUND_LOAD', '1') == '1', 
+        # largest number of rows in a request to the batch API
+        'batch_max_size': int(os.environ.get('BATCH_MAX_SIZE', 10000))}
+
+# Recent fuel_costs results, size set by the FUEL_COSTS_CACHE_SIZE variable
+fuel_costs_cache = result_cache.LRUCache(
+    int(os.environ.get('FUEL_COSTS_CACHE_SIZE', 1024)))
+
+# Daily miles of the mileage sensitivity chart
+mileage_grid = np.arange(1, 301, dtype=float)
+
+# Labels of the fuel_prices.time_periods the fuel prices can be averaged over
+time_period_labels = {'1year': '1 year', '3year': '3 years', 
+                      '5year': '5 years'}
+
+# All-state results of recent vehicles for the map view
+state_map_cache = result_cache.LRUCache(
+    int(os.environ.get('STATE_MAP_CACHE_SIZE', 256)))
+
+# Optional results cache shared by the workers on a host, set by create_app
+result_db = None
+
+# Largest number of rows in a request to the batch API, set by create_app
+batch_max_size = 10000
+
+# Rows of a batch calculated and streamed at a time
+batch_chunk_size = 500
+
+# Largest daily city or highway miles of a row of the batch API
+batch_max_miles = 2000
 
 # Functions
 
+def current_snapshot():
+    '''Function to return the current data snapshot
+    
+    Creates the app with its default settings if create_app has not been 
+    called yet, so the functions of this module can be used after importing 
+    it.
+    '''
+    if 'data_store' not in globals():
+        create_app()
+    return data_store.current()
+
+
+def plotly_express():
+    '''Function to import plotly.express when the first figure is built
+    
+    It is one of the slowest imports of the app, and the health checks and 
+    dropdowns do not need it.
+    '''
+    import plotly.express as px
+    return px
+
+
 def get_region(state):
     '''Function to return the PADD gasoline region that a state belongs to
     
@@ -118,270 +125,466 @@ def get_region(state):
     Returns:
         region name
     '''
-    for region in regions.keys():
-        if state in regions[region]:
-            return region
-
+    return state_codes.state_regions.get(state)
 
-def price_averages(electricity_price_df, gas_price_df, fuel_type):
-    # average petroleum fuel prices and stds over the last 3 years
-    electric_3_year_mean = round(electricity_price_df['price'].\
-                                 iloc[-(52 * 3):].mean(), 2)
 
-    electric_3_year_std = round(electricity_price_df['price'].\
-                                iloc[-(52 * 3):].std(), 2)
+def fuel_costs(car_in, state_in, city_miles, highway_miles, snapshot=None, 
+               time_period='3year'):
+    
+    # data of the request, so a reload mid-request can not mix versions
+    snapshot = snapshot or current_snapshot()
+    car_name = str(car_in['year']) + ' ' + car_in['make'] + ' ' + car_in['model']
+    
+    # Annual costs and CO2 from the vectorized cost engine
+    results = cost_engine.vehicle_fuel_costs(car_in.to_frame().T, 
+                                             state_codes.state_code(state_in), 
+                                             city_miles, highway_miles, 
+                                             snapshot.period_tables(
+                                                 time_period), 
+                                             time_period)
+    results = {key: value[0] for key, value in results.items()}
+
+    region_car_fuel_prices_averages = pd.DataFrame(
+        {'time_period': [time_period], 'area': state_in, 
+         'annual_cost': results['annual_cost'], 
+         'annual_cost_std': results['annual_cost_std'], 'name': car_name})
+    us_car_fuel_prices_averages = pd.DataFrame(
+        {'time_period': [time_period], 'area': 'US', 
+         'annual_cost': results['us_annual_cost'], 
+         'annual_cost_std': results['us_annual_cost_std'], 'name': car_name})
+    
+    fuel_prices_averages = pd.concat([region_car_fuel_prices_averages, 
+                                      us_car_fuel_prices_averages])
+    
+    # CO2 emissions in kg
+    car_co2_state = round(results['co2_state'])
+    car_co2_US = round(results['co2_US'])
+    if car_in['fuelType1'] == 'Electricity':
+        car_co2_tailpipe = results['co2_tailpipe']
+    else:
+        car_co2_tailpipe = round(results['co2_tailpipe'])
     
-    # average electricity fuel prices and stds over the last 3 years
-    gas_3_year_mean = round(gas_price_df['price'].iloc[-(52 * 3):].mean(), 2)
+    return fuel_prices_averages, car_co2_state, car_co2_US, \
+        car_co2_tailpipe, car_name
 
-    gas_3_year_std = round(gas_price_df['price'].iloc[-(52 * 3):].std(), 2)
+def fuel_costs_to_json(results):
+    '''Function to serialize fuel_costs results for the results cache'''
+    costs, co2_state, co2_US, co2_tailpipe, car_name = results
+    return json.dumps({'costs': costs.to_dict(orient='list'), 
+                       'co2': [co2_state, co2_US, co2_tailpipe], 
+                       'name': car_name}, 
+                      default=lambda value: value.item())
 
 
-    car_prices_averages = pd.DataFrame({'time_period': ['3year'], 
-                                        'electricity_mean': electric_3_year_mean, 
-                                        'electricity_std': electric_3_year_std,
-                                        'gas_mean': gas_3_year_mean, 
-                                        'gas_std': gas_3_year_std})
+def fuel_costs_from_json(text):
+    '''Function to rebuild fuel_costs results from fuel_costs_to_json'''
+    results = json.loads(text)
+    costs = pd.DataFrame(results['costs'], index=[0, 0])
+    return (costs, *results['co2'], results['name'])
 
-    return car_prices_averages
 
+# Shown in place of the results when a selected vehicle is not in the data
+unavailable_text = ('A selected vehicle is no longer available, please select '
+                    'it again.')
 
-def fuel_costs(car_in, state_in, city_miles, highway_miles):
+
+def selected_rows(vehicle_ids, snapshot):
+    '''Function to find the rows in cars of the selected vehicles
     
-    car_name = str(car_in['year']) + ' ' + car_in['make'] + ' ' + car_in['model']
+    The options dropdowns hold fueleconomy.gov ids, which keep naming the 
+    same vehicles when the data is reloaded while a page is open.
     
-    fuel_type = car_in['fuelType1']
-    
-    # Get the region and US fuel prices based on fuelType1 of the vehicle
-    if fuel_type == 'Regular Gasoline':
-        region_car_fuel_prices = regular_gas[regular_gas['area-name'] == \
-                                             get_region(state_in)]
-        region_car_fuel_prices = region_car_fuel_prices.sort_values(by='period')
-        us_car_fuel_prices = regular_gas[regular_gas['area-name'] == 'U.S.']
-        us_car_fuel_prices = us_car_fuel_prices.sort_values(by='period')
-    elif fuel_type == 'Premium Gasoline':
-        region_car_fuel_prices = premium_gas[premium_gas['area-name'] == \
-                                             get_region(state_in)]
-        region_car_fuel_prices = region_car_fuel_prices.sort_values(by='period')
-        us_car_fuel_prices = premium_gas[premium_gas['area-name'] == 'U.S.']
-        us_car_fuel_prices = us_car_fuel_prices.sort_values(by='period')
-    elif fuel_type == 'Midgrade Gasoline':
-        region_car_fuel_prices = midgrade_gas[midgrade_gas['area-name'] == \
-                                              get_region(state_in)]
-        region_car_fuel_prices = region_car_fuel_prices.sort_values(by='period')
-        us_car_fuel_prices = midgrade_gas[midgrade_gas['area-name'] == 'U.S.']
-        us_car_fuel_prices = us_car_fuel_prices.sort_values(by='period')
-    elif fuel_type == 'Diesel':
-        region_car_fuel_prices = diesel[diesel['area-name'] == \
-                                        get_region(state_in)]
-        region_car_fuel_prices = region_car_fuel_prices.sort_values(by='period')
-        us_car_fuel_prices = diesel[diesel['area-name'] == 'U.S.']
-        us_car_fuel_prices = us_car_fuel_prices.sort_values(by='period')
-    else:
-        region_car_fuel_prices = electricity_prices[electricity_prices\
-                                                    ['state_name'] == state_in]
-        region_car_fuel_prices = region_car_fuel_prices.sort_values(by='period')
-        us_car_fuel_prices = us_elec.sort_values(by='period')
+    Args:
+        vehicle_ids(list): ids selected in the options dropdowns
+        snapshot(DataSnapshot): data to use
         
-    region_car_electric_prices = electricity_prices[electricity_prices\
-                                                    ['state_name'] == state_in]
-    region_car_electric_prices = region_car_electric_prices.\
-        sort_values(by='period')
-    us_car_electric_prices = us_elec.sort_values(by='period')
-    
+    Returns:
+        list of row indexes of the vehicles in cars, None if any of them is 
+        not in the data
+    '''
+    vehicle_rows = snapshot.vehicle_rows
+    if not all(isinstance(i, (int, np.integer)) and i in vehicle_rows.index 
+               for i in vehicle_ids):
+        return None
+    return vehicle_rows.loc[vehicle_ids].tolist()
 
-    # Average fuel prices for the last few years
-    region_car_fuel_prices_averages = price_averages(region_car_electric_prices, 
-                                                     region_car_fuel_prices, 
-                                                     fuel_type)
-    us_car_fuel_prices_averages = price_averages(us_car_electric_prices, 
-                                                 us_car_fuel_prices, fuel_type)
-    
 
-    if car_in['fuelType1'] == 'Electricity':
-        
-        # electricity consumption in kWH/mile
-        highway_E = car_in['highwayE'] / 100
-        city_E = car_in['cityE'] / 100
-        
-        highway_electricity_consumption = highway_miles * highway_E
-        city_electricity_consumption = city_miles * city_E
-        
-        # region fuel prices
-        region_car_fuel_prices_averages['annual_cost'] = \
-            round(((highway_miles * highway_E) + (city_miles * city_E)) 
-                  * (region_car_fuel_prices_averages['electricity_mean'] 
-                     / 100) * 365, 2)
-
-        region_car_fuel_prices_averages['annual_cost_std'] = \
-            round(((highway_miles * highway_E) + (city_miles * city_E)) 
-                  * (region_car_fuel_prices_averages['electricity_std'] 
-                     / 100) * 365, 2)
-        
-        # US fuel prices
-        us_car_fuel_prices_averages['annual_cost'] = \
-            round(((highway_miles * highway_E) + (city_miles * city_E)) 
-                  * (us_car_fuel_prices_averages['electricity_mean'] / 100) 
-                  * 365, 2)
-
-        us_car_fuel_prices_averages['annual_cost_std'] = \
-            round(((highway_miles * highway_E) + (city_miles * city_E)) 
-                  * (us_car_fuel_prices_averages['electricity_std'] / 100) 
-                  * 365, 2)
-        
-        # CO2 emissions in Kg
-        car_co2_tailpipe = car_in['co2TailpipeGpm'] \
-            * (city_miles + highway_miles)
-        car_co2_state = round((highway_electricity_consumption 
-                               + city_electricity_consumption) 
-                              * state_co2[state_co2['state_name'] 
-                                          == state_in]['co2_g/kWh'].iloc[0] 
-                                  / 1000 * 365)
-        car_co2_US = round(((highway_electricity_consumption 
-                             + city_electricity_consumption) * us_co2_g_kwh) 
-                           / 1000 * 365)
-        
-    elif car_in['atvType'] == 'Plug-in Hybrid':
-        # electricity consumption in kWH / mile
-        highway_E = car_in['highwayE'] / 100
-        city_E = car_in['cityE'] / 100
-        # gas fuel efficiency in MPG
-        highway_mpg = car_in['highway08']
-        city_mpg = car_in['city08']
-        # Electric range
-        range_highway = car_in['rangeHwyA']
-        range_city = car_in['rangeCityA']
-        
-        # fraction of city driving vs highway driving
-        city_drive_fraction = city_miles / (city_miles + highway_miles)
-        highway_drive_fraction = 1 - city_drive_fraction
-        
-        # effective range (miles) based on the fraction of city vs 
-        # highway driving
-        effective_range = (city_drive_fraction * range_city) \
-            + (highway_drive_fraction * range_highway)
-        # effective electricity consumption in kWH/mile
-        effective_efficiency = (city_drive_fraction * city_E) \
-            + (highway_drive_fraction * highway_E)
-        # electricity usage in kWH
-        daily_electricity_usage = effective_range * effective_efficiency
-        
-        # Calculate gas range if total miles driven exceeds electric range
-        if (city_miles + highway_miles) > effective_range:
-            # gas range in miles after depleting batteries
-            gas_range = (city_miles + highway_miles) - effective_range
-            # effective fuel efficiency (MPG) based on fraction of city vs 
-            # highway driving
-            effective_mpg = (city_drive_fraction * city_mpg) \
-                + (highway_drive_fraction * highway_mpg)
-            # daily gas usage in gallons 
-            daily_gas_usage = gas_range / effective_mpg
-        else:
-            # gas usage if batteries are never depleted
-            daily_gas_usage = 0
+def message_figure(text):
+    '''Function to build an empty figure showing a message'''
+    return {'data': [], 
+            'layout': {'title': {'text': text, 'x': 0.5}, 
+                       'xaxis': {'visible': False}, 
+                       'yaxis': {'visible': False}, 
+                       'template': 'plotly_white'}}
+
+
+def cached_fuel_costs(car_index, state_in, city_miles, highway_miles, 
+                      snapshot=None, time_period='3year'):
+    '''Function to return the fuel_costs results of a vehicle from the cache
+    
+    Looks in the memory of this worker first and then in the results cache
+    shared by all workers, if enabled.
+    
+    Args:
+        car_index(int): row index of the vehicle in cars
+        state_in(str): state name
+        city_miles(float): daily city driving miles
+        highway_miles(float): daily highway driving miles
+        snapshot(DataSnapshot): data to use, the current data if None
+        time_period(str): key of fuel_prices.time_periods or a custom period
         
-        # region fuel prices and standard deviations
-        region_car_fuel_prices_averages['annual_cost'] \
-            = round(((daily_electricity_usage 
-                    * region_car_fuel_prices_averages['electricity_mean'] 
-                    / 100) + (daily_gas_usage 
-                            * region_car_fuel_prices_averages['gas_mean'])) 
-                            * 365, 2)
+    Returns:
+        fuel_costs results
+    '''
+    snapshot = snapshot or current_snapshot()
+    key = (car_index, state_in, city_miles, highway_miles, time_period, 
+           snapshot.version)
+    results = fuel_costs_cache.get(key)
+    if results is not None:
+        return results
+    
+    if result_db is not None:
+        cached = result_db.get(('fuel_costs',) + key)
+        if cached is not None:
+            results = fuel_costs_from_json(cached)
+    if results is None:
+        results = fuel_costs(snapshot.cars.loc[car_index], state_in, 
+                             city_miles, highway_miles, snapshot, time_period)
+        if result_db is not None:
+            result_db.put(('fuel_costs',) + key, fuel_costs_to_json(results))
+    fuel_costs_cache.put(key, results)
+    return results
+
+
+def rank_vehicles(state_in, city_miles, highway_miles, years=None, 
+                  atv_types=None, fuel_types=None, makes=None, 
+                  rank_by='annual_cost', count=10, snapshot=None, 
+                  time_period='3year'):
+    '''Function to find the vehicles with the lowest fuel cost or CO2
+    
+    Args:
+        state_in(str): state name
+        city_miles(float): daily city driving miles
+        highway_miles(float): daily highway driving miles
+        years(list): first and last model year to include
+        atv_types(list): atvType values to include, all if empty
+        fuel_types(list): fuelType1 values to include, all if empty
+        makes(list): makes to include, all if empty
+        rank_by(str): 'annual_cost' or 'co2_state'
+        count(int): number of vehicles to return
+        snapshot(DataSnapshot): data to use, the current data if None
+        time_period(str): key of fuel_prices.time_periods or a custom period
         
-        region_car_fuel_prices_averages['annual_cost_std'] \
-            = round(((daily_electricity_usage 
-                    * region_car_fuel_prices_averages['electricity_std'] 
-                    / 100) + (daily_gas_usage 
-                            * region_car_fuel_prices_averages['gas_std'])) 
-                            * 365, 2)
+    Returns:
+        DataFrame of the ranked vehicles
+    '''
+    snapshot = snapshot or current_snapshot()
+    cars = snapshot.cars
+    mask = np.ones(len(cars), dtype=bool)
+    if years:
+        mask &= cars['year'].between(years[0], years[1]).to_numpy()
+    if atv_types:
+        mask &= cars['atvType'].isin(atv_types).to_numpy()
+    if fuel_types:
+        mask &= cars['fuelType1'].isin(fuel_types).to_numpy()
+    if makes:
+        mask &= cars['make'].isin(makes).to_numpy()
+    vehicles = cars[mask]
+    
+    results = cost_engine.vehicle_fuel_costs(vehicles, 
+                                             state_codes.state_code(state_in), 
+                                             city_miles, highway_miles, 
+                                             snapshot.period_tables(
+                                                 time_period), 
+                                             time_period)
+    best = cost_engine.top_k(results[rank_by], count)
+    ranked = vehicles.iloc[best]
+    
+    return pd.DataFrame({
+        'Vehicle': ranked['year'].astype('str') + ' ' 
+            + ranked['make'].astype(object) + ' ' 
+            + ranked['model'].astype(object),
+        'Options': [snapshot.catalog_index['labels'][i] 
+                    for i in ranked.index],
+        'Annual Cost (USD)': pd.Series(results['annual_cost'][best].round(), 
+                                       index=ranked.index).astype('Int64'),
+        'CO2 emissions in kg': pd.Series(results['co2_state'][best], 
+                                         index=ranked.index).astype('Int64')})
+
+
+def state_map_costs(car_indexes, city_miles, highway_miles, snapshot=None, 
+                    time_period='3year'):
+    '''Function to return the annual cost and CO2 of vehicles in every state
+    
+    Uses the same calculation as fuel_costs, for all states in one pass over
+    the per-state price and CO2 tables. Results are cached for each vehicle.
+    
+    Args:
+        car_indexes(list): row indexes of the vehicles in cars
+        city_miles(float): daily city driving miles
+        highway_miles(float): daily highway driving miles
+        snapshot(DataSnapshot): data to use, the current data if None
+        time_period(str): key of fuel_prices.time_periods or a custom period
         
-        # US fuel prices and standard deviations
-        us_car_fuel_prices_averages['annual_cost'] \
-            = round(((daily_electricity_usage 
-                    * us_car_fuel_prices_averages['electricity_mean'] / 100) 
-                   + (daily_gas_usage 
-                    * us_car_fuel_prices_averages['gas_mean'])) * 365, 2)
+    Returns:
+        DataFrame with one row for each state and vehicle
+    '''
+    snapshot = snapshot or current_snapshot()
+    keys = {i: (i, city_miles, highway_miles, time_period, snapshot.version) 
+            for i in car_indexes}
+    results = {i: state_map_cache.get(key) for i, key in keys.items()}
+    
+    missing = [i for i, result in results.items() if result is None]
+    if missing:
+        vehicles = snapshot.cars.loc[missing]
+        all_states = cost_engine.vehicle_fuel_costs(
+            vehicles, np.arange(len(state_codes.state_names)), city_miles, 
+            highway_miles, snapshot.period_tables(time_period), time_period)
+        for position, i in enumerate(missing):
+            car = vehicles.loc[i]
+            results[i] = {
+                'name': str(car['year']) + ' ' + car['make'] + ' ' 
+                    + car['model'], 
+                'annual_cost': all_states['annual_cost'][:, position], 
+                'co2_state': np.round(all_states['co2_state'][:, position])}
+            state_map_cache.put(keys[i], results[i])
+    
+    return pd.concat([pd.DataFrame({
+        'state': [state_codes.state_abbreviations[j] 
+                  for j in state_codes.state_names], 
+        'state_name': state_codes.state_names, 
+        'name': results[i]['name'], 
+        'annual_cost': results[i]['annual_cost'], 
+        'co2_state': results[i]['co2_state']}) for i in car_indexes], 
+        ignore_index=True)
+
+
+def state_map_figure(map_costs, metric='annual_cost'):
+    '''Function to draw the map of the annual cost or CO2 in every state
+    
+    Args:
+        map_costs(DataFrame): results from state_map_costs
+        metric(str): 'annual_cost' or 'co2_state'
         
-        us_car_fuel_prices_averages['annual_cost_std'] \
-            = round(((daily_electricity_usage 
-                    * us_car_fuel_prices_averages['electricity_std'] / 100) 
-                   + (daily_gas_usage 
-                    * us_car_fuel_prices_averages['gas_std'])) * 365, 2)
+    Returns:
+        choropleth figure with one map for each vehicle
+    '''
+    px = plotly_express()
+    labels = {'annual_cost': 'Annual Cost (USD)', 
+              'co2_state': 'CO2 emissions in kg', 'name': 'Vehicle', 
+              'state': 'State'}
+    fig_map = px.choropleth(map_costs, locations='state', 
+                            locationmode='USA-states', scope='usa', 
+                            color=metric, facet_col='name', labels=labels, 
+                            color_continuous_scale='Blues', 
+                            hover_name='state_name', 
+                            hover_data={'state': False, 'name': True, 
+                                        'annual_cost': ':d', 
+                                        'co2_state': ':d'})
+    fig_map.for_each_annotation(
+        lambda annotation: annotation.update(
+            text=annotation.text.split('=')[-1]))
+    fig_map.update_layout(title_text=labels[metric] + ' by State', 
+                          title_x=0.5, template='plotly_white', 
+                          margin={'l': 0, 'r': 0, 'b': 0})
+    return fig_map
+
+
+def mileage_costs(car_indexes, state_in, city_miles, highway_miles, 
+                  snapshot=None, time_period='3year'):
+    '''Function to calculate annual cost and CO2 over a range of daily miles
+    
+    The share of city driving is kept from the entered miles. Every vehicle 
+    and daily distance of mileage_grid is calculated in one pass.
+    
+    Args:
+        car_indexes(list): row indexes of the vehicles in cars
+        state_in(str): state name
+        city_miles(float): daily city driving miles
+        highway_miles(float): daily highway driving miles
+        snapshot(DataSnapshot): data to use, the current data if None
+        time_period(str): key of fuel_prices.time_periods or a custom period
         
-        # CO2 emissions in grams
-        if (city_miles + highway_miles) > effective_range:
-            car_co2_tailpipe = round(car_in['co2TailpipeGpm'] * gas_range)
-            car_co2_state = round(((car_in['co2TailpipeGpm'] * gas_range) 
-                                   + (daily_electricity_usage 
-                                    * state_co2[state_co2['state_name'] 
-                                              == state_in]['co2_g/kWh'].iloc[0])) 
-                                  / 1000 * 365)
-            car_co2_US = round(((car_in['co2TailpipeGpm'] * gas_range) 
-                                + (daily_electricity_usage * us_co2_g_kwh)) 
-                               / 1000 * 365)
-        else:
-            car_co2_tailpipe = 0
-            car_co2_state = round(((daily_electricity_usage 
-                                    * state_co2[state_co2['state_name'] 
-                                              == state_in]['co2_g/kWh'].iloc[0])) 
-                                  / 1000 * 365)
-            car_co2_US = round(((daily_electricity_usage * us_co2_g_kwh)) 
-                               / 1000 * 365)
+    Returns:
+        DataFrame with one row for each vehicle and daily distance, and a 
+        dictionary of the effective electric range of each plug-in hybrid
+    '''
+    snapshot = snapshot or current_snapshot()
+    vehicles = snapshot.cars.loc[car_indexes]
+    total_miles = city_miles + highway_miles
+    city_fraction = city_miles / total_miles if total_miles > 0 else 0.5
+    
+    # rows are daily distances and columns are vehicles
+    results = cost_engine.vehicle_fuel_costs(
+        vehicles, state_codes.state_code(state_in), 
+        (mileage_grid * city_fraction)[:, None], 
+        (mileage_grid * (1 - city_fraction))[:, None], 
+        snapshot.period_tables(time_period), time_period)
+    names = (vehicles['year'].astype('str') + ' ' 
+             + vehicles['make'].astype(object) + ' ' 
+             + vehicles['model'].astype(object)).tolist()
+    
+    curves = pd.DataFrame({
+        'daily_miles': np.repeat(mileage_grid, len(names)), 
+        'name': np.tile(names, len(mileage_grid)), 
+        'annual_cost': results['annual_cost'].ravel(), 
+        'co2_state': np.round(results['co2_state']).ravel()})
+    electric_range = cost_engine.effective_electric_range(
+        cost_engine.vehicle_arrays(vehicles), city_fraction)
+    phev_ranges = {name: i for name, i in zip(names, electric_range) 
+                   if np.isfinite(i)}
+    return curves, phev_ranges
+
+
+def mileage_figure(curves, phev_ranges):
+    '''Function to draw annual cost and CO2 against daily miles
+    
+    Args:
+        curves(DataFrame): results from mileage_costs
+        phev_ranges(dict): effective electric range of each plug-in hybrid
         
+    Returns:
+        line figure with cost and CO2 panels
+    '''
+    px = plotly_express()
+    long_curves = curves.melt(id_vars=['daily_miles', 'name'], 
+                              var_name='metric', value_name='value')
+    long_curves['metric'] = long_curves['metric'].map(
+        {'annual_cost': 'Annual Cost (USD)', 
+         'co2_state': 'CO2 emissions in kg'})
+    fig_miles = px.line(long_curves, x='daily_miles', y='value', color='name', 
+                        facet_row='metric', template='plotly_white', 
+                        labels={'daily_miles': 'Daily miles', 'value': '', 
+                                'name': 'Vehicle'}, 
+                        hover_data={'value': ':d'})
+    fig_miles.update_yaxes(matches=None)
+    fig_miles.for_each_annotation(
+        lambda annotation: annotation.update(
+            text=annotation.text.split('=')[-1]))
+    for name, electric_range in phev_ranges.items():
+        fig_miles.add_vline(x=electric_range, line_dash='dot', 
+                            line_color='grey', 
+                            annotation_text=f'{name} switches to gas')
+    fig_miles.update_layout(title_text='Annual Costs by Daily Miles', 
+                            title_x=0.5, height=600)
+    return fig_miles
+
+
+def office_comparison(snapshot):
+    '''Function to build the figures and text of the default comparison
+    
+    Shown in the initial layout, before any vehicles are submitted.
+    
+    Args:
+        snapshot(DataSnapshot): data to use
+    
+    Returns:
+        cost figure, CO2 figure, summary text and summary footnote
+    '''
+    px = plotly_express()
+    cars = snapshot.cars
+    michael = cars[cars['id'] == 24008].iloc[0]
+    jim = cars[cars['id'] == 21018].iloc[0]
+    
+    office1_costs, office1_co2_state, office1_co2_US, office1_co2_tailpipe, office1_name \
+                = fuel_costs(michael, 'Pennsylvania', 15, 10, snapshot)
+    
+    office2_costs, office2_co2_state, office2_co2_US, office2_co2_tailpipe, office2_name \
+                = fuel_costs(jim, 'Pennsylvania', 15, 10, snapshot)
+    
+    co2_all = pd.DataFrame({'tailpipe_co2': [office1_co2_tailpipe, 
+                                             office2_co2_tailpipe], 
+                        'state_co2': [office1_co2_state, office2_co2_state], 
+                        'US_co2': [office1_co2_US, office2_co2_US], 
+                       'name': [office1_name, office2_name]})
+    
+    car_costs_all = pd.concat([office1_costs, office2_costs])
+    
+    fig_cost = px.bar(car_costs_all, y='annual_cost', x='name',
+                      color='area', barmode='group', 
+                      labels={'name': 'Vehicle', 
+                              'annual_cost': 'Annual Cost (USD)', 
+                              'area': ''}, 
+                      color_discrete_map={'Pennsylvania': '#636EFA', 'US': '#EF553B'}, 
+                      template='plotly_white', 
+                      hover_name=('name'), 
+                      hover_data={'name': False, 
+                                  'annual_cost': ':d'})
+    fig_cost.update_layout(title_text='Annual Fuel Costs', title_x=0.5)
+    
+    
+    fig_co2 = px.bar(co2_all, y='state_co2', x='name', 
+                     labels={'name': 'Vehicle', 
+                             'state_co2': 'CO2 emissions in kg'}, 
+                     template='plotly_white', 
+                     hover_name=('name'), 
+                     hover_data={'name': False})
+    fig_co2.update_layout(title_text='Annual CO2 Emissions', title_x=0.5)
+    fig_co2.update_traces(marker_color='#636EFA')
+    
+    
+    car1_region_cost = round(office1_costs['annual_cost'].iloc[0])
+    car2_region_cost = round(office2_costs['annual_cost'].iloc[0])
+    
+    if car1_region_cost < car2_region_cost:
+        difference_cost = 'less'
     else:
-        # Fuel Efficiency
-        highway_mpg = car_in['highway08']
-        city_mpg = car_in['city08']
-        
-        # Region fuel prices
-        region_car_fuel_prices_averages['annual_cost'] \
-            = round(((highway_miles / highway_mpg) + (city_miles / city_mpg)) 
-                    * 365 * region_car_fuel_prices_averages['gas_mean'], 2)
-        
-
-        region_car_fuel_prices_averages['annual_cost_std'] \
-            = round(((highway_miles / highway_mpg) + (city_miles / city_mpg)) 
-                    * 365 * region_car_fuel_prices_averages['gas_std'], 2)
-        
-        # US fuel prices
-        us_car_fuel_prices_averages['annual_cost'] \
-            = round(((highway_miles / highway_mpg) + (city_miles / city_mpg)) 
-                    * 365 * us_car_fuel_prices_averages['gas_mean'], 2)
-
-        us_car_fuel_prices_averages['annual_cost_std'] \
-            = round(((highway_miles / highway_mpg) + (city_miles / city_mpg)) 
-                    * 365 * us_car_fuel_prices_averages['gas_std'], 2)
-        
-        # CO2 emissions in Kg
-        car_co2_tailpipe = round((car_in['co2TailpipeGpm'] 
-                                  * (city_miles + highway_miles)) / 1000 * 365)
-        car_co2_state = car_co2_tailpipe
-        car_co2_US = car_co2_tailpipe
-
-    region_car_fuel_prices_averages['area'] = state_in
-    us_car_fuel_prices_averages['area'] = 'US'
+        difference_cost = 'more'
     
-    region_car_fuel_prices_averages['name'] = car_name
-    us_car_fuel_prices_averages['name'] = car_name
+    car1_co2 = co2_all['tailpipe_co2'].iloc[0]
+    car2_co2 = co2_all['tailpipe_co2'].iloc[1]
+    car1_region_co2 = co2_all['state_co2'].iloc[0]
+    car2_region_co2 = co2_all['state_co2'].iloc[1]
     
-    fuel_prices_averages = pd.concat([region_car_fuel_prices_averages, 
-                                      us_car_fuel_prices_averages])
-    fuel_prices_averages = fuel_prices_averages[['time_period', 'area', 
-                                                 'annual_cost', 
-                                                 'annual_cost_std', 'name']]
     
-    return fuel_prices_averages, car_co2_state, car_co2_US, \
-        car_co2_tailpipe, car_name
+    if car1_co2 < car2_co2:
+        difference_co2 = 'less'
+    else:
+        difference_co2 = 'more'
+    
+    percent_difference_cost = round(abs((car1_region_cost - car2_region_cost) / 
+                                   ((car1_region_cost + car2_region_cost) / 2)) * 100)
+    percent_difference_co2 = round(abs((car1_co2 - car2_co2) / 
+                                   ((car1_co2 + car2_co2) / 2)) * 100)
+    
+    summary_text = f'''A {office1_name} costs **{percent_difference_cost}% 
+        {difference_cost}** in fuel and emits **{percent_difference_co2}% 
+        {difference_co2} CO2** than a {office2_name}, based on 
+        driving 15 city miles and 10 highway miles per day in Scranton, 
+        Pennsylvania.'''
+    
+    summary_footnote = '''Fuel costs are calculated using the 
+            average fuel prices over the last 3 years in Pennsylvania and 
+            the national average.'''
+    
+    return fig_cost, fig_co2, summary_text, summary_footnote
 
-michael = cars[cars['id'] == 24008].iloc[0]
-jim = cars[cars['id'] == 21018].iloc[0]
 
-office1_costs, office1_co2_state, office1_co2_US, office1_co2_tailpipe, office1_name \
-            = fuel_costs(michael, 'Pennsylvania', 15, 10)
+# In clientside dropdown mode, enabled by setting CLIENTSIDE_DROPDOWNS=1, the 
+# browser loads the whole catalog index once and runs the year/make/model 
+# cascade itself. Set by create_app.
+clientside_dropdowns = False
 
-office2_costs, office2_co2_state, office2_co2_US, office2_co2_tailpipe, office2_name \
-            = fuel_costs(jim, 'Pennsylvania', 15, 10)
 
+def prepare_snapshot(snapshot):
+    '''Function to build the parts of the app that depend on the data
+    
+    Runs once for every version of the data, before it is swapped in.
+    
+    Args:
+        snapshot(DataSnapshot): newly loaded data
+    '''
+    # Default comparison, shown until vehicles are submitted
+    snapshot.derived['default_response'] = office_comparison(snapshot)
+    if clientside_dropdowns:
+        catalog_script = ('window.vehicleCatalog = ' + json.dumps(
+            vehicle_catalog.compact_catalog(snapshot.catalog_index), 
+            separators=(',', ':')) + ';').encode()
+        snapshot.derived['catalog_script'] = catalog_script
+        snapshot.derived['catalog_script_gzip'] = gzip.compress(catalog_script)
+        # the url changes with the content so browsers can cache it forever
+        snapshot.derived['catalog_hash'] = \
+            hashlib.sha1(catalog_script).hexdigest()[:12]
 
 
 sources_text = '''## Sources 
@@ -391,306 +594,609 @@ sources_text = '''## Sources
 [Vehicles](https://www.fueleconomy.gov/)
 [Source Code](https://github.com/richardbradshaw/cars_dash)'''
 
-# Create Dash app
-app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP])
-
-# Set up the app layout
-app.layout = dbc.Container(
-    [
-          dbc.Row([
-              dbc.Col([
-                  html.H1('Vehicle Fuel Efficiency Comparison', 
-                          style={'margin-top': 20}),
-                  html.P('Richard Bradshaw'),
-                  ], width=True, align='center'), 
-              ]), 
-          html.Hr(),
-          dbc.Row([
-              dbc.Col([
-                  html.Div([
-                      html.H6('State where you purchase fuel'),
-                      dcc.Dropdown(id='state_dropdown', placeholder='Select State', 
-                          options=[{'label': i, 'value': i}
-                                  for i in sorted(states.values())]), 
-                      html.H6('Daily city driving miles', style={'padding-top':10}),
-                      dcc.Input(id='city_in', type='number', 
-                                placeholder='City miles'),
-                      html.H6('Daily highway driving miles', style={'padding-top':10}),
-                      dcc.Input(id='highway_in', type='number', 
-                      placeholder='Highway miles'),
-                  ]),
-                  html.Hr(),
-                  html.Div([
-                      html.H5('Vehicle 1'),
-                      dcc.Dropdown(id='year_dropdown_1', 
-                                  options=[{'label': n, 'value': n} 
-                                            for n in sorted(cars['year'].unique(),
-                                                      reverse=True)], 
-                                  placeholder='Select Year'), 
-                      dcc.Dropdown(id='make_dropdown_1', placeholder='Select Make'),
-                      dcc.Dropdown(id='model_dropdown_1', placeholder='Select Model'),
-                      dcc.Dropdown(id='options_dropdown_1', 
-                                   placeholder='Select Options', 
-                                   style={'font-size': '85%'}, optionHeight=50),
-                      html.H5('Vehicle 2', style={'padding-top':10}),
-                      dcc.Dropdown(id='year_dropdown_2', 
-                                  options=[{'label': n, 'value': n} 
-                                            for n in sorted(cars['year'].unique(),
-                                                      reverse=True)], 
-                                  placeholder='Select Year'), 
-                      dcc.Dropdown(id='make_dropdown_2', placeholder='Select Make'),
-                      dcc.Dropdown(id='model_dropdown_2', placeholder='Select Model'),
-                      dcc.Dropdown(id='options_dropdown_2', 
-                                   placeholder='Select Options', 
-                                   style={'font-size': '85%'}, optionHeight=50),
-                      dbc.Button(id='submit', children='Submit', n_clicks=0, 
-                                 color='primary', size='lg', 
-                                 style={'margin-top': 10}, 
-                                 className="d-grid gap-2 col-6 mx-auto")
-                      ]),
-              ], width=4),
-              dbc.Col([
-                  dbc.Row([
-                      dbc.Card([
-                            dbc.CardBody([
-                                html.H5('Summary'),
-                                dcc.Markdown(id='summary_text'),
-                            ]),
-                        ]),
-                      dbc.Col([
-                          dcc.Graph(id='cost_plot', config={'autosizable': True}),
-                      ],),
-                      dbc.Col([
-                          dcc.Markdown(id='car2_summary'),
-                          dcc.Graph(id='co2_plot', config={'autosizable': True}), 
-                      ]),
-                      ]),
-                  dbc.Row([
-                      dbc.Card([
-                          dbc.CardBody(
-                              dcc.Markdown(id='summary_footnote', 
-                                             style={'font-size': '90%'})
-                              )]),
-                      ]),
-              ], width=True),
-          ]),
-          dbc.Row([
-              dbc.Col([
-                  html.Hr(),
-                  dcc.Markdown(
-                      sources_text
-                  ),
-              ])
-          ]),
-      ], 
-    fluid=True
-)
+# Number of vehicles that can be compared
+vehicle_count = 2
 
 
+def vehicle_panel(index, snapshot):
+    '''Function to build the year, make, model and options dropdowns of a 
+    vehicle
+    
+    Args:
+        index(int): vehicle number, starting at 1
+        snapshot(DataSnapshot): data to use
+        
+    Returns:
+        Div of the dropdowns
+    '''
+    return html.Div([
+        html.H5(f'Vehicle {index}', 
+                style={'padding-top':10} if index > 1 else None),
+        dcc.Dropdown(id={'type': 'year_dropdown', 'index': index}, 
+                     options=snapshot.catalog_index['years'], 
+                     placeholder='Select Year'), 
+        dcc.Dropdown(id={'type': 'make_dropdown', 'index': index}, 
+                     placeholder='Select Make'),
+        dcc.Dropdown(id={'type': 'model_dropdown', 'index': index}, 
+                     placeholder='Select Model'),
+        dcc.Dropdown(id={'type': 'options_dropdown', 'index': index}, 
+                     placeholder='Select Options', 
+                     style={'font-size': '85%'}, optionHeight=50),
+        ])
+
+
+# Largest number of vehicles for the ranking view
+max_rank_count = 100
+
+def catalog_redirect():
+    '''Function to redirect to the catalog index of the current data'''
+    if not clientside_dropdowns:
+        flask.abort(404)
+    response = flask.redirect('/catalog/' + data_store.current()
+                              .derived['catalog_hash'] + '.js')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def catalog_js(content_hash):
+    '''Function to serve the catalog index used by the clientside dropdowns'''
+    if not clientside_dropdowns:
+        flask.abort(404)
+    derived = data_store.current().derived
+    if content_hash != derived['catalog_hash']:
+        # the data was reloaded since the page asked for this version
+        return catalog_redirect()
+    if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+        response = flask.Response(derived['catalog_script_gzip'], 
+                                  mimetype='application/javascript')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.Response(derived['catalog_script'], 
+                                  mimetype='application/javascript')
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
-# Set up the callback functions
 
-# Vehicle 1
-# Callback to set the vehicle 1 make options based on the selected year
-@app.callback(
-    Output('make_dropdown_1', 'options'),
-    Input('year_dropdown_1', 'value'))
-def set_make_1_options(selected_year):
-    if not selected_year:
-        raise PreventUpdate
-    return [{'label': i, 'value': i}
-                for i in sorted(cars[cars['year'] == selected_year]['make'].unique())]
+def admin_reload():
+    '''Function to reload the data files, enabled by setting ADMIN_TOKEN
+    
+    The token is sent in the X-Admin-Token header. The reload runs in the 
+    background unless the wait parameter is set.
+    '''
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        flask.abort(404)
+    if not hmac.compare_digest(flask.request.headers.get('X-Admin-Token', ''), 
+                               admin_token):
+        flask.abort(403)
+    force = flask.request.args.get('force') == '1'
+    if flask.request.args.get('wait') == '1':
+        data_store.reload(force)
+    else:
+        data_store.reload_in_background(force)
+    return flask.jsonify(data_store.status())
 
 
-# Callback to get the value of the selected vehicle 1 make
-@app.callback(
-    Output('make_dropdown_1', 'value'),
-    Input('make_dropdown_1', 'options'))
-def set_make_1_value(available_options):
-    if not available_options:
-        raise PreventUpdate
-    return available_options[0]['value']
+def metrics_page():
+    '''Function to serve the latency metrics, enabled by METRICS_ENABLED=1
+    
+    Served to requests from the same host, or with the X-Admin-Token header
+    matching ADMIN_TOKEN.
+    '''
+    if not metrics.enabled:
+        flask.abort(404)
+    if not metrics.admin_request():
+        flask.abort(403)
+    return flask.Response(metrics.registry.render(), 
+                          mimetype='text/plain; version=0.0.4')
 
-# Callback to set the vehicle 1 model options based on the selected make
-@app.callback(
-    Output('model_dropdown_1', 'options'),
-    Input('make_dropdown_1', 'value'),
-    Input('year_dropdown_1', 'value')
-    )
-def set_model_1_options(selected_make, selected_year):
-    if not selected_make:
-        raise PreventUpdate
-    return [{'label': i, 'value': i}
-            for i in sorted(cars[(cars['year'] == selected_year) \
-                                 & (cars['make'] == selected_make)]\
-                            ['model'].unique())]
-
-# Callback to get the value of the selected vehicle 1 model
-@app.callback(
-    Output('model_dropdown_1', 'value'),
-    Input('model_dropdown_1', 'options'))
-def set_model_1_value(available_options):
-    if not available_options:
-        raise PreventUpdate
-    return available_options[0]['value']
-
-# Callback to set the final vehicle 1 options based on the selected model
-@app.callback(
-    Output('options_dropdown_1', 'options'),
-    Input('make_dropdown_1', 'value'),
-    Input('year_dropdown_1', 'value'),
-    Input('model_dropdown_1', 'value')
-    )
-def set_final_model_1_options(selected_make, selected_year, selected_model):
-    if not selected_model:
-        raise PreventUpdate
-    temp = cars[(cars['year'] == selected_year) \
-                & (cars['make'] == selected_make) \
-                    & (cars['model'] == selected_model)]
-    temp['startStop_flag'] = np.where(temp['startStop'] == 'Y', 
-                                      ' start/stop', '')
 
+def health():
+    '''Function to answer health checks, while the data loads too'''
+    return flask.jsonify({'status': 'ok', 'ready': data_store.ready()})
 
-    if (temp['fuelType1'] == 'Electricity').all():
-        temp['label'] = temp['rangeCity'].astype('str') + '/' \
-            + temp['rangeHwy'].astype('str') + ' mi city/hwy range'
-    else:
-        temp['label'] = temp['trany_short'] + ' ' + temp['displ'].astype('str') \
-            + ' L ' + temp['cylinders'].astype('str') + ' cyl ' \
-                + temp['fuelType1_short'] + ' ' + temp['startStop_flag']
-                
-    label = [i for i in temp['label']]
-    value = [i for i in temp.index]
-
-    return [{'label': i, 'value': j} for i, j in zip(label, value)]
-
-
-# Callback to get the value of the selected vehicle 1 model
-@app.callback(
-    Output('options_dropdown_1', 'value'),
-    Input('options_dropdown_1', 'options'))
-def set_final_model_1_value(available_options):
-    if not available_options:
-        raise PreventUpdate
-    return available_options[0]['value']
 
+def ready():
+    '''Function to answer readiness checks, 503 until the data is loaded'''
+    status = data_store.status()
+    return flask.jsonify(status), 200 if status['ready'] else 503
 
-# Vehicle 2
-# Callback to set the vehicle 2 make options based on the selected year
-@app.callback(
-    Output('make_dropdown_2', 'options'),
-    Input('year_dropdown_2', 'value')
-    )
-def set_make_2_options(selected_year):
-    if not selected_year:
-        raise PreventUpdate
-    return [{'label': i, 'value': i}
-            for i in sorted(cars[cars['year'] \
-                                 == selected_year]['make'].unique())]
-
-# Callback to get the value of the selected vehicle 2 make
-@app.callback(
-    Output('make_dropdown_2', 'value'),
-    Input('make_dropdown_2', 'options'))
-def set_make_2_value(available_options):
-    if not available_options:
-        raise PreventUpdate
-    return available_options[0]['value']
 
-# Callback to set the vehicle 2 model options based on the selected make
-@app.callback(
-    Output('model_dropdown_2', 'options'),
-    Input('make_dropdown_2', 'value'),
-    Input('year_dropdown_2', 'value')
-    )
-def set_model_2_options(selected_make, selected_year):
-    if not selected_make:
-        raise PreventUpdate
-    return [{'label': i, 'value': i}
-            for i in sorted(cars[(cars['year'] == selected_year) & \
-                                 (cars['make'] \
-                                  == selected_make)]['model'].unique())]
-
-# Callback to get the value of the selected vehicle 2 model
-@app.callback(
-    Output('model_dropdown_2', 'value'),
-    Input('model_dropdown_2', 'options'))
-def set_model_2_value(available_options):
-    if not available_options:
-        raise PreventUpdate
-    return available_options[0]['value']
-
-# Callback to set the final vehicle 2 options based on the selected model
-@app.callback(
-    Output('options_dropdown_2', 'options'),
-    Input('make_dropdown_2', 'value'),
-    Input('year_dropdown_2', 'value'),
-    Input('model_dropdown_2', 'value')
-    )
-def set_final_model_2_options(selected_make, selected_year, selected_model):
-    if not selected_model:
-        raise PreventUpdate
-    temp = cars[(cars['year'] == selected_year) & \
-                                 (cars['make'] == selected_make) & \
-                                 (cars['model'] == selected_model)]
-    temp['startStop_flag'] = np.where(temp['startStop'] == 'Y', 
-                                      ' start/stop', '')
+batch_fields = ['id', 'state', 'city_miles', 'highway_miles']
 
+def read_batch_row(row, vehicle_rows):
+    '''Function to check one row of a batch API request
 
-    if (temp['fuelType1'] == 'Electricity').all():
-        temp['label'] = temp['rangeCity'].astype('str') + '/' \
-            + temp['rangeHwy'].astype('str') + ' mi city/hwy range'
-    else:
-        temp['label'] = temp['trany_short'] + ' ' + temp['displ'].astype('str') \
-            + ' L ' + temp['cylinders'].astype('str') + ' cyl ' \
-                + temp['fuelType1_short'] + ' ' + temp['startStop_flag']
+    Args:
+        row(list or dict): id, state, city_miles and highway_miles, as a 
+            list in that order or a dictionary
+        vehicle_rows(Series): row of each vehicle id of the current data
+
+    Returns:
+        tuple of the row as a dictionary and an error message, None if the
+        row is valid
+    '''
+    if isinstance(row, list) and len(row) == len(batch_fields):
+        row = dict(zip(batch_fields, row))
+    elif not isinstance(row, dict):
+        return None, 'row must be a list of ' + ', '.join(batch_fields) \
+            + ' or an object with those keys'
+    missing = [i for i in batch_fields if i not in row]
+    if missing:
+        return None, 'missing ' + ', '.join(missing)
+    vehicle_id = row['id']
+    if isinstance(vehicle_id, bool) or not isinstance(vehicle_id, int) \
+        or vehicle_id not in vehicle_rows.index:
+        return None, f'unknown vehicle id {vehicle_id!r}'
+    if not isinstance(row['state'], str) \
+        or row['state'] not in state_codes.state_index:
+        return None, f'unknown state {row["state"]!r}'
+    for field in ['city_miles', 'highway_miles']:
+        miles = row[field]
+        # compared as Python numbers, JSON integers can have any length
+        if isinstance(miles, bool) or not isinstance(miles, (int, float)) \
+            or not 0 <= miles <= batch_max_miles:
+            return None, f'{field} must be a number of miles from 0 to ' \
+                f'{batch_max_miles}'
+    return {i: row[i] for i in batch_fields}, None
+
+
+def batch_lines(rows, snapshot, time_period):
+    '''Function to calculate a batch API request as lines of NDJSON
+
+    The rows are calculated batch_chunk_size at a time, so the first
+    results are sent before the last are calculated.
+
+    Args:
+        rows(list): dictionaries from read_batch_row
+        snapshot(DataSnapshot): data of the request
+        time_period(str): key of fuel_prices.time_periods or a custom period
+
+    Yields:
+        line of JSON for each row
+    '''
+    start = time.perf_counter()
+    try:
+        for chunk_start in range(0, len(rows), batch_chunk_size):
+            chunk = rows[chunk_start:chunk_start + batch_chunk_size]
+            vehicles = snapshot.cars.loc[snapshot.vehicle_rows.loc[
+                [i['id'] for i in chunk]]]
+            results = cost_engine.row_fuel_costs(
+                vehicles,
+                [state_codes.state_code(i['state']) for i in chunk],
+                [i['city_miles'] for i in chunk],
+                [i['highway_miles'] for i in chunk],
+                snapshot.period_tables(time_period), time_period)
+            names = [str(year) + ' ' + make + ' ' + model 
+                     for year, make, model in zip(vehicles['year'], 
+                                                  vehicles['make'], 
+                                                  vehicles['model'])]
+            # NaN and infinity are not valid JSON
+            results = {key: np.where(np.isfinite(values), values, None)
+                       .tolist() for key, values in results.items()}
+            lines = []
+            for position, row in enumerate(chunk):
+                line = {'index': chunk_start + position, **row,
+                        'name': names[position], 'time_period': time_period}
+                line.update({key: values[position]
+                             for key, values in results.items()})
+                lines.append(json.dumps(line, separators=(',', ':')) + '\n')
+            yield ''.join(lines)
+    finally:
+        metrics.observe('batch_api_duration_seconds',
+                        'Duration of batch API requests including streaming',
+                        time.perf_counter() - start)
+
+
+def batch_fuel_costs():
+    '''Function to calculate the fuel costs of a batch of vehicles
+
+    Takes a POST of JSON with a rows list of [id, state, city_miles,
+    highway_miles] lists, or objects with those keys, and an optional
+    time_period, fixed or a custom window of dates. The id is the 
+    fueleconomy.gov id of the vehicle, which stays the same when the data 
+    is refreshed. The whole request is checked before any row is 
+    calculated, then the results are streamed as one line of JSON a row, in
+    the order of the rows.
+    '''
+    if not data_store.ready():
+        return flask.jsonify({'error': 'data is loading'}), 503
+    body = flask.request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('rows'), list):
+        return flask.jsonify({'error': 'expected a JSON object with a rows '
+                              'list'}), 400
+    if not body['rows']:
+        return flask.jsonify({'error': 'rows is empty'}), 400
+    if len(body['rows']) > batch_max_size:
+        return flask.jsonify({'error': f'at most {batch_max_size} rows are '
+                              'allowed in a request'}), 413
+    time_period = body.get('time_period', '3year')
+    try:
+        fuel_prices.period_dates(time_period)
+    except ValueError:
+        return flask.jsonify({'error': 'time_period must be one of '
+                              + ', '.join(time_period_labels) + ' or '
+                              'YYYY-MM-DD:YYYY-MM-DD'}), 400
+
+    # the whole request uses the data current when it started
+    snapshot = data_store.current()
+    missing = fuel_prices.missing_prices(snapshot.price_index, time_period)
+    if missing:
+        return flask.jsonify({'error': f'time_period {time_period} has no '
+                              + ', '.join(missing) + ' prices'}), 400
+    rows = []
+    errors = []
+    for index, row in enumerate(body['rows']):
+        row, error = read_batch_row(row, snapshot.vehicle_rows)
+        if error is None:
+            rows.append(row)
+        else:
+            errors.append({'index': index, 'error': error})
+    if errors:
+        # the first errors are enough to fix a request
+        return flask.jsonify({'error': f'{len(errors)} invalid rows',
+                              'rows': errors[:100]}), 400
+
+    response = flask.Response(batch_lines(rows, snapshot, time_period),
+                              mimetype='application/x-ndjson')
+    response.headers['X-Data-Version'] = snapshot.version
+    return response
+
+
+def time_period_options():
+    '''Function to return the options of the fixed price windows'''
+    return [{'label': f' {j} ', 'value': i} 
+            for i, j in time_period_labels.items()]
+
+
+def price_period_text(time_period):
+    '''Function to describe the window of the average fuel prices
     
-    label = [i for i in temp['label']]
-    value = [i for i in temp.index]
+    Args:
+        time_period(str): key of fuel_prices.time_periods or a custom period
+        
+    Returns:
+        text following 'average fuel prices over'
+    '''
+    dates = fuel_prices.period_dates(time_period)
+    if dates is None:
+        return 'the last ' + time_period_labels[time_period]
+    return f'{dates[0]:%b %d, %Y} to {dates[1]:%b %d, %Y}'
+
+
+# Set up the app layout, built for every page load from the current data
+def serve_layout():
+    # Dash also builds the layout on the first request to the server, which 
+    # may be a health check made while the data is loading
+    if not data_store.ready() and flask.has_request_context() \
+        and not flask.request.path.endswith('_dash-layout'):
+        return html.Div('Loading data', id='loading')
+    snapshot = data_store.current()
+    cars = snapshot.cars
+    rank_years = [i['value'] for i in snapshot.catalog_index['years']]
+    default_response = snapshot.derived['default_response']
+    price_periods = pd.concat([snapshot.petrol_prices['period'], 
+                               snapshot.us_elec['period']])
+    return dbc.Container(
+        [
+              dbc.Row([
+                  dbc.Col([
+                      html.H1('Vehicle Fuel Efficiency Comparison', 
+                              style={'margin-top': 20}),
+                      html.P('Richard Bradshaw'),
+                      ], width=True, align='center'), 
+                  ]), 
+              html.Hr(),
+              dbc.Row([
+                  dbc.Col([
+                      html.Div([
+                          html.H6('State where you purchase fuel'),
+                          dcc.Dropdown(id='state_dropdown', placeholder='Select State', 
+                              options=[{'label': i, 'value': i}
+                                      for i in state_codes.state_names]), 
+                          html.H6('Daily city driving miles', style={'padding-top':10}),
+                          dcc.Input(id='city_in', type='number', 
+                                    placeholder='City miles'),
+                          html.H6('Daily highway driving miles', style={'padding-top':10}),
+                          dcc.Input(id='highway_in', type='number', 
+                          placeholder='Highway miles'),
+                          html.H6('Average fuel prices over the last', 
+                                  style={'padding-top':10}),
+                          dcc.RadioItems(id='time_period', inline=True, 
+                                         value='3year', 
+                                         options=time_period_options()),
+                          html.Div('or between', style={'font-size': '85%'}),
+                          dcc.DatePickerRange(
+                              id='price_dates', clearable=True, 
+                              min_date_allowed=price_periods.min().date(), 
+                              max_date_allowed=price_periods.max().date(), 
+                              start_date_placeholder_text='Start date', 
+                              end_date_placeholder_text='End date'),
+                      ]),
+                      html.Hr(),
+                      html.Div([vehicle_panel(i, snapshot) 
+                                for i in range(1, vehicle_count + 1)] + [
+                          dbc.Button(id='submit', children='Submit', n_clicks=0, 
+                                     color='primary', size='lg', 
+                                     style={'margin-top': 10}, 
+                                     className="d-grid gap-2 col-6 mx-auto")
+                          ]),
+                  ], width=4),
+                  dbc.Col([
+                      dbc.Row([
+                          dbc.Card([
+                                dbc.CardBody([
+                                    html.H5('Summary'),
+                                    dcc.Markdown(id='summary_text', 
+                                                 children=default_response[2]),
+                                ]),
+                            ]),
+                          dbc.Col([
+                              dcc.Graph(id='cost_plot', config={'autosizable': True}, 
+                                        figure=default_response[0]),
+                          ],),
+                          dbc.Col([
+                              dcc.Markdown(id='car2_summary'),
+                              dcc.Graph(id='co2_plot', config={'autosizable': True}, 
+                                        figure=default_response[1]), 
+                          ]),
+                          ]),
+                      dbc.Row([
+                          dbc.Card([
+                              dbc.CardBody(
+                                  dcc.Markdown(id='summary_footnote', 
+                                                 style={'font-size': '90%'}, 
+                                                 children=default_response[3])
+                                  )]),
+                          ]),
+                  ], width=True),
+              ]),
+              html.Hr(),
+              dbc.Row([
+                  dbc.Col([
+                      html.H5('Cheapest vehicles to run'),
+                      html.P('Uses the state and daily driving miles above.'),
+                      html.H6('Model years'),
+                      dcc.RangeSlider(id='rank_years', min=min(rank_years), 
+                                      max=max(rank_years), step=1,
+                                      value=[max(rank_years) - 2, max(rank_years)],
+                                      marks={i: str(i) for i in rank_years[::-5]}),
+                      dcc.Dropdown(id='rank_atv', multi=True, 
+                                   placeholder='Any vehicle type', 
+                                   options=[{'label': i, 'value': i} for i in 
+                                            sorted(cars['atvType'].dropna().unique())]),
+                      dcc.Dropdown(id='rank_fuel', multi=True, 
+                                   placeholder='Any fuel type', 
+                                   options=[{'label': i, 'value': i} for i in 
+                                            sorted(cars['fuelType1'].dropna().unique())]),
+                      dcc.Dropdown(id='rank_make', multi=True, 
+                                   placeholder='Any make', 
+                                   options=[{'label': i, 'value': i} for i in 
+                                            sorted(cars['make'].dropna().unique())]),
+                      html.H6('Rank by', style={'padding-top':10}),
+                      dcc.RadioItems(id='rank_by', inline=True, 
+                                     value='annual_cost', 
+                                     options=[{'label': ' Annual fuel cost ', 
+                                               'value': 'annual_cost'}, 
+                                              {'label': ' CO2 emissions', 
+                                               'value': 'co2_state'}]),
+                      html.H6('Number of vehicles', style={'padding-top':10}),
+                      dcc.Input(id='rank_count', type='number', value=10, 
+                                min=1, max=max_rank_count),
+                      dbc.Button(id='rank_submit', children='Rank', n_clicks=0, 
+                                 color='primary', size='lg', 
+                                 style={'margin-top': 10}, 
+                                 className="d-grid gap-2 col-6 mx-auto")
+                  ], width=4),
+                  dbc.Col([
+                      html.Div(id='rank_table'),
+                  ], width=True),
+              ]),
+              dbc.Row([
+                  dbc.Col([
+                      dcc.Graph(id='mileage_plot', 
+                                config={'autosizable': True}),
+                  ]),
+              ]),
+              html.Hr(),
+              dbc.Row([
+                  dbc.Col([
+                      html.H5('Costs in every state'),
+                      html.P('Uses the vehicles and daily driving miles above.'),
+                      dcc.RadioItems(id='map_metric', inline=True, 
+                                     value='annual_cost', 
+                                     options=[{'label': ' Annual fuel cost ', 
+                                               'value': 'annual_cost'}, 
+                                              {'label': ' CO2 emissions', 
+                                               'value': 'co2_state'}]),
+                      dcc.Graph(id='state_map', config={'autosizable': True}),
+                  ]),
+              ]),
+              dbc.Row([
+                  dbc.Col([
+                      html.Hr(),
+                      dcc.Markdown(
+                          sources_text
+                      ),
+                  ])
+              ]),
+          ], 
+        fluid=True
+    )
+
 
-    return [{'label': i, 'value': j} for i, j in zip(label, value)]
 
-# Callback to get the value of the selected vehicle 2 model
-@app.callback(
-    Output('options_dropdown_2', 'value'),
-    Input('options_dropdown_2', 'options'))
-def set_final_model_2_value(available_options):
-    if not available_options:
+# Set up the callback functions
+
+def first_value(options):
+    '''Function to return the value of the first dropdown option'''
+    if not options:
+        return None
+    return options[0]['value']
+
+
+def vehicle_options(changed, selected_year, selected_make, selected_model, 
+                    snapshot=None):
+    '''Function to update the dropdowns below the one that changed
+    
+    Every dropdown below the changed one gets its options and is set to its
+    first option, so the whole cascade is answered at once.
+    
+    Args:
+        changed(str): 'year', 'make' or 'model'
+        selected_year(int): selected year
+        selected_make(str): selected make
+        selected_model(str): selected model
+        snapshot(DataSnapshot): data to use, the current data if None
+        
+    Returns:
+        options and value of the make, model and options dropdowns, 
+        no_update for the dropdowns that do not change
+    '''
+    catalog_index = (snapshot or current_snapshot()).catalog_index
+    make_options = make_value = dash.no_update
+    model_options = model_value = dash.no_update
+    
+    if changed == 'year':
+        make_options = catalog_index['makes'].get(selected_year, [])
+        selected_make = make_value = first_value(make_options)
+    if changed in ['year', 'make']:
+        model_options = catalog_index['models'].get((selected_year, 
+                                                     selected_make), [])
+        selected_model = model_value = first_value(model_options)
+    trim_options = catalog_index['trims'].get((selected_year, selected_make, 
+                                               selected_model), [])
+    
+    return make_options, make_value, model_options, model_value, \
+        trim_options, first_value(trim_options)
+
+
+# Dropdowns set by the cascade callback of every vehicle
+vehicle_dropdowns = [
+    Output({'type': 'make_dropdown', 'index': MATCH}, 'options'),
+    Output({'type': 'make_dropdown', 'index': MATCH}, 'value'),
+    Output({'type': 'model_dropdown', 'index': MATCH}, 'options'),
+    Output({'type': 'model_dropdown', 'index': MATCH}, 'value'),
+    Output({'type': 'options_dropdown', 'index': MATCH}, 'options'),
+    Output({'type': 'options_dropdown', 'index': MATCH}, 'value'),
+    Input({'type': 'year_dropdown', 'index': MATCH}, 'value'),
+    Input({'type': 'make_dropdown', 'index': MATCH}, 'value'),
+    Input({'type': 'model_dropdown', 'index': MATCH}, 'value')]
+
+
+# Callback to set the make, model and options dropdowns of every vehicle 
+# based on the selected year, make and model
+def set_vehicle_options(selected_year, selected_make, selected_model):
+    if not selected_year or not dash.callback_context.triggered_id:
         raise PreventUpdate
-    return available_options[0]['value']
+    changed = dash.callback_context.triggered_id['type'].split('_')[0]
+    return vehicle_options(changed, selected_year, selected_make, 
+                           selected_model)
+
+
+# Same cascade as vehicle_options, run in the browser from window.vehicleCatalog
+set_vehicle_options_js = '''
+function(selected_year, selected_make, selected_model) {
+    const dc = window.dash_clientside;
+    const triggered = dc.callback_context.triggered;
+    if (!selected_year || !triggered.length || triggered[0].prop_id === '.') {
+        throw dc.PreventUpdate;
+    }
+    const changed = JSON.parse(triggered[0].prop_id.split('}.')[0] + '}')
+        .type.split('_')[0];
+    const find = (items, key) => (items.find(i => i[0] === key) || [key, []])[1];
+    const options = items => items.map(i => ({label: i[0], value: i[0]}));
+    const first = items => items.length ? items[0].value : null;
+
+    const makes = find(window.vehicleCatalog, selected_year);
+    let make_options = dc.no_update, make_value = dc.no_update;
+    let model_options = dc.no_update, model_value = dc.no_update;
+    if (changed === 'year') {
+        make_options = options(makes);
+        selected_make = make_value = first(make_options);
+    }
+    const models = find(makes, selected_make);
+    if (changed === 'year' || changed === 'make') {
+        model_options = options(models);
+        selected_model = model_value = first(model_options);
+    }
+    const trim_options = find(models, selected_model)
+        .map(i => ({label: i[0], value: i[1]}));
+    return [make_options, make_value, model_options, model_value,
+            trim_options, first(trim_options)];
+}
+'''
+
+
+# Callback adding the picked dates as a custom price window
+price_window_dependencies = [
+    Output('time_period', 'options'),
+    Output('time_period', 'value'),
+    Input('price_dates', 'start_date'),
+    Input('price_dates', 'end_date'),
+    State('time_period', 'value')]
+
+
+def set_price_window(start_date, end_date, time_period):
+    options = time_period_options()
+    if not start_date or not end_date:
+        # the picked dates were cleared
+        if time_period in time_period_labels:
+            return options, dash.no_update
+        return options, '3year'
+    custom = fuel_prices.custom_period(start_date, end_date)
+    return options + [{'label': ' picked dates ', 'value': custom}], custom
 
 
 # Callback for the submit button
-@app.callback(
+submit_dependencies = [
     Output('cost_plot', 'figure'),
     Output('co2_plot', 'figure'),
     Output('summary_text', 'children'),
     Output('summary_footnote', 'children'),
     Input('submit', 'n_clicks'),
-    State('options_dropdown_1', 'value'),
-    State('options_dropdown_2', 'value'),
+    State({'type': 'options_dropdown', 'index': ALL}, 'value'),
     State('state_dropdown', 'value'),
     State('city_in', 'value'),
-    State('highway_in', 'value')
-    )
-def submit_calc(n_clicks, car_1_in, car_2_in, state_in, city_miles, 
-                highway_miles):
+    State('highway_in', 'value'),
+    State('time_period', 'value')]
+
+
+def submit_calc(n_clicks, cars_in, state_in, city_miles, highway_miles, 
+                time_period):
+    # the whole callback uses the data current when it started
+    snapshot = current_snapshot()
+    stages = metrics.stages('submit_calc')
     if n_clicks > 0:
-        car1 = cars[cars.index == car_1_in].iloc[0]
-        car2 = cars[cars.index == car_2_in].iloc[0]
+        cars_in = [i for i in cars_in if i is not None]
+        if len(cars_in) < 2:
+            raise PreventUpdate
+        car_rows = selected_rows(cars_in, snapshot)
+        if car_rows is None:
+            return message_figure(unavailable_text), \
+                message_figure(unavailable_text), unavailable_text, ''
+        
+        # Figures and text from the results cache shared by the workers
+        submit_key = ('submit_calc', cars_in, state_in, city_miles, 
+                      highway_miles, time_period, snapshot.version)
+        cached = result_db.get(submit_key) if result_db is not None else None
+        stages.mark('lookup')
+        if cached is not None:
+            return tuple(json.loads(cached))
         
-        car1_costs, car1_co2_state, car1_co2_US, car1_co2_tailpipe, car1_name \
-            = fuel_costs(car1, state_in, city_miles, highway_miles)
-        car2_costs, car2_co2_state, car2_co2_US, car2_co2_tailpipe, car2_name \
-            = fuel_costs(car2, state_in, city_miles, highway_miles)
+        results = [cached_fuel_costs(i, state_in, city_miles, highway_miles, 
+                                     snapshot, time_period) 
+                   for i in car_rows]
+        stages.mark('cost_engine')
+        px = plotly_express()
             
-        co2_all = pd.DataFrame({'tailpipe_co2': [car1_co2_tailpipe, 
-                                                 car2_co2_tailpipe], 
-                            'state_co2': [car1_co2_state, car2_co2_state], 
-                            'US_co2': [car1_co2_US, car2_co2_US], 
-                           'name': [car1_name, car2_name]})
+        co2_all = pd.DataFrame({'tailpipe_co2': [i[3] for i in results], 
+                            'state_co2': [i[1] for i in results], 
+                            'US_co2': [i[2] for i in results], 
+                           'name': [i[4] for i in results]})
         
-        car_costs_all = pd.concat([car1_costs, car2_costs])
+        car_costs_all = pd.concat([i[0] for i in results])
         
         fig_cost = px.bar(car_costs_all, y='annual_cost', x='name',
                           color='area', barmode='group', 
@@ -713,14 +1219,26 @@ def submit_calc(n_clicks, car_1_in, car_2_in, state_in, city_miles,
                          hover_data={'name': False})
         fig_co2.update_layout(title_text='Annual CO2 Emissions', title_x=0.5)
         fig_co2.update_traces(marker_color='#636EFA')
+        stages.mark('figures')
         
-        car1_region_cost = round(car1_costs['annual_cost'].iloc[0])
-        car2_region_cost = round(car2_costs['annual_cost'].iloc[0])
+        # The summary compares two vehicles, the most and the least 
+        # expensive when more than two are selected
+        region_costs = [i[0]['annual_cost'].iloc[0] for i in results]
+        if len(results) > 2:
+            car1_index = int(np.argmax(region_costs))
+            car2_index = int(np.argmin(region_costs))
+        else:
+            car1_index, car2_index = 0, 1
+        car1_name = results[car1_index][4]
+        car2_name = results[car2_index][4]
+        
+        car1_region_cost = round(region_costs[car1_index])
+        car2_region_cost = round(region_costs[car2_index])
         
-        car1_co2 = co2_all['tailpipe_co2'].iloc[0]
-        car2_co2 = co2_all['tailpipe_co2'].iloc[1]
-        car1_region_co2 = co2_all['state_co2'].iloc[0]
-        car2_region_co2 = co2_all['state_co2'].iloc[1]
+        car1_co2 = co2_all['tailpipe_co2'].iloc[car1_index]
+        car2_co2 = co2_all['tailpipe_co2'].iloc[car2_index]
+        car1_region_co2 = co2_all['state_co2'].iloc[car1_index]
+        car2_region_co2 = co2_all['state_co2'].iloc[car2_index]
         
         if car1_region_cost > car2_region_cost:
             summary_name_1 = car1_name
@@ -766,12 +1284,14 @@ def submit_calc(n_clicks, car_1_in, car_2_in, state_in, city_miles,
             {summary_text}** in fuel and emits **{percent_difference_co2} 
             {summary_text} CO2** than a {summary_name_2}.'''
         
-        if ((car1['atvType'] == 'Plug-in Hybrid') \
-            or (car2['atvType'] == 'Plug-in Hybrid')) \
-            and ((car1['fuelType1'] == 'Electricity') \
-            or (car2['fuelType1'] == 'Electricity')):
+        period_text = price_period_text(time_period)
+        cars = snapshot.cars
+        any_phev = (cars.loc[car_rows, 'atvType'] == 'Plug-in Hybrid').any()
+        any_ev = (cars.loc[car_rows, 'fuelType1'] == 'Electricity').any()
+        
+        if any_phev and any_ev:
             summary_footnote = f'''Fuel costs are calculated using the 
-            average fuel prices over the last 3 years in {state_in} and 
+            average fuel prices over {period_text} in {state_in} and 
             the national average. Fuel costs for plug-in hybrids assume 
             that the battery is fully charged each day and that the battery
             is fully drained before switching to gas.
@@ -787,10 +1307,9 @@ def submit_calc(n_clicks, car_1_in, car_2_in, state_in, city_miles,
                     the average CO2 emission rates from electricity 
                     generation in {state_in}.'''
         
-        elif (car1['fuelType1'] == 'Electricity') \
-            or (car2['fuelType1'] == 'Electricity'):
+        elif any_ev:
             summary_footnote = f'''Fuel costs are calculated using the 
-            average fuel prices over the last 3 years in {state_in} and 
+            average fuel prices over {period_text} in {state_in} and 
             the national average.  
             Electric vehicles have no tailpipe CO2 
             emissions, the total emissions in this analysis represent the 
@@ -798,10 +1317,9 @@ def submit_calc(n_clicks, car_1_in, car_2_in, state_in, city_miles,
             multiplied by the average CO2 emission rates from electricity 
             generation in {state_in}.'''
             
-        elif (car1['atvType'] == 'Plug-in Hybrid') \
-            or (car2['atvType'] == 'Plug-in Hybrid'):
+        elif any_phev:
             summary_footnote = f'''Fuel costs are calculated using the 
-            average fuel prices over the last 3 years in {state_in} and 
+            average fuel prices over {period_text} in {state_in} and 
             the national average. Fuel costs for plug-in hybrids assume 
             that the battery is fully charged each day and that the battery
             is fully drained before switching to gas.  
@@ -811,92 +1329,206 @@ def submit_calc(n_clicks, car_1_in, car_2_in, state_in, city_miles,
                 emissions while running on gas plus the electricity used to 
                 charge the battery multiplied by the average CO2 emission rates 
                 from electricity generation in {state_in}.'''
-        
-        elif (car1['fuelType1'] == 'Electricity') \
-            or (car2['fuelType1'] == 'Electricity'):
-            summary_footnote = f'''Fuel costs are calculated using the 
-            average fuel prices over the last 3 years in {state_in} and 
-            the national average.  
-            Electric vehicles have no tailpipe CO2 
-            emissions, the total emissions in this analysis represent the 
-            electricity used to charge the vehicle 
-            multiplied by the average CO2 emission rates from electricity 
-            generation in {state_in}.'''
-            
+
         else:
             summary_footnote = f'''Fuel costs are calculated using the 
-            average fuel prices over the last 3 years in {state_in} and 
+            average fuel prices over {period_text} in {state_in} and 
             the national average.'''
+        stages.mark('summary')
 
     else:
-        co2_all = pd.DataFrame({'tailpipe_co2': [office1_co2_tailpipe, 
-                                                 office2_co2_tailpipe], 
-                            'state_co2': [office1_co2_state, office2_co2_state], 
-                            'US_co2': [office1_co2_US, office2_co2_US], 
-                           'name': [office1_name, office2_name]})
-        
-        car_costs_all = pd.concat([office1_costs, office2_costs])
-        
-        fig_cost = px.bar(car_costs_all, y='annual_cost', x='name',
-                          color='area', barmode='group', 
-                          labels={'name': 'Vehicle', 
-                                  'annual_cost': 'Annual Cost (USD)', 
-                                  'area': ''}, 
-                          color_discrete_map={'Pennsylvania': '#636EFA', 'US': '#EF553B'}, 
-                          template='plotly_white', 
-                          hover_name=('name'), 
-                          hover_data={'name': False, 
-                                      'annual_cost': ':d'})
-        fig_cost.update_layout(title_text='Annual Fuel Costs', title_x=0.5)
-        
-        
-        fig_co2 = px.bar(co2_all, y='state_co2', x='name', 
-                         labels={'name': 'Vehicle', 
-                                 'state_co2': 'CO2 emissions in kg'}, 
-                         template='plotly_white', 
-                         hover_name=('name'), 
-                         hover_data={'name': False})
-        fig_co2.update_layout(title_text='Annual CO2 Emissions', title_x=0.5)
-        fig_co2.update_traces(marker_color='#636EFA')
-        
-        
-        car1_region_cost = round(office1_costs['annual_cost'].iloc[0])
-        car2_region_cost = round(office2_costs['annual_cost'].iloc[0])
-        
-        if car1_region_cost < car2_region_cost:
-            difference_cost = 'less'
-        else:
-            difference_cost = 'more'
-        
-        car1_co2 = co2_all['tailpipe_co2'].iloc[0]
-        car2_co2 = co2_all['tailpipe_co2'].iloc[1]
-        car1_region_co2 = co2_all['state_co2'].iloc[0]
-        car2_region_co2 = co2_all['state_co2'].iloc[1]
-        
-        
-        if car1_co2 < car2_co2:
-            difference_co2 = 'less'
-        else:
-            difference_co2 = 'more'
-        
-        percent_difference_cost = round(abs((car1_region_cost - car2_region_cost) / 
-                                       ((car1_region_cost + car2_region_cost) / 2)) * 100)
-        percent_difference_co2 = round(abs((car1_co2 - car2_co2) / 
-                                       ((car1_co2 + car2_co2) / 2)) * 100)
-        
-        summary_text = f'''A {office1_name} costs **{percent_difference_cost}% 
-        {difference_cost}** in fuel and emits **{percent_difference_co2}% 
-        {difference_co2} CO2** than a {office2_name}, based on 
-        driving 15 city miles and 10 highway miles per day in Scranton, 
-        Pennsylvania.'''
-        
-        summary_footnote = '''Fuel costs are calculated using the 
-            average fuel prices over the last 3 years in Pennsylvania and 
-            the national average.'''
+        # The default comparison is built once when the data is loaded
+        return snapshot.derived['default_response']
+    
+    if result_db is not None:
+        result_db.put(submit_key, '[' + fig_cost.to_json() + ', ' 
+                      + fig_co2.to_json() + ', ' 
+                      + json.dumps([summary_text, summary_footnote])[1:])
+        stages.mark('store')
         
     return fig_cost, fig_co2, summary_text, summary_footnote
     
 
+# Callback for the vehicle ranking button
+rank_dependencies = [
+    Output('rank_table', 'children'),
+    Input('rank_submit', 'n_clicks'),
+    State('state_dropdown', 'value'),
+    State('city_in', 'value'),
+    State('highway_in', 'value'),
+    State('rank_years', 'value'),
+    State('rank_atv', 'value'),
+    State('rank_fuel', 'value'),
+    State('rank_make', 'value'),
+    State('rank_by', 'value'),
+    State('rank_count', 'value'),
+    State('time_period', 'value')]
+
+
+def rank_calc(n_clicks, state_in, city_miles, highway_miles, years, 
+              atv_types, fuel_types, makes, rank_by, count, time_period):
+    if not n_clicks or not state_in or city_miles is None \
+        or highway_miles is None:
+        raise PreventUpdate
+    ranked = rank_vehicles(state_in, city_miles, highway_miles, years, 
+                           atv_types, fuel_types, makes, rank_by, 
+                           min(count or 10, max_rank_count), 
+                           current_snapshot(), time_period)
+    if ranked.empty:
+        return html.P('No vehicles match the selected filters.')
+    ranked.insert(0, 'Rank', range(1, len(ranked) + 1))
+    return dbc.Table.from_dataframe(ranked, striped=True, hover=True, 
+                                    size='sm')
+
+
+# Callback for the daily miles chart, updated with the comparison
+mileage_dependencies = [
+    Output('mileage_plot', 'figure'),
+    Input('submit', 'n_clicks'),
+    State({'type': 'options_dropdown', 'index': ALL}, 'value'),
+    State('state_dropdown', 'value'),
+    State('city_in', 'value'),
+    State('highway_in', 'value'),
+    State('time_period', 'value')]
+
+
+def mileage_calc(n_clicks, cars_in, state_in, city_miles, highway_miles, 
+                 time_period):
+    cars_in = [i for i in cars_in if i is not None]
+    if not n_clicks or len(cars_in) < 2 or city_miles is None \
+        or highway_miles is None:
+        raise PreventUpdate
+    snapshot = current_snapshot()
+    car_rows = selected_rows(cars_in, snapshot)
+    if car_rows is None:
+        return message_figure(unavailable_text)
+    curves, phev_ranges = mileage_costs(car_rows, state_in, city_miles, 
+                                        highway_miles, snapshot, time_period)
+    return mileage_figure(curves, phev_ranges)
+
+
+# Callback for the map of every state, updated with the comparison
+state_map_dependencies = [
+    Output('state_map', 'figure'),
+    Input('submit', 'n_clicks'),
+    Input('map_metric', 'value'),
+    State({'type': 'options_dropdown', 'index': ALL}, 'value'),
+    State('city_in', 'value'),
+    State('highway_in', 'value'),
+    State('time_period', 'value')]
+
+
+def state_map_calc(n_clicks, metric, cars_in, city_miles, highway_miles, 
+                   time_period):
+    cars_in = [i for i in cars_in if i is not None]
+    if not n_clicks or not cars_in or city_miles is None \
+        or highway_miles is None:
+        raise PreventUpdate
+    snapshot = current_snapshot()
+    car_rows = selected_rows(cars_in, snapshot)
+    if car_rows is None:
+        return message_figure(unavailable_text)
+    map_costs = state_map_costs(car_rows, city_miles, highway_miles, 
+                                snapshot, time_period)
+    return state_map_figure(map_costs, metric)
+
+
+def create_app(config=None):
+    '''Function to create the dashboard app
+    
+    Sets up the data store, results cache, routes and callbacks, and keeps 
+    them in this module, so one app is created for each process. Importing 
+    the module does not load any data. With background_load the data loads 
+    in a background thread: the server answers /health at once, /ready once 
+    the data is loaded, and pages wait for the data.
+    
+    Args:
+        config(dict): settings replacing those of default_config
+        
+    Returns:
+        Dash app
+    '''
+    global app, server, data_store, result_db, clientside_dropdowns, \
+        batch_max_size
+    config = {**default_config(), **(config or {})}
+    clientside_dropdowns = config['clientside_dropdowns']
+    batch_max_size = config['batch_max_size']
+    
+    if config['result_cache_db']:
+        result_db = result_cache.SQLiteCache(
+            config['result_cache_db'], ttl=config['result_cache_ttl'], 
+            max_entries=config['result_cache_size'])
+    else:
+        result_db = None
+    
+    # Current data, swapped for a new version when the data files change. 
+    # Results cached for the old version are dropped. A shared_path maps the 
+    # numeric vehicle columns and price statistics from files shared by all 
+    # workers on the host.
+    data_store = data_snapshot.SnapshotStore(
+        config['data_path'], prepare=prepare_snapshot, 
+        on_swap=[lambda snapshot: fuel_costs_cache.clear(), 
+                 lambda snapshot: state_map_cache.clear()], 
+        shared_path=config['shared_path'], 
+        background=config['background_load'])
+    if config['data_watch_interval']:
+        data_store.watch(config['data_watch_interval'])
+    
+    # Cache hit rates and snapshot reloads for /metrics
+    metrics.add_cache('fuel_costs', fuel_costs_cache)
+    metrics.add_cache('state_map', state_map_cache)
+    if result_db is not None:
+        metrics.add_cache('result_db', result_db)
+    metrics.add_snapshot_store(data_store)
+    
+    # Create Dash app
+    app = dash.Dash(external_stylesheets=[dbc.themes.BOOTSTRAP], 
+                    external_scripts=['/catalog.js'] if clientside_dropdowns 
+                    else None)
+    server = app.server
+    server.add_url_rule('/catalog.js', view_func=catalog_redirect)
+    server.add_url_rule('/catalog/<content_hash>.js', view_func=catalog_js)
+    server.add_url_rule('/admin/reload', view_func=admin_reload, 
+                        methods=['POST'])
+    server.add_url_rule('/metrics', view_func=metrics_page)
+    server.add_url_rule('/health', view_func=health)
+    server.add_url_rule('/ready', view_func=ready)
+    server.add_url_rule('/api/fuel_costs', view_func=batch_fuel_costs, 
+                        methods=['POST'])
+    app.layout = serve_layout
+    
+    # Set up the callback functions
+    if clientside_dropdowns:
+        app.clientside_callback(set_vehicle_options_js, *vehicle_dropdowns)
+    else:
+        app.callback(*vehicle_dropdowns)(set_vehicle_options)
+    app.callback(*price_window_dependencies, 
+                 prevent_initial_call=True)(set_price_window)
+    app.callback(*submit_dependencies, prevent_initial_call=True)(submit_calc)
+    app.callback(*rank_dependencies)(rank_calc)
+    app.callback(*mileage_dependencies, 
+                 prevent_initial_call=True)(mileage_calc)
+    app.callback(*state_map_dependencies, 
+                 prevent_initial_call=True)(state_map_calc)
+    
+    # Profile slow callbacks when PROFILE_CALLBACKS or PROFILE_ON_REQUEST is 
+    # set
+    profiling.instrument_callbacks(app)
+    
+    # Time every server callback when METRICS_ENABLED=1
+    metrics.instrument_callbacks(app)
+    return app
+
+
+def __getattr__(name):
+    # the app is created on first use, so WSGI files importing app or server
+    # from this module keep working
+    if name in ['app', 'server', 'data_store']:
+        create_app()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 # Run on local server
 if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file